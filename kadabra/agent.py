@@ -1,16 +1,21 @@
-import threading, logging, datetime, json, time, sys
+import threading, logging, datetime, json, time, sys, socket, random,\
+       hashlib, collections, math, struct, os, uuid
 
 if (sys.version_info > (3, 0)):
-    from queue import Queue, Empty
+    from queue import Queue, Empty, Full
 else:
-    from Queue import Queue, Empty
+    from Queue import Queue, Empty, Full
 
 from threading import Timer
 
-from .channels import RedisChannel
+from .channels import RedisChannel, ShardedRedisChannel,\
+                       RedisClusterChannel, PriorityRedisChannel,\
+                       MemoryChannel, SpoolChannel, SharedMemoryChannel,\
+                       SocketChannel, DatagramChannel
 from .publishers import DebugPublisher, InfluxDBPublisher
+from .metrics import Metrics, Dimension, Counter, Timer as MetricsTimer, Units
 from .utils import get_now, get_datetime_from_timestamp_string,\
-                   timedelta_total_seconds
+                   timedelta_total_seconds, get_age_seconds, TokenBucket
 
 from .config import DEFAULT_CONFIG
 
@@ -45,6 +50,22 @@ class Agent(object):
         custom_channel_args = config["AGENT_CHANNEL_ARGS"]
         if channel_type == 'redis':
             channel_type = RedisChannel
+        elif channel_type == 'sharded_redis':
+            channel_type = ShardedRedisChannel
+        elif channel_type == 'redis_cluster':
+            channel_type = RedisClusterChannel
+        elif channel_type == 'priority_redis':
+            channel_type = PriorityRedisChannel
+        elif channel_type == 'memory':
+            channel_type = MemoryChannel
+        elif channel_type == 'spool':
+            channel_type = SpoolChannel
+        elif channel_type == 'shared_memory':
+            channel_type = SharedMemoryChannel
+        elif channel_type == 'socket':
+            channel_type = SocketChannel
+        elif channel_type == 'datagram':
+            channel_type = DatagramChannel
         else:
             raise Exception("Unrecognized channel type: '%s'" % channel_type)
 
@@ -69,22 +90,101 @@ class Agent(object):
             for k,v in custom_publisher_args.items():
                 publisher_args[k] = v
         publisher = publisher_type(**publisher_args)
+        self.dedup_filter = None
+        if config["AGENT_DEDUP_ENABLED"]:
+            self.dedup_filter = DedupFilter(
+                    config["AGENT_DEDUP_WINDOW_SECONDS"],
+                    config["AGENT_DEDUP_CAPACITY"],
+                    config["AGENT_DEDUP_ERROR_RATE"])
+            publisher = DedupPublisher(publisher, self.dedup_filter,
+                    self.logger)
+        self.publisher = publisher
 
         nanny_frequency_seconds = config["AGENT_NANNY_FREQUENCY_SECONDS"]
         nanny_threshold_seconds = config["AGENT_NANNY_THRESHOLD_SECONDS"]
+        self.circuit_breaker = None
+        if config["AGENT_CIRCUIT_BREAKER_FAILURES"]:
+            self.circuit_breaker = CircuitBreaker(self.logger,
+                    config["AGENT_CIRCUIT_BREAKER_FAILURES"],
+                    config["AGENT_CIRCUIT_BREAKER_BACKOFF_SECONDS"],
+                    config["AGENT_CIRCUIT_BREAKER_MAX_BACKOFF_SECONDS"],
+                    config["AGENT_CIRCUIT_BREAKER_PROBE_SIZE"])
         receiver_args = {"channel": channel, "publisher": publisher, "logger":
-                self.logger}
+                self.logger, "circuit_breaker": self.circuit_breaker}
+        nanny_rate_limiter = None
+        if config["AGENT_NANNY_RATE_LIMIT"]:
+            nanny_rate_limiter = TokenBucket(config["AGENT_NANNY_RATE_LIMIT"])
+        # Without the circuit breaker nothing tells an outage apart from bad
+        # metrics, so metrics are only given up on while it is enabled.
+        nanny_max_attempts = None
+        if self.circuit_breaker is not None:
+            nanny_max_attempts = config["AGENT_NANNY_MAX_ATTEMPTS"]
+        nanny_backoff = RetryBackoff(config["AGENT_NANNY_BACKOFF_SECONDS"],
+                config["AGENT_NANNY_MAX_BACKOFF_SECONDS"],
+                max_attempts=nanny_max_attempts)
+        self.agent_id = "%s:%d:%s" % (socket.gethostname(), os.getpid(),
+                uuid.uuid4().hex[:8])
+        if hasattr(channel, "register"):
+            channel.register(self.agent_id)
+        self.channel = channel
+        nanny_lease = None
+        if config["AGENT_NANNY_LEASE_SECONDS"] and hasattr(channel, "lease"):
+            nanny_lease = channel.lease(self.agent_id,
+                    config["AGENT_NANNY_LEASE_SECONDS"])
         nanny_args = {"channel": channel, "publisher": publisher, "logger":
                 self.logger, "frequency_seconds": nanny_frequency_seconds,
-                "threshold_seconds": nanny_threshold_seconds}
+                "threshold_seconds": nanny_threshold_seconds,
+                "circuit_breaker": self.circuit_breaker,
+                "rate_limiter": nanny_rate_limiter, "backoff": nanny_backoff,
+                "lease": nanny_lease}
+        self.max_age = None
+        if config["AGENT_MAX_AGE_SECONDS"]:
+            self.max_age = MaxAge(config["AGENT_MAX_AGE_SECONDS"],
+                    config["AGENT_MAX_AGE_ACTION"], self.logger)
+            receiver_args["max_age"] = self.max_age
+            nanny_args["max_age"] = self.max_age
+        self.retry_requeuer = None
+        if config["AGENT_RETRY_QUEUE_ENABLED"]:
+            if hasattr(channel, "retry"):
+                receiver_args["backoff"] = nanny_backoff
+                receiver_args["retry_queue"] = True
+                nanny_args["retry_queue"] = True
+                self.retry_requeuer = RetryRequeuer(channel, self.logger,
+                        config["AGENT_RETRY_QUEUE_FREQUENCY_SECONDS"],
+                        config["AGENT_RETRY_QUEUE_MAX_BATCH_SIZE"])
+            else:
+                self.logger.warn("The channel doesn't have a retry queue, "
+                        "leaving failed metrics for the nanny")
+        self.recovery = None
+        self.backfiller = None
+        if config["AGENT_RECOVERY_BACKLOG_SECONDS"]:
+            if hasattr(channel, "backlog_stats") and\
+                    hasattr(channel, "receive_newest"):
+                self.recovery = Recovery(channel, self.logger,
+                        config["AGENT_RECOVERY_BACKLOG_SECONDS"],
+                        config["AGENT_RECOVERY_CHECK_SECONDS"])
+                receiver_args["recovery"] = self.recovery
+                self.backfiller = Backfiller(channel, publisher, self.logger,
+                        self.recovery,
+                        TokenBucket(config["AGENT_RECOVERY_BACKFILL_RATE"]),
+                        config["AGENT_RECOVERY_BACKFILL_BATCH_SIZE"],
+                        circuit_breaker=self.circuit_breaker,
+                        backoff=receiver_args.get("backoff"),
+                        retry_queue=receiver_args.get("retry_queue", False),
+                        max_age=self.max_age)
+            else:
+                self.logger.warn("The channel can't receive the newest "
+                        "metrics first, recovery mode is disabled")
 
         if agent_type == "default":
             receiver_type = Receiver
-            receiver_args["receiver_threads"] =\
+            receiver_args["num_threads"] =\
                     config["AGENT_RECEIVER_THREADS"]
             nanny_type = Nanny
             nanny_args["query_limit"] = config["AGENT_NANNY_QUERY_LIMIT"]
             nanny_args["num_threads"] = config["AGENT_NANNY_THREADS"]
+            nanny_args["max_queue_size"] = config["AGENT_NANNY_QUEUE_SIZE"]
+            nanny_args["deduplicate"] = config["AGENT_NANNY_DEDUPLICATE"]
         elif agent_type == "batched":
             receiver_type = BatchedReceiver
             receiver_args["publishing_interval"] =\
@@ -100,6 +200,12 @@ class Agent(object):
         self.receiver = receiver_type(**receiver_args)
         self.nanny = nanny_type(**nanny_args)
 
+        self.statsd = None
+        if config["AGENT_STATSD_ENABLED"]:
+            self.statsd = StatsdReceiver(publisher, self.logger,
+                    config["AGENT_STATSD_HOST"], config["AGENT_STATSD_PORT"],
+                    config["AGENT_STATSD_FLUSH_SECONDS"])
+
         self.stopped = False
 
     def start(self):
@@ -113,9 +219,16 @@ class Agent(object):
         self.logger.info("Starting agent...")
         self.receiver.start()
         self.nanny.start()
+        if self.retry_requeuer is not None:
+            self.retry_requeuer.start()
+        if self.backfiller is not None:
+            self.backfiller.start()
+        if self.statsd is not None:
+            self.statsd.start()
 
         try:
             while not self._check_stopped():
+                self._heartbeat()
                 time.sleep(10)
         except KeyboardInterrupt:
             self.stop()
@@ -129,6 +242,12 @@ class Agent(object):
         self.stopped = True
         self.nanny.stop()
         self.receiver.stop()
+        if self.retry_requeuer is not None:
+            self.retry_requeuer.stop()
+        if self.backfiller is not None:
+            self.backfiller.stop()
+        if self.statsd is not None:
+            self.statsd.stop()
 
     def _check_stopped(self):
         """Determines if the agent has been stopped. This is used internally to
@@ -139,6 +258,17 @@ class Agent(object):
         """
         return self.stopped
 
+    def _heartbeat(self):
+        """Tell the channel that the agent is still alive, if it keeps track
+        of agents (see :meth:`RedisChannel.heartbeat
+        <kadabra.channels.RedisChannel.heartbeat>`)."""
+        if not hasattr(self.channel, "heartbeat"):
+            return
+        try:
+            self.channel.heartbeat()
+        except:
+            self.logger.warn("Failed to send heartbeat", exc_info=1)
+
 class Receiver(object):
     """Manages :class:`~kadabra.agent.ReceiverThread`\s which receive metrics
     from the channel, move them from the queue to in-progress, and attempt to
@@ -159,18 +289,50 @@ class Receiver(object):
 
     :type num_threads: integer
     :param num_threads: The number of threads to use for publishing metrics.
+
+    :type circuit_breaker: ~kadabra.agent.CircuitBreaker
+    :param circuit_breaker: If set, the circuit breaker which stops the threads
+                            from receiving metrics while publishing is failing.
+
+    :type backoff: ~kadabra.agent.RetryBackoff
+    :param backoff: If set, counts failed publishes of each metrics object, so
+                    that metrics which keep failing are dead-lettered.
+
+    :type retry_queue: bool
+    :param retry_queue: Whether metrics which fail to publish are moved to the
+                        channel's retry queue (see :meth:`RedisChannel.retry
+                        <kadabra.channels.RedisChannel.retry>`) instead of
+                        being left in progress for the nanny. Requires a
+                        ``backoff``.
+
+    :type max_age: ~kadabra.agent.MaxAge
+    :param max_age: If set, drops or diverts metrics which are too old instead
+                    of publishing them.
+
+    :type recovery: ~kadabra.agent.Recovery
+    :param recovery: If set, decides when the threads receive the newest
+                     metrics first, while the agent recovers from a backlog.
     """
-    def __init__(self, channel, publisher, logger, num_threads):
+    def __init__(self, channel, publisher, logger, num_threads,
+            circuit_breaker=None, backoff=None, retry_queue=False,
+            max_age=None, recovery=None):
         self.channel = channel
         self.publisher = publisher
         self.logger = logger
         self.num_threads = num_threads
+        self.circuit_breaker = circuit_breaker
+        self.backoff = backoff
+        self.retry_queue = retry_queue
+        self.max_age = max_age
+        self.recovery = recovery
 
         self.threads = []
         for i in range(self.num_threads):
             name = "KadabraReceiver-%s" % str(i)
             receiver_thread = ReceiverThread(self.channel, self.publisher,\
-                    self.logger)
+                    self.logger, circuit_breaker=self.circuit_breaker,
+                    backoff=self.backoff, retry_queue=self.retry_queue,
+                    max_age=self.max_age, recovery=self.recovery)
             receiver_thread.name = name
             self.threads.append(receiver_thread)
 
@@ -201,12 +363,37 @@ class ReceiverThread(threading.Thread):
 
     :type logger: ~logging.Logger
     :param logger: The logger to use.
+
+    :type circuit_breaker: ~kadabra.agent.CircuitBreaker
+    :param circuit_breaker: If set, the circuit breaker which stops this thread
+                            from receiving metrics while publishing is failing.
+
+    :type backoff: ~kadabra.agent.RetryBackoff
+    :param backoff: If set, counts failed publishes of each metrics object.
+
+    :type retry_queue: bool
+    :param retry_queue: Whether metrics which fail to publish are moved to the
+                        channel's retry queue instead of being left in
+                        progress.
+
+    :type max_age: ~kadabra.agent.MaxAge
+    :param max_age: If set, drops or diverts metrics which are too old instead
+                    of publishing them.
+
+    :type recovery: ~kadabra.agent.Recovery
+    :param recovery: If set, decides when to receive the newest metrics first.
     """
-    def __init__(self, channel, publisher, logger):
+    def __init__(self, channel, publisher, logger, circuit_breaker=None,
+            backoff=None, retry_queue=False, max_age=None, recovery=None):
         super(ReceiverThread, self).__init__()
         self.channel = channel
         self.publisher = publisher
         self.logger = logger
+        self.circuit_breaker = circuit_breaker
+        self.backoff = backoff
+        self.retry_queue = retry_queue
+        self.max_age = max_age
+        self.recovery = recovery
 
         self.stopped = False
 
@@ -225,17 +412,60 @@ class ReceiverThread(threading.Thread):
     def _run_once(self):
         """Runs this thread once. It will receive a message from the channel
         containing the metrics, publish them using the publisher, and mark the
-        metrics as complete in the channel."""
+        metrics as complete in the channel. Metrics which fail are left in
+        progress, or moved to the retry queue. If the circuit breaker is open,
+        it waits instead."""
+        breaker = self.circuit_breaker
+        permit = None
         try:
-            metrics = self.channel.receive() # This could be blocking
+            if breaker is not None:
+                permit = breaker.allow()
+                if not permit:
+                    breaker.wait()
+                    return
+            metrics = self._receive()
+            if metrics is not None and self.max_age is not None and\
+                    len(self.max_age.expire(self.channel, [metrics])) == 0:
+                metrics = None
             if metrics is not None:
                 self.logger.debug("Publishing metrics: %s" %
                         metrics.serialize())
-                self.publisher.publish([metrics])
+                try:
+                    failed = _publish(self.publisher, [metrics], breaker,
+                            permit)
+                except:
+                    _retry_later(self.channel, self.backoff, [metrics],
+                            breaker, self.logger, self.retry_queue)
+                    raise
+                if len(failed) > 0:
+                    self.logger.warn("Publisher rejected metrics: %s" %\
+                            metrics.serialize())
+                    _retry_later(self.channel, self.backoff, failed, breaker,
+                            self.logger, self.retry_queue)
+                    return
                 self.channel.complete([metrics])
+                if self.backoff is not None:
+                    self.backoff.record_success([metrics])
         except:
             self.logger.warn("Receiver thread encountered exception",\
                     exc_info=1)
+        finally:
+            if permit:
+                # Does nothing if the probe, if this was one, has finished.
+                breaker.abandon_probe(permit)
+
+    def _receive(self):
+        """Receive metrics from the channel, taking the newest first while
+        the agent is recovering from a backlog.
+
+        :rtype: ~kadabra.Metrics
+        :returns: The metrics, or None if there were none.
+        """
+        if self.recovery is not None and self.recovery.active():
+            received = self.channel.receive_newest(1)
+            if len(received) > 0:
+                return received[0]
+        return self.channel.receive() # This could be blocking
 
     def _check_stopped(self):
         """Determines if this thread has been stopped. This is used internally
@@ -274,14 +504,42 @@ class BatchedReceiver(object):
                            parameter just controls the number of metric
                            collections that are retrieved from the channel and
                            published at once.
+
+    :type circuit_breaker: ~kadabra.agent.CircuitBreaker
+    :param circuit_breaker: If set, the circuit breaker which stops the
+                            receiver from receiving metrics while publishing is
+                            failing.
+
+    :type backoff: ~kadabra.agent.RetryBackoff
+    :param backoff: If set, counts failed publishes of each metrics object, so
+                    that metrics which keep failing are dead-lettered.
+
+    :type retry_queue: bool
+    :param retry_queue: Whether metrics which fail to publish are moved to the
+                        channel's retry queue instead of being left in
+                        progress for the nanny. Requires a ``backoff``.
+
+    :type max_age: ~kadabra.agent.MaxAge
+    :param max_age: If set, drops or diverts metrics which are too old instead
+                    of publishing them.
+
+    :type recovery: ~kadabra.agent.Recovery
+    :param recovery: If set, decides when to receive the newest metrics first,
+                     while the agent recovers from a backlog.
     """
     def __init__(self, channel, publisher, logger, publishing_interval,
-            max_batch_size):
+            max_batch_size, circuit_breaker=None, backoff=None,
+            retry_queue=False, max_age=None, recovery=None):
         self.channel = channel
         self.publisher = publisher
         self.logger = logger
         self.publishing_interval = publishing_interval
         self.max_batch_size = max_batch_size
+        self.circuit_breaker = circuit_breaker
+        self.backoff = backoff
+        self.retry_queue = retry_queue
+        self.max_age = max_age
+        self.recovery = recovery
 
         self.timer = None
 
@@ -302,23 +560,297 @@ class BatchedReceiver(object):
         """Run the batched receiver. This will grab all metrics from the
         queue, move them to the in progress queue, attempt to publish them with
         one call to the publisher, and, if successful, mark each one as
-        complete. It will run at the interval specified by the
-        ``publishing_interval``."""
+        complete. If the batch fails, it is split to find the metrics which
+        can't be published, and the rest are completed. It will run at the
+        interval specified by the ``publishing_interval``. While the circuit
+        breaker is open it skips its runs, and when probing it only receives a
+        small batch."""
+        breaker = self.circuit_breaker
+        permit = None
         try:
+            if breaker is not None:
+                permit = breaker.allow()
+                if not permit:
+                    self.logger.debug("Circuit breaker is open, not "
+                            "receiving")
+                    return
+            probing = breaker is not None and breaker.is_probe(permit)
             self.logger.debug("Running batched receiver")
-            batch = self.channel.receive_batch(self.max_batch_size)
+            size = breaker.probe_size if probing else self.max_batch_size
+            if self.recovery is not None and self.recovery.active():
+                batch = self.channel.receive_newest(size)
+            else:
+                batch = self.channel.receive_batch(size)
             self.logger.debug("%s metrics received" % len(batch))
-            self.publisher.publish(batch)
-            self.channel.complete(batch)
+            if self.max_age is not None:
+                batch = self.max_age.expire(self.channel, batch)
+            if len(batch) == 0:
+                return
+            published, failed = _publish_bisecting(self.publisher, batch,
+                    breaker, self.logger, permit)
+            self.channel.complete(published)
+            if self.backoff is not None:
+                self.backoff.record_success(published)
+            _retry_later(self.channel, self.backoff, failed, breaker,
+                    self.logger, self.retry_queue)
         except:
             self.logger.warn("Batched receiver runner encountered exception",\
                     exc_info=1)
         finally:
+            if permit:
+                breaker.abandon_probe(permit)
             timer = Timer(self.publishing_interval, self._run_batched_receiver)
             timer.name = "KadabraBatchedReceiverRunner"
             self.timer = timer
             timer.start()
 
+class StatsdReceiver(object):
+    """Listens for StatsD lines over UDP and publishes them, so that
+    applications which emit StatsD can share the agent with those that use
+    Kadabra. Lines are parsed by a :class:`~kadabra.agent.StatsdParser` as they
+    arrive, and every ``flush_interval`` seconds the aggregated metrics are
+    published with the agent's publisher. Unlike metrics received from the
+    channel, StatsD metrics which fail to publish are not retried.
+
+    :type publisher: :ref:`api-publishers`
+    :param publisher: The publisher to use for publishing metrics. See
+                      :ref:`api-publishers`.
+
+    :type logger: ~logging.Logger
+    :param logger: The logger to use.
+
+    :type host: string
+    :param host: The host to listen on.
+
+    :type port: int
+    :param port: The UDP port to listen on.
+
+    :type flush_interval: float
+    :param flush_interval: How often, in seconds, to publish the metrics which
+                           have been received.
+    """
+    def __init__(self, publisher, logger, host, port, flush_interval):
+        self.publisher = publisher
+        self.logger = logger
+        self.host = host
+        self.port = port
+        self.flush_interval = flush_interval
+
+        self.parser = StatsdParser()
+        self.sock = None
+        self.thread = None
+        self.stopped = False
+
+    def start(self):
+        """Start listening for StatsD lines."""
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((self.host, self.port))
+        self.sock.settimeout(min(self.flush_interval, 1.0))
+        self.thread = threading.Thread(target=self._run)
+        self.thread.name = "KadabraStatsdReceiver"
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop listening for StatsD lines, publishing any that have already
+        been received."""
+        self.logger.info("Stopping StatsdReceiver...")
+        self.stopped = True
+        if self.thread is not None:
+            self.thread.join()
+        if self.sock is not None:
+            self.sock.close()
+
+    def _run(self):
+        """Read datagrams and publish the parsed metrics every
+        ``flush_interval`` seconds until stopped."""
+        next_flush = time.time() + self.flush_interval
+        while not self.stopped:
+            try:
+                self.parser.parse(self.sock.recv(65535))
+            except socket.timeout:
+                pass
+            except:
+                self.logger.warn("StatsD receiver encountered exception",\
+                        exc_info=1)
+            if time.time() >= next_flush:
+                self._flush()
+                next_flush = time.time() + self.flush_interval
+        self._flush()
+
+    def _flush(self):
+        """Publish the metrics parsed since the last flush."""
+        metrics = self.parser.flush()
+        try:
+            if len(metrics) > 0:
+                failed = self.publisher.publish(metrics) or []
+                if len(failed) > 0:
+                    self.logger.warn("Publisher rejected %s StatsD metrics" %\
+                            len(failed))
+        except:
+            self.logger.warn("Failed to publish %s StatsD metrics" %\
+                    len(metrics), exc_info=1)
+
+class StatsdParser(object):
+    """Parses lines in the StatsD format, with DogStatsD style tags, into
+    :class:`~kadabra.Metrics`::
+
+        name:value|type[|@sample_rate][|#tag:value,tag:value]
+
+    Lines are aggregated until :meth:`~kadabra.agent.StatsdParser.flush` is
+    called. Each distinct set of tags and type of metric becomes a
+    :class:`~kadabra.Metrics` with the tags as its dimensions (tags without a
+    value get the value ``true``), plus a ``metric_type`` dimension of
+    ``counter``, ``gauge``, ``timing`` or ``histogram``, so that metrics of
+    different types with the same name don't overwrite each other in the
+    backing store. Counters (``c``) are summed, scaled up by their sample
+    rate. Gauges (``g``) become counters holding the last value received; a
+    value with a leading ``+`` or ``-`` is added to the gauge's current value.
+    Timers (``ms``) and histograms (``h``) become one
+    :class:`~kadabra.Timer` per name, in milliseconds, whose value is the mean
+    of the samples and whose metadata holds their ``count`` (scaled up by the
+    sample rate), ``sum``, ``lower``, ``upper``, ``stddev`` and percentiles
+    (such as ``90_percentile``). Other types, and lines which can't be parsed,
+    are skipped and counted.
+
+    Parsing avoids regular expressions and only splits each line as far as it
+    needs to, as the agent may need to handle a lot of lines.
+
+    :type timestamp_format: string
+    :param timestamp_format: The format string for timestamps of the metrics.
+
+    :type percentiles: list
+    :param percentiles: The percentiles of timer and histogram samples to
+                        report.
+    """
+    #: The ``metric_type`` dimension for each StatsD type.
+    METRIC_TYPES = {"c": "counter", "g": "gauge", "ms": "timing",
+            "h": "histogram"}
+
+    def __init__(self, timestamp_format="%Y-%m-%dT%H:%M:%S.%fZ",
+            percentiles=(90,)):
+        self.timestamp_format = timestamp_format
+        self.percentiles = percentiles
+        self.lock = threading.Lock()
+        self.groups = {}
+        self.gauges = {}
+        self.parsed = 0
+        self.skipped = 0
+
+    def parse(self, data):
+        """Parse a batch of newline separated lines, such as a datagram.
+
+        :type data: bytes
+        :param data: The lines to parse.
+        """
+        parsed = 0
+        skipped = 0
+        with self.lock:
+            groups = self.groups
+            for line in data.decode("utf-8", "replace").split("\n"):
+                name, sep, rest = line.partition(":")
+                if not sep or not name:
+                    if line.strip():
+                        skipped += 1
+                    continue
+                raw_value, sep, rest = rest.partition("|")
+                if not sep:
+                    skipped += 1
+                    continue
+                metric_type, sep, rest = rest.partition("|")
+                sample_rate = 1.0
+                tags = ""
+                while sep:
+                    section, sep, rest = rest.partition("|")
+                    if section[:1] == "@":
+                        sample_rate = section[1:]
+                    elif section[:1] == "#":
+                        tags = section[1:]
+                try:
+                    value = float(raw_value)
+                    sample_rate = float(sample_rate)
+                except ValueError:
+                    skipped += 1
+                    continue
+                if sample_rate <= 0 or metric_type not in self.METRIC_TYPES:
+                    skipped += 1
+                    continue
+
+                key = (tags, self.METRIC_TYPES[metric_type])
+                group = groups.get(key)
+                if group is None:
+                    group = groups[key] = {}
+                if metric_type == "c":
+                    group[name] = group.get(name, 0.0) + value / sample_rate
+                elif metric_type == "g":
+                    if raw_value[:1] in ("+", "-"):
+                        value += self.gauges.get((tags, name), 0.0)
+                    self.gauges[(tags, name)] = value
+                    group[name] = value
+                else:
+                    samples = group.get(name)
+                    if samples is None:
+                        samples = group[name] = [[], 0.0]
+                    samples[0].append(value)
+                    samples[1] += 1 / sample_rate
+                parsed += 1
+            self.parsed += parsed
+            self.skipped += skipped
+
+    def flush(self):
+        """Return the metrics aggregated since the last flush, and start
+        aggregating again. Gauges keep their current values, so that relative
+        changes received after the flush apply to them.
+
+        :rtype: list
+        :returns: A list of :class:`~kadabra.Metrics`, one per distinct set of
+                  tags and type of metric.
+        """
+        with self.lock:
+            groups = self.groups
+            self.groups = {}
+        now = get_now()
+        metrics = []
+        for (tags, metric_type), group in groups.items():
+            dimensions = []
+            for tag in tags.split(",") if tags else []:
+                tag_name, sep, tag_value = tag.partition(":")
+                dimensions.append(Dimension(tag_name,
+                    tag_value if sep else "true"))
+            dimensions.append(Dimension("metric_type", metric_type))
+            if metric_type == "counter" or metric_type == "gauge":
+                metrics.append(Metrics(dimensions,
+                    [Counter(n, now, {}, v) for n, v in group.items()], [],
+                    self.timestamp_format))
+            else:
+                metrics.append(Metrics(dimensions, [],
+                    [self._timer(n, now, values, count)
+                        for n, (values, count) in group.items()],
+                    self.timestamp_format))
+        return metrics
+
+    def _timer(self, name, now, values, count):
+        """Aggregate the samples of a timer or histogram into a
+        :class:`~kadabra.Timer` holding their mean, with the other statistics
+        in its metadata."""
+        values = sorted(values)
+        total = sum(values)
+        mean = total / len(values)
+        metadata = {
+            "count": count,
+            "sum": total,
+            "lower": values[0],
+            "upper": values[-1],
+            "stddev": math.sqrt(sum((v - mean) ** 2 for v in values) /
+                len(values))
+        }
+        for percentile in self.percentiles:
+            rank = int(math.ceil(percentile / 100.0 * len(values)))
+            metadata["%s_percentile" % percentile] =\
+                    values[min(max(rank, 1), len(values)) - 1]
+        return MetricsTimer(name, now, metadata,
+                datetime.timedelta(milliseconds=mean), Units.MILLISECONDS)
+
 class Nanny(object):
     """Monitors metrics that have been in-progress for a long time and attemps
     to republish them. This object will periodically query objects in the
@@ -357,9 +889,48 @@ class Nanny(object):
     :type num_threads: integer
     :param num_threads: The number of :class:`~kadabra.agent.NannyThread`\s to
                         use for republishing.
+
+    :type circuit_breaker: ~kadabra.agent.CircuitBreaker
+    :param circuit_breaker: If set, the circuit breaker which stops the nanny
+                            from republishing while publishing is failing.
+
+    :type rate_limiter: ~kadabra.utils.TokenBucket
+    :param rate_limiter: If set, limits how many metrics are republished per
+                         second.
+
+    :type backoff: ~kadabra.agent.RetryBackoff
+    :param backoff: If set, tracks failed republishes of each metrics object
+                    so that they are retried with exponential backoff.
+
+    :type max_queue_size: integer
+    :param max_queue_size: The maximum number of metrics waiting to be
+                           republished, or 0 for no limit. Once the queue is
+                           full, the rest of a run's metrics are left for the
+                           next run.
+
+    :type deduplicate: bool
+    :param deduplicate: Whether to skip metrics which are already queued or
+                        being republished from a previous run.
+
+    :type lease: ~kadabra.channels.RedisLease
+    :param lease: If set, the nanny only runs while it holds this lease, so
+                  that agents sharing a channel don't republish the same
+                  metrics.
+
+    :type retry_queue: bool
+    :param retry_queue: Whether metrics which fail to republish are moved to
+                        the channel's retry queue instead of being left in
+                        progress.
+
+    :type max_age: ~kadabra.agent.MaxAge
+    :param max_age: If set, drops or diverts in-progress metrics which are too
+                    old instead of republishing them.
     """
     def __init__(self, channel, publisher, logger, frequency_seconds,
-            threshold_seconds, query_limit, num_threads):
+            threshold_seconds, query_limit, num_threads,
+            circuit_breaker=None, rate_limiter=None, backoff=None,
+            max_queue_size=0, deduplicate=False, lease=None,
+            retry_queue=False, max_age=None):
         self.channel = channel
         self.publisher = publisher
         self.logger = logger
@@ -367,8 +938,16 @@ class Nanny(object):
         self.threshold_seconds = threshold_seconds
         self.query_limit = query_limit
         self.num_threads = num_threads
-
-        self.queue = Queue()
+        self.circuit_breaker = circuit_breaker
+        self.rate_limiter = rate_limiter
+        self.backoff = backoff
+        self.max_queue_size = max_queue_size
+        self.in_flight = InFlight() if deduplicate else None
+        self.lease = lease
+        self.retry_queue = retry_queue
+        self.max_age = max_age
+
+        self.queue = Queue(max_queue_size)
         self.threads = []
         self.timer = None
 
@@ -379,7 +958,11 @@ class Nanny(object):
         for i in range(self.num_threads):
             name = "KadabraNannyThread-%s" % str(i)
             nanny_thread = NannyThread(self.channel, self.publisher,
-                    self.queue, self.logger)
+                    self.queue, self.logger,
+                    circuit_breaker=self.circuit_breaker,
+                    rate_limiter=self.rate_limiter, backoff=self.backoff,
+                    in_flight=self.in_flight, lease=self.lease,
+                    retry_queue=self.retry_queue)
             nanny_thread.name = name
             self.threads.append(nanny_thread)
             nanny_thread.start()
@@ -397,20 +980,35 @@ class Nanny(object):
             self.timer.cancel()
         for thread in self.threads:
             thread.stop()
+        _release(self.lease, self.logger)
 
     def _run_nanny(self):
         """Runs the nanny. It will check the channel's in-progress queue at the
         configured frequency, and add any in-progress items to an internal
         queue, which the :class:`~kadabra.agent.NannyThread`\s will listen to
-        and attempt to republish metrics from."""
+        and attempt to republish metrics from. While the circuit breaker is
+        open it, or another agent holds the lease, it skips its runs. Metrics
+        which are backing off after failing to republish, or which are still
+        queued or being republished from a previous run, are skipped, and the
+        freshest metrics are queued first."""
         try:
+            if self.lease is not None and not self.lease.acquire():
+                self.logger.debug("Another agent holds the nanny lease, "
+                        "skipping nanny")
+                return
+            if self.circuit_breaker is not None and\
+                    self.circuit_breaker.is_open():
+                self.logger.debug("Circuit breaker is open, skipping nanny")
+                return
             self.logger.debug("Running nanny")
             in_progress = self.channel.in_progress(self.query_limit)
+            if self.max_age is not None:
+                in_progress = self.max_age.expire(self.channel, in_progress)
 
             if len(in_progress) == 0:
                 self.logger.debug("No metrics found in progress.")
 
-            for metrics in in_progress:
+            for metrics in _freshest_first(in_progress):
                 if metrics.serialized_at is not None:
                     should_republish = _should_republish(metrics,
                             self.threshold_seconds, self.logger)
@@ -419,8 +1017,13 @@ class Nanny(object):
                             "something is wrong with the channel. "
                             "Attempting to republish anyway")
                     should_republish = True
-                if should_republish:
-                    self.queue.put(metrics)
+                if should_republish and self.backoff is not None and\
+                        not self.backoff.ready(metrics):
+                    should_republish = False
+                if should_republish and not self._enqueue(metrics):
+                    self.logger.info("Nanny queue is full, leaving the rest "
+                            "of the in-progress metrics for the next run")
+                    break
         except:
             self.logger.warn("Encountered exception trying to get "
                     "in-progress metrics", exc_info=1)
@@ -430,6 +1033,57 @@ class Nanny(object):
             self.timer = timer
             timer.start()
 
+    def _enqueue(self, metrics):
+        """Add metrics to the queue, unless they are already queued or being
+        republished.
+
+        :type metrics: ~kadabra.Metrics
+        :param metrics: The metrics to queue.
+
+        :rtype: bool
+        :returns: False if the queue is full, True otherwise.
+        """
+        key = None
+        if self.in_flight is not None:
+            key = _metrics_key(metrics)
+            if not self.in_flight.add(key):
+                return True
+        try:
+            self.queue.put_nowait(metrics)
+        except Full:
+            if key is not None:
+                self.in_flight.discard(key)
+            return False
+        return True
+
+class InFlight(object):
+    """A thread-safe set of the keys of metrics which the nanny has queued or
+    is republishing."""
+    def __init__(self):
+        self.keys = set()
+        self.lock = threading.Lock()
+
+    def add(self, key):
+        """Add a key.
+
+        :rtype: bool
+        :returns: True if the key was added, False if it was already present.
+        """
+        with self.lock:
+            if key in self.keys:
+                return False
+            self.keys.add(key)
+            return True
+
+    def discard(self, key):
+        """Remove a key, if it is present."""
+        with self.lock:
+            self.keys.discard(key)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.keys)
+
 class NannyThread(threading.Thread):
     """Listens to a queue for metrics that have been in progress for a long
     time and attempts to republish them. If the publishing is successful,
@@ -447,13 +1101,50 @@ class NannyThread(threading.Thread):
 
     :type logger: ~logging.Logger
     :param logger: The :class:`Logger` to log messages to.
+
+    :type circuit_breaker: ~kadabra.agent.CircuitBreaker
+    :param circuit_breaker: If set, the circuit breaker which stops this thread
+                            from republishing while publishing is failing.
+
+    :type rate_limiter: ~kadabra.utils.TokenBucket
+    :param rate_limiter: If set, limits how many metrics are republished per
+                         second.
+
+    :type backoff: ~kadabra.agent.RetryBackoff
+    :param backoff: If set, records failed republishes so that they are
+                    retried with exponential backoff.
+
+    :type in_flight: ~kadabra.agent.InFlight
+    :param in_flight: If set, the keys of the metrics queued or being
+                      republished, which this thread removes metrics from once
+                      it is done with them.
+
+    :type lease: ~kadabra.channels.RedisLease
+    :param lease: If set, metrics are only republished while the nanny holds
+                  this lease; once it is lost, queued metrics are dropped and
+                  left to the agent which holds it.
+
+    :type retry_queue: bool
+    :param retry_queue: Whether metrics which fail to republish are moved to
+                        the channel's retry queue (see
+                        :meth:`RedisChannel.retry
+                        <kadabra.channels.RedisChannel.retry>`) instead of
+                        being left in progress.
     """
-    def __init__(self, channel, publisher, queue, logger):
+    def __init__(self, channel, publisher, queue, logger,
+            circuit_breaker=None, rate_limiter=None, backoff=None,
+            in_flight=None, lease=None, retry_queue=False):
         super(NannyThread, self).__init__()
         self.channel = channel
         self.publisher = publisher
         self.queue = queue
         self.logger = logger
+        self.circuit_breaker = circuit_breaker
+        self.rate_limiter = rate_limiter
+        self.backoff = backoff
+        self.in_flight = in_flight
+        self.lease = lease
+        self.retry_queue = retry_queue
 
         self.stopped = False
 
@@ -471,19 +1162,61 @@ class NannyThread(threading.Thread):
 
     def _run_once(self):
         """Listen to the queue for metrics to publish and attempt to publish
-        them and mark them as complete."""
+        them and mark them as complete. If the circuit breaker is open, it
+        waits instead."""
+        breaker = self.circuit_breaker
+        permit = None
         try:
+            if breaker is not None:
+                permit = breaker.allow()
+                if not permit:
+                    breaker.wait()
+                    return
             metrics = self.queue.get(timeout=10)
             if metrics is not None:
-                self.logger.debug("Publishing metrics: %s" %\
-                        metrics.serialize())
-                self.publisher.publish([metrics])
-                self.channel.complete([metrics])
+                try:
+                    self._republish(metrics, breaker, permit)
+                finally:
+                    if self.in_flight is not None:
+                        self.in_flight.discard(_metrics_key(metrics))
         except Empty:
             pass
         except:
             self.logger.warn("Nanny thread encountered exception",\
                     exc_info=1)
+        finally:
+            if permit:
+                # Does nothing if the probe, if this was one, has finished.
+                breaker.abandon_probe(permit)
+
+    def _republish(self, metrics, breaker, permit=None):
+        """Republish metrics, once the rate limiter allows it, and mark them as
+        complete."""
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        if self.lease is not None and not self.lease.check():
+            self.logger.debug("Lost the nanny lease, dropping metrics")
+            return
+        self.logger.debug("Publishing metrics: %s" %\
+                metrics.serialize())
+        try:
+            failed = _publish(self.publisher, [metrics], breaker, permit)
+        except:
+            self._record_failure(metrics, breaker)
+            raise
+        if len(failed) > 0:
+            self.logger.warn("Publisher rejected metrics: %s" %\
+                    metrics.serialize())
+            self._record_failure(metrics, breaker)
+            return
+        self.channel.complete([metrics])
+        if self.backoff is not None:
+            self.backoff.record_success([metrics])
+
+    def _record_failure(self, metrics, breaker):
+        """Count a failed republish (see :func:`_retry_later`)."""
+        _retry_later(self.channel, self.backoff, [metrics], breaker,
+                self.logger, self.retry_queue)
 
     def _check_stopped(self):
         """Determines if this thread has been stopped. This is used internally
@@ -519,15 +1252,50 @@ class BatchedNanny(object):
     :type max_batch_size: integer
     :param max_batch_size: The maximum size of the batch to receive from the
                            channel and attempt to republish.
+
+    :type circuit_breaker: ~kadabra.agent.CircuitBreaker
+    :param circuit_breaker: If set, the circuit breaker which stops the nanny
+                            from republishing while publishing is failing.
+
+    :type rate_limiter: ~kadabra.utils.TokenBucket
+    :param rate_limiter: If set, limits how many metrics are republished per
+                         second; each run republishes no more than the tokens
+                         available.
+
+    :type backoff: ~kadabra.agent.RetryBackoff
+    :param backoff: If set, tracks failed republishes of each metrics object
+                    so that they are retried with exponential backoff.
+
+    :type lease: ~kadabra.channels.RedisLease
+    :param lease: If set, the nanny only runs while it holds this lease, so
+                  that agents sharing a channel don't republish the same
+                  metrics.
+
+    :type retry_queue: bool
+    :param retry_queue: Whether metrics which fail to republish are moved to
+                        the channel's retry queue instead of being left in
+                        progress.
+
+    :type max_age: ~kadabra.agent.MaxAge
+    :param max_age: If set, drops or diverts in-progress metrics which are too
+                    old instead of republishing them.
     """
     def __init__(self, channel, publisher, logger, frequency_seconds,
-            threshold_seconds, max_batch_size):
+            threshold_seconds, max_batch_size, circuit_breaker=None,
+            rate_limiter=None, backoff=None, lease=None, retry_queue=False,
+            max_age=None):
         self.channel = channel
         self.publisher = publisher
         self.logger = logger
         self.frequency_seconds = frequency_seconds
         self.threshold_seconds = threshold_seconds
         self.max_batch_size = max_batch_size
+        self.circuit_breaker = circuit_breaker
+        self.rate_limiter = rate_limiter
+        self.backoff = backoff
+        self.lease = lease
+        self.retry_queue = retry_queue
+        self.max_age = max_age
 
         self.timer = None
 
@@ -543,31 +1311,1087 @@ class BatchedNanny(object):
         self.logger.info("Stopping batched nanny...")
         if self.timer is not None:
             self.timer.cancel()
+        _release(self.lease, self.logger)
 
     def _run_nanny(self):
         """Runs the nanny. It will check the channel's in-progress queue at the
         configured frequency, and attempt to republish the in-progress metrics
-        as a batch."""
+        as a batch, splitting it to isolate metrics which can't be published.
+        Metrics which have failed too many times are moved to the channel's
+        dead letter list. While the circuit breaker is open, or another agent
+        holds the lease, it skips its runs, and when probing it only
+        republishes a small batch."""
+        breaker = self.circuit_breaker
+        permit = None
         try:
+            if self.lease is not None and not self.lease.acquire():
+                self.logger.debug("Another agent holds the nanny lease, "
+                        "skipping nanny")
+                return
+            if breaker is not None:
+                permit = breaker.allow()
+                if not permit:
+                    self.logger.debug("Circuit breaker is open, skipping "
+                            "nanny")
+                    return
+            probing = breaker is not None and breaker.is_probe(permit)
             self.logger.debug("Running batched nanny")
             in_progress = self.channel.in_progress(self.max_batch_size)
+            if self.max_age is not None:
+                in_progress = self.max_age.expire(self.channel, in_progress)
 
             if len(in_progress) == 0:
                 self.logger.debug("No metrics found in progress.")
 
             batch = [m for m in in_progress if _should_republish(m,
                 self.threshold_seconds, self.logger)]
-
-            self.publisher.publish(batch)
-            self.channel.complete(batch)
+            if self.backoff is not None:
+                batch = [m for m in batch if self.backoff.ready(m)]
+            if self.rate_limiter is not None:
+                allowed = self.rate_limiter.take(len(batch))
+                if allowed < len(batch):
+                    batch = _freshest_first(batch)[:allowed]
+            if probing:
+                batch = batch[:breaker.probe_size]
+            if len(batch) == 0:
+                return
+            if self.lease is not None and not self.lease.check():
+                self.logger.debug("Lost the nanny lease, not republishing")
+                return
+
+            published, failed = _publish_bisecting(self.publisher, batch,
+                    breaker, self.logger, permit)
+            self.channel.complete(published)
+            if self.backoff is not None:
+                self.backoff.record_success(published)
+            _retry_later(self.channel, self.backoff, failed, breaker,
+                    self.logger, self.retry_queue)
         except:
             self.logger.warn("Batched nanny encountered exception", exc_info=1)
         finally:
+            if permit:
+                breaker.abandon_probe(permit)
             timer = Timer(self.frequency_seconds, self._run_nanny)
             timer.name = "KadabraBatchedNanny"
             self.timer = timer
             timer.start()
 
+class RetryRequeuer(object):
+    """Periodically moves metrics whose retry is due from the channel's retry
+    queue back onto its queue, where the receiver picks them up again (see
+    :meth:`RedisChannel.requeue_due
+    <kadabra.channels.RedisChannel.requeue_due>`). Each run moves due metrics
+    in batches until there are none left.
+
+    :type channel: :ref:`api-channels`
+    :param channel: The channel with the retry queue.
+
+    :type logger: ~logging.Logger
+    :param logger: The logger to use.
+
+    :type frequency_seconds: float
+    :param frequency_seconds: How often to check for due metrics.
+
+    :type max_batch_size: integer
+    :param max_batch_size: The maximum number of metrics to move with each
+                           call to the channel.
+    """
+    def __init__(self, channel, logger, frequency_seconds, max_batch_size):
+        self.channel = channel
+        self.logger = logger
+        self.frequency_seconds = frequency_seconds
+        self.max_batch_size = max_batch_size
+
+        self.timer = None
+
+    def start(self):
+        """Start the retry requeuer."""
+        timer = Timer(self.frequency_seconds, self._run_requeuer)
+        timer.name = "KadabraRetryRequeuer"
+        self.timer = timer
+        timer.start()
+
+    def stop(self):
+        """Stop the retry requeuer."""
+        self.logger.info("Stopping retry requeuer...")
+        if self.timer is not None:
+            self.timer.cancel()
+
+    def _run_requeuer(self):
+        """Run the retry requeuer, moving due metrics back onto the queue."""
+        try:
+            moved = self.max_batch_size
+            while moved >= self.max_batch_size:
+                moved = self.channel.requeue_due(self.max_batch_size)
+                if moved > 0:
+                    self.logger.debug("Moved %s metrics due for retry back "
+                            "onto the queue" % moved)
+        except:
+            self.logger.warn("Retry requeuer encountered exception",
+                    exc_info=1)
+        finally:
+            timer = Timer(self.frequency_seconds, self._run_requeuer)
+            timer.name = "KadabraRetryRequeuer"
+            self.timer = timer
+            timer.start()
+
+class MaxAge(object):
+    """Stops the agent from publishing metrics which are too old to be useful,
+    for example after a long outage has left hours of metrics in the queue.
+    Metrics serialized more than ``max_age_seconds`` ago are either dropped
+    (marked as complete without being published) or diverted to the
+    channel's dead letter list, where they can be inspected and requeued
+    later.
+
+    :type max_age_seconds: float
+    :param max_age_seconds: The age after which metrics aren't published.
+
+    :type action: string
+    :param action: What to do with metrics which are too old, either ``drop``
+                   or ``divert``. Channels without a dead letter list drop
+                   them either way.
+
+    :type logger: ~logging.Logger
+    :param logger: The logger to use.
+    """
+
+    DROP = "drop"
+    DIVERT = "divert"
+
+    def __init__(self, max_age_seconds, action, logger):
+        if action not in (MaxAge.DROP, MaxAge.DIVERT):
+            raise Exception("Unrecognized max age action: '%s'" % action)
+        self.max_age_seconds = max_age_seconds
+        self.action = action
+        self.logger = logger
+
+        self.lock = threading.Lock()
+        self.expired = 0
+
+    def expire(self, channel, metrics):
+        """Drop or divert the metrics which are too old.
+
+        :type channel: :ref:`api-channels`
+        :param channel: The channel the metrics were received from.
+
+        :type metrics: list
+        :param metrics: The list of :class:`~kadabra.Metrics` to check.
+
+        :rtype: list
+        :returns: The metrics which are young enough to publish.
+        """
+        fresh = []
+        expired = []
+        for m in metrics:
+            age = get_age_seconds(m)
+            if age is not None and age > self.max_age_seconds:
+                expired.append(m)
+            else:
+                fresh.append(m)
+        if len(expired) == 0:
+            return fresh
+        self.logger.info("%s %s metrics older than %s seconds" %\
+                ("Diverting" if self.action == MaxAge.DIVERT else "Dropping",
+                    len(expired), self.max_age_seconds))
+        if self.action == MaxAge.DIVERT and hasattr(channel, "dead_letter"):
+            channel.dead_letter(expired)
+        else:
+            channel.complete(expired)
+        with self.lock:
+            self.expired = self.expired + len(expired)
+        return fresh
+
+    def stats(self):
+        """Return how many metrics have been dropped or diverted.
+
+        :rtype: dict
+        :returns: The number of ``expired`` metrics.
+        """
+        with self.lock:
+            return {"expired": self.expired}
+
+class Recovery(object):
+    """Decides when the agent is recovering from a backlog, so that it can
+    publish current metrics first. The agent is recovering while the oldest
+    metrics in the channel's queue are more than ``backlog_seconds`` old; the
+    receivers then take the newest metrics from the head of the queue (see
+    :meth:`RedisChannel.receive_newest
+    <kadabra.channels.RedisChannel.receive_newest>`), and a
+    :class:`~kadabra.agent.Backfiller` publishes the old metrics from its tail
+    at a limited rate. The queue is checked at most every ``check_seconds``.
+
+    :type channel: :ref:`api-channels`
+    :param channel: The channel to check.
+
+    :type logger: ~logging.Logger
+    :param logger: The logger to use.
+
+    :type backlog_seconds: float
+    :param backlog_seconds: The age of the oldest queued metrics above which
+                            the agent is recovering.
+
+    :type check_seconds: float
+    :param check_seconds: How often to check the queue.
+    """
+    def __init__(self, channel, logger, backlog_seconds, check_seconds):
+        self.channel = channel
+        self.logger = logger
+        self.backlog_seconds = backlog_seconds
+        self.check_seconds = check_seconds
+
+        self.lock = threading.Lock()
+        self.recovering = False
+        self.backlog = None
+        self.next_check = 0
+
+    def active(self):
+        """Return whether the agent is recovering from a backlog, checking the
+        queue if it is due to be checked.
+
+        :rtype: bool
+        :returns: True if the newest metrics should be published first.
+        """
+        with self.lock:
+            if time.time() < self.next_check:
+                return self.recovering
+            self.next_check = time.time() + self.check_seconds
+            try:
+                self.backlog = self.channel.backlog_stats()
+            except:
+                self.logger.warn("Failed to get backlog statistics",
+                        exc_info=1)
+                return self.recovering
+            oldest = self.backlog["oldest_age_seconds"]
+            recovering = oldest is not None and oldest > self.backlog_seconds
+            if recovering != self.recovering:
+                self.logger.info("%s recovery mode, backlog: %s" %\
+                        ("Entering" if recovering else "Leaving",
+                            self.backlog))
+            self.recovering = recovering
+            return recovering
+
+    def stats(self):
+        """Return the backlog statistics from the last check of the queue (see
+        :meth:`RedisChannel.backlog_stats
+        <kadabra.channels.RedisChannel.backlog_stats>`), and whether the agent
+        is recovering.
+
+        :rtype: dict
+        :returns: The backlog statistics, with ``recovering``.
+        """
+        with self.lock:
+            stats = dict(self.backlog or {})
+            stats["recovering"] = self.recovering
+            return stats
+
+class Backfiller(threading.Thread):
+    """Publishes the oldest metrics in the channel's queue while the agent is
+    recovering from a backlog (see :class:`~kadabra.agent.Recovery`), at a
+    limited rate so that it doesn't compete with publishing current metrics.
+    While the agent isn't recovering, the receivers drain the queue oldest
+    first as usual and this thread waits.
+
+    :type channel: :ref:`api-channels`
+    :param channel: The channel to read metrics from.
+
+    :type publisher: :ref:`api-publishers`
+    :param publisher: The publisher to use for publishing metrics.
+
+    :type logger: ~logging.Logger
+    :param logger: The logger to use.
+
+    :type recovery: ~kadabra.agent.Recovery
+    :param recovery: Decides when the agent is recovering.
+
+    :type rate_limiter: ~kadabra.utils.TokenBucket
+    :param rate_limiter: Limits how many metrics are backfilled per second.
+
+    :type max_batch_size: integer
+    :param max_batch_size: The maximum number of metrics to publish at once.
+
+    :type circuit_breaker: ~kadabra.agent.CircuitBreaker
+    :param circuit_breaker: If set, the circuit breaker which stops this thread
+                            from receiving metrics while publishing is failing.
+
+    :type backoff: ~kadabra.agent.RetryBackoff
+    :param backoff: If set, counts failed publishes of each metrics object, so
+                    that metrics which keep failing are dead-lettered.
+
+    :type retry_queue: bool
+    :param retry_queue: Whether metrics which fail to publish are moved to the
+                        channel's retry queue instead of being left in
+                        progress for the nanny. Requires a ``backoff``.
+
+    :type max_age: ~kadabra.agent.MaxAge
+    :param max_age: If set, drops or diverts metrics which are too old instead
+                    of publishing them.
+    """
+    def __init__(self, channel, publisher, logger, recovery, rate_limiter,
+            max_batch_size, circuit_breaker=None, backoff=None,
+            retry_queue=False, max_age=None):
+        super(Backfiller, self).__init__()
+        self.channel = channel
+        self.publisher = publisher
+        self.logger = logger
+        self.recovery = recovery
+        self.rate_limiter = rate_limiter
+        self.max_batch_size = max_batch_size
+        self.circuit_breaker = circuit_breaker
+        self.backoff = backoff
+        self.retry_queue = retry_queue
+        self.max_age = max_age
+
+        self.name = "KadabraBackfiller"
+        self.stopped = False
+
+    def stop(self):
+        """Stops this thread, ensuring that the current run will be the last
+        one."""
+        self.logger.info("Stopping %s..." % self.name)
+        self.stopped = True
+
+    def run(self):
+        """Run this thread until stopped."""
+        while not self._check_stopped():
+            self._run_once()
+        self.logger.info("Stopped %s." % self.name)
+
+    def _run_once(self):
+        """Publish a batch of the oldest metrics, if the agent is recovering
+        and the rate limiter allows it, and mark them as complete. Metrics
+        which fail to publish are counted and retried later, like the
+        receivers' failures."""
+        try:
+            breaker = self.circuit_breaker
+            if not self.recovery.active() or (breaker is not None and
+                    breaker.is_open()):
+                time.sleep(1)
+                return
+            size = self.rate_limiter.take(self.max_batch_size)
+            if size == 0:
+                time.sleep(1.0 / self.rate_limiter.rate)
+                return
+            batch = self.channel.receive_batch(size)
+            if self.max_age is not None:
+                batch = self.max_age.expire(self.channel, batch)
+            if len(batch) == 0:
+                return
+            published, failed = _publish_bisecting(self.publisher, batch,
+                    breaker, self.logger)
+            self.channel.complete(published)
+            if self.backoff is not None:
+                self.backoff.record_success(published)
+            _retry_later(self.channel, self.backoff, failed, breaker,
+                    self.logger, self.retry_queue)
+        except:
+            self.logger.warn("Backfiller encountered exception", exc_info=1)
+
+    def _check_stopped(self):
+        """Determines if this thread has been stopped. This is used internally
+        to run the thread continuously until stopped.
+
+        :rtype: bool
+        :returns: True if the thread has been stopped, False otherwise.
+        """
+        return self.stopped
+
+class CircuitBreaker(object):
+    """Stops the agent from receiving and republishing metrics while the
+    publisher keeps failing, so that an outage of the backing store doesn't
+    churn metrics between the channel's queue and in-progress list, or hammer
+    the backing store while it recovers.
+
+    The breaker starts closed. After ``failure_threshold`` publishes in a row
+    fail, it opens, and the receiver and nanny stop taking metrics from the
+    channel. After ``backoff_seconds`` one of them is allowed to probe the
+    backing store by publishing a single small batch (of at most
+    ``probe_size`` metrics). If the probe succeeds the breaker closes again and
+    the agent resumes at full throughput; if it fails the breaker opens again
+    and the backoff doubles, up to ``max_backoff_seconds``.
+
+    :type logger: ~logging.Logger
+    :param logger: The logger to use.
+
+    :type failure_threshold: integer
+    :param failure_threshold: The number of failed publishes in a row after
+                              which the breaker opens.
+
+    :type backoff_seconds: float
+    :param backoff_seconds: How long to wait before the first probe.
+
+    :type max_backoff_seconds: float
+    :param max_backoff_seconds: The longest to wait between probes.
+
+    :type probe_size: integer
+    :param probe_size: The maximum number of metrics to publish in a probe.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, logger, failure_threshold, backoff_seconds,
+            max_backoff_seconds, probe_size):
+        self.logger = logger
+        self.failure_threshold = failure_threshold
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.probe_size = probe_size
+
+        self.lock = threading.Lock()
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.backoff = backoff_seconds
+        self.next_probe = 0
+        self.probe = None
+
+    @property
+    def probing(self):
+        """Whether a probe is in progress."""
+        return self.state == CircuitBreaker.HALF_OPEN
+
+    def is_open(self):
+        """Return whether the breaker is open (or probing).
+
+        :rtype: bool
+        :returns: True if metrics should not be published at full throughput.
+        """
+        return self.state != CircuitBreaker.CLOSED
+
+    def allow(self):
+        """Return whether the caller may take metrics from the channel and
+        publish them. While the breaker is open, the first caller after the
+        backoff gets to probe, and no one else is allowed until the probe is
+        finished.
+
+        A caller which is allowed gets a permit, which it passes back when it
+        records the outcome. A caller which gets a probe permit (see
+        :meth:`~kadabra.agent.CircuitBreaker.is_probe`) must finish the probe
+        by recording a success or failure, or by abandoning it, however it
+        ends; otherwise no one is allowed to publish again.
+
+        :rtype: object
+        :returns: A permit (which is true) if the caller may publish, or None.
+        """
+        with self.lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+            if self.state == CircuitBreaker.OPEN and\
+                    time.time() >= self.next_probe:
+                self.logger.info("Circuit breaker probing the publisher")
+                self.state = CircuitBreaker.HALF_OPEN
+                self.probe = object()
+                return self.probe
+            return None
+
+    def is_probe(self, permit):
+        """Return whether a permit from
+        :meth:`~kadabra.agent.CircuitBreaker.allow` is for the probe in
+        progress.
+
+        :type permit: object
+        :param permit: The permit.
+
+        :rtype: bool
+        :returns: True if the caller holding the permit is probing.
+        """
+        return permit is not None and permit is self.probe
+
+    def wait(self, max_seconds=1.0):
+        """Sleep until the next probe is due, or for at most ``max_seconds``.
+
+        :type max_seconds: float
+        :param max_seconds: The longest to sleep for.
+        """
+        delay = self.next_probe - time.time()
+        if self.state != CircuitBreaker.OPEN:
+            delay = max_seconds
+        time.sleep(min(max(delay, 0.01), max_seconds))
+
+    def record_success(self, permit=None):
+        """Record a successful publish, closing the breaker. Any caller's
+        success closes it, since it shows the backing store is answering.
+
+        :type permit: object
+        :param permit: The caller's permit.
+        """
+        with self.lock:
+            if self.state != CircuitBreaker.CLOSED:
+                self.logger.info("Circuit breaker closed, resuming publishing")
+            self.state = CircuitBreaker.CLOSED
+            self.failures = 0
+            self.backoff = self.backoff_seconds
+            self.probe = None
+
+    def record_failure(self, permit=None):
+        """Record a failed publish, opening the breaker if it has failed too
+        many times in a row or if it was the probe that failed. Failures of
+        publishes which started before the breaker opened don't affect a
+        probe in progress.
+
+        :type permit: object
+        :param permit: The caller's permit.
+        """
+        with self.lock:
+            if self.state == CircuitBreaker.HALF_OPEN:
+                if permit is self.probe:
+                    self.backoff = min(self.backoff * 2,
+                            self.max_backoff_seconds)
+                    self._open()
+            elif self.state == CircuitBreaker.CLOSED:
+                self.failures = self.failures + 1
+                if self.failures >= self.failure_threshold:
+                    self._open()
+
+    def abandon_probe(self, permit):
+        """Give up a probe which found no metrics to publish, or which failed
+        before publishing, so that the next caller can probe straight away.
+        This does nothing unless the permit is for the probe in progress, so
+        callers can safely call it once they're done with any permit.
+
+        :type permit: object
+        :param permit: The caller's permit.
+        """
+        with self.lock:
+            if self.state == CircuitBreaker.HALF_OPEN and\
+                    permit is self.probe:
+                self.state = CircuitBreaker.OPEN
+                self.next_probe = 0
+                self.probe = None
+
+    def _open(self):
+        """Open the breaker until the next probe is due. The lock must be
+        held."""
+        self.logger.warn("Circuit breaker opened after publishing failed, "
+                "probing again in %s seconds" % self.backoff)
+        self.state = CircuitBreaker.OPEN
+        self.next_probe = time.time() + self.backoff
+        self.probe = None
+
+class RetryBackoff(object):
+    """Keeps count of how many times the nanny has failed to republish each
+    metrics object, so that it backs off exponentially from metrics which keep
+    failing instead of retrying everything on every run. After ``n`` failures,
+    metrics aren't retried for ``base_seconds * 2 ** (n - 1)`` seconds (up to
+    ``max_seconds``), with random jitter of up to half that delay so that
+    retries after an outage are spread out.
+
+    Metrics are identified by a hash of their serialized form. Only the most
+    recently failed ``max_entries`` are remembered.
+
+    :type base_seconds: float
+    :param base_seconds: The delay after the first failure.
+
+    :type max_seconds: float
+    :param max_seconds: The longest delay.
+
+    :type max_entries: integer
+    :param max_entries: The maximum number of metrics to remember.
+
+    :type max_attempts: integer
+    :param max_attempts: If set, the number of failures after which metrics
+                         are given up on (see
+                         :meth:`~kadabra.agent.RetryBackoff.exhausted`).
+    """
+    def __init__(self, base_seconds, max_seconds, max_entries=100000,
+            max_attempts=None):
+        self.base_seconds = base_seconds
+        self.max_seconds = max_seconds
+        self.max_entries = max_entries
+        self.max_attempts = max_attempts
+
+        self.lock = threading.Lock()
+        self.attempts = collections.OrderedDict()
+
+    def ready(self, metrics):
+        """Return whether metrics are due to be retried.
+
+        :type metrics: ~kadabra.Metrics
+        :param metrics: The metrics to check.
+
+        :rtype: bool
+        :returns: True if the metrics haven't failed, or their backoff has
+                  passed.
+        """
+        key = _metrics_key(metrics)
+        with self.lock:
+            entry = self.attempts.get(key)
+        return entry is None or time.time() >= entry[1]
+
+    def record_failure(self, metrics):
+        """Record that metrics failed to republish.
+
+        :type metrics: list
+        :param metrics: The list of :class:`~kadabra.Metrics` which failed.
+
+        :rtype: list
+        :returns: The number of seconds until each of the metrics should be
+                  retried.
+        """
+        now = time.time()
+        keys = [_metrics_key(m) for m in metrics]
+        delays = []
+        with self.lock:
+            for key in keys:
+                count = self.attempts.pop(key, (0, 0))[0] + 1
+                delay = min(self.base_seconds * 2 ** (count - 1),
+                        self.max_seconds)
+                delay = delay / 2 + random.uniform(0, delay / 2)
+                self.attempts[key] = (count, now + delay)
+                delays.append(delay)
+            while len(self.attempts) > self.max_entries:
+                self.attempts.popitem(last=False)
+        return delays
+
+    def record_success(self, metrics):
+        """Forget metrics which have been republished.
+
+        :type metrics: list
+        :param metrics: The list of :class:`~kadabra.Metrics` which were
+                        republished.
+        """
+        keys = [_metrics_key(m) for m in metrics]
+        with self.lock:
+            for key in keys:
+                self.attempts.pop(key, None)
+
+    def exhausted(self, metrics):
+        """Return the metrics which have failed at least ``max_attempts``
+        times.
+
+        :type metrics: list
+        :param metrics: The list of :class:`~kadabra.Metrics` to check.
+
+        :rtype: list
+        :returns: The metrics to give up on, which is always empty if
+                  ``max_attempts`` isn't set.
+        """
+        if self.max_attempts is None:
+            return []
+        with self.lock:
+            return [m for m in metrics if self.attempts.get(_metrics_key(m),
+                (0, 0))[0] >= self.max_attempts]
+
+class DedupFilter(object):
+    """Remembers the IDs of recently published metrics, so that metrics which
+    are delivered more than once (for example, republished by the nanny after
+    the receiver already published them) aren't published again.
+
+    IDs are kept in two Bloom filters: new IDs are added to the current one,
+    and both are checked. The filters rotate every ``window_seconds`` (or
+    sooner, once the current one holds ``capacity`` IDs), dropping the older
+    one, so IDs are remembered for between one and two windows in a bounded
+    amount of memory. A small fraction (``error_rate``) of metrics which were
+    never published may be mistaken for duplicates.
+
+    :type window_seconds: float
+    :param window_seconds: How long each filter collects IDs before rotating.
+
+    :type capacity: integer
+    :param capacity: The number of IDs each filter is sized for.
+
+    :type error_rate: float
+    :param error_rate: The false positive rate of a full filter.
+    """
+    def __init__(self, window_seconds, capacity, error_rate):
+        self.window_seconds = window_seconds
+        self.capacity = capacity
+
+        self.num_bits = int(math.ceil(-capacity * math.log(error_rate) /
+            math.log(2) ** 2))
+        self.num_hashes = max(1,
+                int(round(self.num_bits / float(capacity) * math.log(2))))
+
+        self.lock = threading.Lock()
+        self.current = bytearray((self.num_bits + 7) // 8)
+        self.previous = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+        self.rotated_at = time.time()
+
+        self.checked = 0
+        self.duplicates = 0
+
+    def contains(self, metrics_id):
+        """Return whether an ID has been added recently, and count the check
+        towards the duplicate rate.
+
+        :type metrics_id: string
+        :param metrics_id: The ID to check.
+
+        :rtype: bool
+        :returns: True if the ID (probably) has been added, False if it
+                  definitely hasn't.
+        """
+        positions = self._positions(metrics_id)
+        with self.lock:
+            self._rotate_if_due()
+            found = self._test(self.current, positions) or\
+                    self._test(self.previous, positions)
+            self.checked += 1
+            if found:
+                self.duplicates += 1
+            return found
+
+    def add(self, metrics_id):
+        """Remember an ID.
+
+        :type metrics_id: string
+        :param metrics_id: The ID to remember.
+        """
+        positions = self._positions(metrics_id)
+        with self.lock:
+            self._rotate_if_due()
+            for position in positions:
+                self.current[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def stats(self):
+        """Return how many IDs have been checked, and how many of them were
+        duplicates.
+
+        :rtype: dict
+        :returns: The ``checked`` and ``duplicates`` counts, and the
+                  ``duplicate_rate`` (0 if nothing has been checked).
+        """
+        with self.lock:
+            return {
+                "checked": self.checked,
+                "duplicates": self.duplicates,
+                "duplicate_rate": float(self.duplicates) / self.checked\
+                        if self.checked else 0.0
+            }
+
+    def _positions(self, metrics_id):
+        """Return the bits for an ID, using double hashing over a single MD5
+        digest."""
+        digest = hashlib.md5(metrics_id.encode("utf-8")).digest()
+        first, second = struct.unpack("<QQ", digest)
+        return [(first + i * second) % self.num_bits
+                for i in range(self.num_hashes)]
+
+    def _test(self, bits, positions):
+        for position in positions:
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def _rotate_if_due(self):
+        now = time.time()
+        if now - self.rotated_at < self.window_seconds and\
+                self.count < self.capacity:
+            return
+        self.previous = self.current
+        self.current = bytearray(len(self.previous))
+        self.count = 0
+        self.rotated_at = now
+
+class DedupPublisher(object):
+    """Wraps a publisher so that metrics whose IDs are in a
+    :class:`~kadabra.agent.DedupFilter` are dropped before they reach it.
+    IDs are only added to the filter once they have been published
+    successfully, so metrics which fail to publish can still be retried.
+    Metrics without an ID are always published.
+
+    :type publisher: :ref:`api-publishers`
+    :param publisher: The publisher to wrap.
+
+    :type dedup_filter: ~kadabra.agent.DedupFilter
+    :param dedup_filter: The filter of recently published IDs.
+
+    :type logger: logging.Logger
+    :param logger: The logger to use.
+    """
+    def __init__(self, publisher, dedup_filter, logger):
+        self.publisher = publisher
+        self.dedup_filter = dedup_filter
+        self.logger = logger
+
+    def publish(self, metrics):
+        """Publish the metrics which haven't been published recently.
+
+        :type metrics: list
+        :param metrics: The list of :class:`~kadabra.Metrics` to publish.
+
+        :rtype: list
+        :returns: The list of metrics which the publisher rejected.
+        """
+        fresh = [m for m in metrics
+                if m.id is None or not self.dedup_filter.contains(m.id)]
+        if len(fresh) < len(metrics):
+            self.logger.debug("Dropped %d duplicate metrics" %\
+                    (len(metrics) - len(fresh)))
+        if len(fresh) == 0:
+            return []
+        failed = self.publisher.publish(fresh) or []
+        rejected = set(id(m) for m in failed)
+        for m in fresh:
+            if m.id is not None and id(m) not in rejected:
+                self.dedup_filter.add(m.id)
+        return failed
+
+    def stats(self):
+        """Return the duplicate statistics of the filter (see
+        :meth:`~kadabra.agent.DedupFilter.stats`).
+
+        :rtype: dict
+        :returns: The filter's statistics.
+        """
+        return self.dedup_filter.stats()
+
+def _metrics_key(metrics):
+    """Helper to identify metrics across nanny runs, since the channel returns
+    new instances every time.
+
+    :type metrics: ~kadabra.Metrics
+    :param metrics: The metrics to identify.
+
+    :rtype: string
+    :returns: The ID of the metrics, or a hash of the serialized metrics if
+              they don't have one.
+    """
+    if metrics.id is not None:
+        return metrics.id
+    return hashlib.sha1(json.dumps(metrics.serialize(),
+        sort_keys=True).encode("utf-8")).hexdigest()
+
+def _freshest_first(metrics):
+    """Helper to sort metrics so the most recently serialized come first, so
+    that after an outage the freshest data is republished first. Metrics
+    without a serialized_at timestamp come last.
+
+    :type metrics: list
+    :param metrics: The list of :class:`~kadabra.Metrics` to sort.
+
+    :rtype: list
+    :returns: The sorted list.
+    """
+    def sort_key(m):
+        if m.serialized_at is None:
+            return datetime.datetime.min
+        return get_datetime_from_timestamp_string(m.serialized_at,
+                m.timestamp_format)
+    try:
+        return sorted(metrics, key=sort_key, reverse=True)
+    except (ValueError, TypeError):
+        return list(metrics)
+
+def _publish(publisher, metrics, circuit_breaker, permit=None):
+    """Helper to publish metrics and record the outcome with the circuit
+    breaker, if there is one.
+
+    :type publisher: :ref:`api-publishers`
+    :param publisher: The publisher to use.
+
+    :type metrics: list
+    :param metrics: The list of :class:`~kadabra.Metrics` to publish.
+
+    :type circuit_breaker: ~kadabra.agent.CircuitBreaker
+    :param circuit_breaker: The circuit breaker, or None.
+
+    :type permit: object
+    :param permit: The caller's permit from the circuit breaker.
+
+    :rtype: list
+    :returns: The list of metrics which the publisher reported as failed. The
+              backing store still answered, so these count as a success for
+              the circuit breaker.
+    """
+    if circuit_breaker is None:
+        return publisher.publish(metrics) or []
+    try:
+        failed = publisher.publish(metrics) or []
+    except:
+        circuit_breaker.record_failure(permit)
+        raise
+    circuit_breaker.record_success(permit)
+    return failed
+
+def _publish_bisecting(publisher, metrics, circuit_breaker, logger,
+        permit=None):
+    """Helper to publish a batch of metrics, isolating the metrics which can't
+    be published. If the publisher reports which metrics failed, only those
+    are failed. If the batch fails outright, each half is published
+    separately, and a half which fails outright while the other doesn't is
+    split in turn, down to single metrics, so that one bad metrics object
+    doesn't stop the rest of the batch from being published. If both halves
+    fail outright the backing store is probably down rather than the metrics
+    at fault, so the whole batch is failed without splitting further. Splitting
+    also stops once the circuit breaker opens.
+
+    :type publisher: :ref:`api-publishers`
+    :param publisher: The publisher to use.
+
+    :type metrics: list
+    :param metrics: The list of :class:`~kadabra.Metrics` to publish.
+
+    :type circuit_breaker: ~kadabra.agent.CircuitBreaker
+    :param circuit_breaker: The circuit breaker, or None.
+
+    :type logger: ~logging.Logger
+    :param logger: The logger to use.
+
+    :type permit: object
+    :param permit: The caller's permit from the circuit breaker.
+
+    :rtype: tuple
+    :returns: The list of metrics which were published, and the list of
+              metrics which failed.
+    """
+    try:
+        return _publish_rejecting(publisher, metrics, circuit_breaker,
+                logger, permit)
+    except:
+        logger.warn("Failed to publish %s metrics" % len(metrics),
+                exc_info=1)
+    return _bisect(publisher, metrics, circuit_breaker, logger, permit)
+
+def _publish_rejecting(publisher, metrics, circuit_breaker, logger,
+        permit=None):
+    """Helper to publish metrics, separating the metrics which the publisher
+    reported as failed. Raises if the publish fails outright.
+
+    :rtype: tuple
+    :returns: The list of metrics which were published, and the list of
+              metrics which failed.
+    """
+    failed = _publish(publisher, metrics, circuit_breaker, permit)
+    if len(failed) == 0:
+        return metrics, []
+    logger.warn("Publisher rejected %s of %s metrics" %\
+            (len(failed), len(metrics)))
+    rejected = set(id(m) for m in failed)
+    return [m for m in metrics if id(m) not in rejected], failed
+
+def _bisect(publisher, metrics, circuit_breaker, logger, permit=None):
+    """Helper to split metrics which just failed to publish outright (see
+    :func:`_publish_bisecting`), publishing each half and splitting further
+    only the half which fails outright while the other doesn't.
+
+    :rtype: tuple
+    :returns: The list of metrics which were published, and the list of
+              metrics which failed.
+    """
+    if len(metrics) <= 1 or (circuit_breaker is not None and
+            circuit_breaker.is_open()):
+        return [], metrics
+    middle = len(metrics) // 2
+    halves = [metrics[:middle], metrics[middle:]]
+    results = []
+    for half in halves:
+        if circuit_breaker is not None and circuit_breaker.is_open():
+            results.append(([], half))
+            continue
+        try:
+            results.append(_publish_rejecting(publisher, half,
+                circuit_breaker, logger, permit))
+        except:
+            results.append(None)
+    if all(result is None for result in results):
+        logger.warn("Both halves of %s metrics failed to publish, not "
+                "splitting further" % len(metrics))
+        return [], metrics
+    published, failed = [], []
+    for half, result in zip(halves, results):
+        if result is None:
+            result = _bisect(publisher, half, circuit_breaker, logger, permit)
+        published.extend(result[0])
+        failed.extend(result[1])
+    return published, failed
+
+def _dead_letter(channel, backoff, failed, circuit_breaker, logger):
+    """Helper to move metrics which have failed too many times to the
+    channel's dead letter list, if it has one. Nothing is given up on while
+    the circuit breaker is open, since then the metrics probably aren't at
+    fault.
+
+    :type channel: :ref:`api-channels`
+    :param channel: The channel the metrics were received from.
+
+    :type backoff: ~kadabra.agent.RetryBackoff
+    :param backoff: The backoff which counts failures, or None.
+
+    :type failed: list
+    :param failed: The list of :class:`~kadabra.Metrics` which just failed.
+
+    :type circuit_breaker: ~kadabra.agent.CircuitBreaker
+    :param circuit_breaker: The circuit breaker, or None.
+
+    :type logger: ~logging.Logger
+    :param logger: The logger to use.
+
+    :rtype: list
+    :returns: The metrics which were moved to the dead letter list.
+    """
+    if backoff is None or not hasattr(channel, "dead_letter"):
+        return []
+    if circuit_breaker is not None and circuit_breaker.is_open():
+        return []
+    exhausted = backoff.exhausted(failed)
+    if len(exhausted) == 0:
+        return []
+    logger.error("Giving up on %s metrics after %s attempts: %s" %\
+            (len(exhausted), backoff.max_attempts,
+                [m.serialize() for m in exhausted]))
+    channel.dead_letter(exhausted)
+    backoff.record_success(exhausted)
+    return exhausted
+
+def _retry_later(channel, backoff, failed, circuit_breaker, logger,
+        retry_queue):
+    """Helper to count failed publishes, moving metrics which have failed too
+    many times to the dead letter list (see :func:`_dead_letter`). If the
+    agent uses the channel's retry queue, the rest are moved there to be
+    retried once their backoff has passed; otherwise they are left in
+    progress for the nanny.
+
+    :type channel: :ref:`api-channels`
+    :param channel: The channel the metrics were received from.
+
+    :type backoff: ~kadabra.agent.RetryBackoff
+    :param backoff: The backoff which counts failures, or None.
+
+    :type failed: list
+    :param failed: The list of :class:`~kadabra.Metrics` which just failed.
+
+    :type circuit_breaker: ~kadabra.agent.CircuitBreaker
+    :param circuit_breaker: The circuit breaker, or None.
+
+    :type logger: ~logging.Logger
+    :param logger: The logger to use.
+
+    :type retry_queue: bool
+    :param retry_queue: Whether to move the metrics to the retry queue.
+    """
+    if backoff is None or len(failed) == 0:
+        return
+    delays = backoff.record_failure(failed)
+    dead = set(id(m) for m in _dead_letter(channel, backoff, failed,
+        circuit_breaker, logger))
+    if not retry_queue:
+        return
+    retries = [(m, delay) for m, delay in zip(failed, delays)
+            if id(m) not in dead]
+    if len(retries) > 0:
+        channel.retry([m for m, delay in retries],
+                [delay for m, delay in retries])
+
+def _release(lease, logger):
+    """Helper to release the nanny's lease when it stops, if it has one, so
+    that another agent can take over without waiting for it to expire.
+
+    :type lease: ~kadabra.channels.RedisLease
+    :param lease: The lease, or None.
+
+    :type logger: ~logging.Logger
+    :param logger: The logger to use.
+    """
+    if lease is None:
+        return
+    try:
+        lease.release()
+    except:
+        logger.warn("Failed to release the nanny lease", exc_info=1)
+
 def _should_republish(metrics, threshold_seconds, logger):
     """Helper to determine if metrics should be republished by the nanny.
 
@@ -577,7 +2401,10 @@ def _should_republish(metrics, threshold_seconds, logger):
     :type threshold_seconds: int
     :param threshold_seconds: The number of seconds from when the metrics were
                               serliazed to now for them to be attempted to be
-                              republished.
+                              republished. If the channel measured how long
+                              the metrics have been in progress by its own
+                              clock, that is used instead, so that clients
+                              with skewed clocks don't affect the decision.
 
     :type logger: ~logging.Logger
     :param logger: The logger to use.
@@ -585,6 +2412,10 @@ def _should_republish(metrics, threshold_seconds, logger):
     :rtype: bool
     :returns: True if the metrics should be republished, False otherwise.
     """
+    if metrics.in_progress_seconds is not None:
+        logger.debug("in progress for %s seconds" %\
+                metrics.in_progress_seconds)
+        return metrics.in_progress_seconds > threshold_seconds
     if metrics.serialized_at is not None:
         now = get_now()
         serialized_at = get_datetime_from_timestamp_string(
@@ -1,6 +1,39 @@
 from .metrics import Metrics
+from .utils import get_age_seconds
 
-import logging, json
+import logging, json, zlib, itertools, threading, weakref, os, collections,\
+       struct, mmap, time, tempfile, socket, hashlib
+
+#: Marker byte prepended to payloads which have been compressed with zlib.
+#: Uncompressed payloads are JSON objects and always start with ``{``, so
+#: compressed and uncompressed payloads can safely live side by side in the
+#: same queue.
+COMPRESSED_MARKER = b"\x01"
+
+#: A preset zlib dictionary made up of the strings that appear in almost
+#: every serialized :class:`~kadabra.Metrics`. Using it lets zlib compress even
+#: moderately sized payloads well, since the JSON keys, units and timestamp
+#: format don't have to be spelled out in each payload. The most common
+#: strings are at the end, as zlib favors closer matches.
+DEFAULT_COMPRESSION_DICTIONARY = (
+        '"seconds_offset": 1.0}, "metadata": {}, '
+        '{"name": "seconds", "seconds_offset": 1.0}, '
+        '"unit": {"name": "milliseconds", "seconds_offset": 1000.0}, '
+        '"metadata": {}, "timestamp": "20, "value": 1.0}, '
+        '"timers": [{"name": "", "unit": {"name": "milliseconds", '
+        '"counters": [{"name": "", "metadata": {}, "timestamp": "20'
+        '"}], "timestamp_format": "%Y-%m-%dT%H:%M:%S.%fZ", '
+        '"serialized_at": "20{"dimensions": [{"name": "", "value": "'
+        ).encode("utf-8")
+
+#: Marker prepended to payloads whose strings have been replaced by IDs from a
+#: :class:`~kadabra.channels.StringDictionary`.
+DICTIONARY_MARKER = "\x02"
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
 
 class RedisChannel(object):
     """A channel for transporting metrics using Redis.
@@ -18,6 +51,117 @@ class RedisChannel(object):
 
     :type logger: string
     :param logger: The name of the logger to use.
+
+    :type queue_key: string
+    :param queue_key: The key of the Redis list used as the queue of pending
+                      metrics.
+
+    :type inprogress_key: string
+    :param inprogress_key: The key of the Redis list used to hold metrics that
+                           are in the process of being published.
+
+    :type compression_threshold: int
+    :param compression_threshold: If specified, serialized metrics whose size
+                                  in bytes is at least this value will be
+                                  compressed with zlib before being sent.
+                                  Smaller payloads are sent as-is, since
+                                  compressing them costs more CPU than it
+                                  saves. If ``None``, compression is
+                                  disabled. Compressed payloads can always be
+                                  received, regardless of this setting.
+
+    :type compression_level: int
+    :param compression_level: The zlib compression level, from 1 (fastest)
+                              to 9 (smallest).
+
+    :type compression_dictionary: bytes
+    :param compression_dictionary: An optional preset dictionary for zlib,
+                                   such as
+                                   :data:`~kadabra.channels.DEFAULT_COMPRESSION_DICTIONARY`.
+                                   Must be the same for the client and agent.
+                                   Requires Python 3.3 or later.
+
+    :type dictionary_encoding: bool
+    :param dictionary_encoding: Whether to replace metric names, dimension
+                                names and dimension values with small integer
+                                IDs from a dictionary shared through Redis
+                                when sending metrics. Dictionary-encoded
+                                metrics can always be received, regardless of
+                                this setting.
+
+    :type dictionary_key: string
+    :param dictionary_key: The key prefix of the shared string dictionary.
+
+    :type dictionary_max_size: int
+    :param dictionary_max_size: The maximum number of strings in the shared
+                                dictionary. Once it is full, new strings are
+                                sent as literals.
+
+    :type client: ~redis.StrictRedis
+    :param client: An existing Redis client to use instead of connecting to
+                   the given host, port and database. This is used by
+                   channels which share one client between several key pairs,
+                   such as the :class:`~kadabra.channels.RedisClusterChannel`.
+
+    :type unix_socket_path: string
+    :param unix_socket_path: If specified, connect to Redis over the Unix
+                             domain socket at this path instead of over TCP
+                             to the host and port. This avoids the TCP stack
+                             when Redis runs on the same host.
+
+    :type max_connections: int
+    :param max_connections: If specified, the connection pool will hold at
+                            most this many connections. When they are all in
+                            use, callers wait up to ``pool_timeout`` seconds
+                            for one to be released instead of opening more.
+
+    :type pool_timeout: int
+    :param pool_timeout: The number of seconds to wait for a free connection
+                         when the pool is at ``max_connections``.
+
+    :type socket_timeout: float
+    :param socket_timeout: The timeout in seconds for reads and writes on the
+                           connection. This must be longer than the 10
+                           seconds that the agent waits for metrics when
+                           receiving.
+
+    :type socket_connect_timeout: float
+    :param socket_connect_timeout: The timeout in seconds for establishing a
+                                   connection.
+
+    :type socket_keepalive: bool
+    :param socket_keepalive: Whether to enable TCP keepalive on connections.
+
+    :type health_check_interval: int
+    :param health_check_interval: If greater than 0, connections which have
+                                  been idle for this many seconds are checked
+                                  with a ``PING`` before they are used.
+
+    :type agent_inprogress_keys: bool
+    :param agent_inprogress_keys: Whether each agent keeps the metrics it is
+                                  publishing in its own in-progress list
+                                  (the ``inprogress_key`` followed by ``:`` and
+                                  the agent's ID), rather than all agents
+                                  sharing one. Agents register in a sorted set
+                                  (the ``queue_key`` followed by ``:agents``)
+                                  and send heartbeats, and the lists of agents
+                                  which stop sending heartbeats are moved back
+                                  onto the queue. Heartbeats are recorded by
+                                  the Redis server's clock, so this requires
+                                  Redis 5 or later.
+
+    :type heartbeat_timeout: int
+    :param heartbeat_timeout: The number of seconds without a heartbeat after
+                              which an agent is considered dead.
+
+    :type server_timestamps: bool
+    :param server_timestamps: Whether to record when metrics are received
+                              using the Redis server's clock, in a hash (the
+                              ``inprogress_key`` followed by ``:received``)
+                              keyed by the SHA1 of each payload, so that the
+                              nanny can tell how long metrics have really been
+                              in progress even if the clients' clocks are
+                              skewed. Requires Redis 5 or later.
     """
 
     #: Default arguments for the Redis channel. These will be used by the
@@ -29,15 +173,214 @@ class RedisChannel(object):
             "db": 0,
             "logger": "kadabra.channel",
             "queue_key": "kadabra_queue",
-            "inprogress_key": "kadabra_inprogress"
+            "inprogress_key": "kadabra_inprogress",
+            "compression_threshold": None,
+            "compression_level": 6,
+            "compression_dictionary": None,
+            "dictionary_encoding": False,
+            "dictionary_key": "kadabra_dictionary",
+            "dictionary_max_size": 65536,
+            "unix_socket_path": None,
+            "max_connections": None,
+            "pool_timeout": 20,
+            "socket_timeout": None,
+            "socket_connect_timeout": None,
+            "socket_keepalive": False,
+            "health_check_interval": 0,
+            "agent_inprogress_keys": False,
+            "heartbeat_timeout": 60,
+            "server_timestamps": False
     }
 
-    def __init__(self, host, port, db, logger, queue_key, inprogress_key):
-        from redis import StrictRedis
-        self.client = StrictRedis(host=host, port=port, db=db)
+    #: Moves up to ARGV[1] metrics from the queue to the in-progress list,
+    #: recording the Redis server's time in milliseconds against the SHA1 of
+    #: each payload. Returns the payloads moved.
+    RECEIVE_SCRIPT = """
+        local time = redis.call('TIME')
+        local now = time[1] * 1000 + math.floor(time[2] / 1000)
+        local received = {}
+        for i = 1, tonumber(ARGV[1]) do
+            local raw = redis.call('RPOPLPUSH', KEYS[1], KEYS[2])
+            if not raw then
+                break
+            end
+            redis.call('HSET', KEYS[3], redis.sha1hex(raw), now)
+            received[i] = raw
+        end
+        return received
+    """
+
+    #: Moves up to ARGV[1] of the most recently sent metrics from the head of
+    #: the queue to the in-progress list. If ARGV[2] is 1, the Redis server's
+    #: time in milliseconds is recorded against the SHA1 of each payload.
+    #: Returns the payloads moved.
+    RECEIVE_NEWEST_SCRIPT = """
+        local received = {}
+        local now = nil
+        if ARGV[2] == '1' then
+            local time = redis.call('TIME')
+            now = time[1] * 1000 + math.floor(time[2] / 1000)
+        end
+        for i = 1, tonumber(ARGV[1]) do
+            local raw = redis.call('LPOP', KEYS[1])
+            if not raw then
+                break
+            end
+            redis.call('LPUSH', KEYS[2], raw)
+            if now then
+                redis.call('HSET', KEYS[3], redis.sha1hex(raw), now)
+            end
+            received[i] = raw
+        end
+        return received
+    """
+
+    #: Records the Redis server's time in milliseconds against the SHA1 given
+    #: in ARGV[1].
+    STAMP_SCRIPT = """
+        local time = redis.call('TIME')
+        redis.call('HSET', KEYS[1], ARGV[1],
+            time[1] * 1000 + math.floor(time[2] / 1000))
+    """
+
+    #: Returns the Redis server's time in milliseconds, up to ARGV[1]
+    #: payloads from the in-progress list, and the time each was received
+    #: (or -1 if it wasn't recorded).
+    IN_PROGRESS_SCRIPT = """
+        local time = redis.call('TIME')
+        local now = time[1] * 1000 + math.floor(time[2] / 1000)
+        local raws = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+        local stamps = {}
+        for i, raw in ipairs(raws) do
+            stamps[i] = tonumber(redis.call('HGET', KEYS[2],
+                redis.sha1hex(raw))) or -1
+        end
+        return {now, raws, stamps}
+    """
+
+    #: Moves each payload in ARGV from the in-progress list to the dead letter
+    #: list, if it is still in progress, and forgets when it was received.
+    #: Returns the number of payloads moved.
+    DEAD_LETTER_SCRIPT = """
+        local moved = 0
+        for _, raw in ipairs(ARGV) do
+            if redis.call('LREM', KEYS[1], 1, raw) > 0 then
+                redis.call('LPUSH', KEYS[2], raw)
+                redis.call('HDEL', KEYS[3], redis.sha1hex(raw))
+                moved = moved + 1
+            end
+        end
+        return moved
+    """
+
+    #: Moves payloads from the in-progress list to the retry sorted set, if
+    #: they are still in progress, scored by the time in milliseconds at
+    #: which they are due to be retried. ARGV[1] is the agent's time in
+    #: milliseconds, followed by pairs of the delay in milliseconds and the
+    #: payload. Returns the number of payloads moved.
+    RETRY_SCRIPT = """
+        local now = tonumber(ARGV[1])
+        local moved = 0
+        for i = 2, #ARGV, 2 do
+            local raw = ARGV[i + 1]
+            if redis.call('LREM', KEYS[1], 1, raw) > 0 then
+                redis.call('ZADD', KEYS[2], now + tonumber(ARGV[i]), raw)
+                redis.call('HDEL', KEYS[3], redis.sha1hex(raw))
+                moved = moved + 1
+            end
+        end
+        return moved
+    """
+
+    #: Moves up to ARGV[2] payloads which are due by ARGV[1], the agent's time
+    #: in milliseconds, from the retry sorted set to the end of the queue that
+    #: is received from next. Returns the number of payloads moved.
+    REQUEUE_DUE_SCRIPT = """
+        local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1],
+            'LIMIT', 0, tonumber(ARGV[2]))
+        for _, raw in ipairs(due) do
+            redis.call('RPUSH', KEYS[2], raw)
+            redis.call('ZREM', KEYS[1], raw)
+        end
+        return #due
+    """
+
+    #: Records a heartbeat for an agent, using the Redis server's clock so
+    #: that agents with skewed clocks agree on who is alive. Like the other
+    #: scripts which write after calling ``TIME``, this relies on the effect
+    #: replication of Redis 5 or later.
+    HEARTBEAT_SCRIPT = """
+        local now = redis.call('TIME')[1]
+        redis.call('ZADD', KEYS[1], now, ARGV[1])
+        return now
+    """
+
+    #: Moves up to ARGV[2] metrics back onto the queue from the in-progress
+    #: lists of the agents in ARGV[3..], whose lists are KEYS[3..], if they
+    #: still haven't sent a heartbeat since ARGV[1], and unregisters those
+    #: agents once their lists are empty. Returns the number of metrics moved.
+    RECLAIM_SCRIPT = """
+        local cutoff = tonumber(ARGV[1])
+        local limit = tonumber(ARGV[2])
+        local moved = 0
+        for i = 3, #ARGV do
+            local agent = ARGV[i]
+            local key = KEYS[i]
+            local heartbeat = redis.call('ZSCORE', KEYS[1], agent)
+            if heartbeat and tonumber(heartbeat) <= cutoff then
+                while moved < limit and
+                        redis.call('RPOPLPUSH', key, KEYS[2]) do
+                    moved = moved + 1
+                end
+                if redis.call('LLEN', key) == 0 then
+                    redis.call('ZREM', KEYS[1], agent)
+                end
+            end
+        end
+        return moved
+    """
+
+    def __init__(self, host, port, db, logger, queue_key, inprogress_key,
+            compression_threshold=None, compression_level=6,
+            compression_dictionary=None, dictionary_encoding=False,
+            dictionary_key="kadabra_dictionary", dictionary_max_size=65536,
+            client=None, unix_socket_path=None, max_connections=None,
+            pool_timeout=20, socket_timeout=None, socket_connect_timeout=None,
+            socket_keepalive=False, health_check_interval=0,
+            agent_inprogress_keys=False, heartbeat_timeout=60,
+            server_timestamps=False):
+        if client is None:
+            from redis import StrictRedis
+            pool = get_connection_pool(host, port, db, unix_socket_path,
+                    max_connections, pool_timeout, socket_timeout,
+                    socket_connect_timeout, socket_keepalive,
+                    health_check_interval)
+            client = StrictRedis(connection_pool=pool)
+        self.client = client
         self.logger = logging.getLogger(logger)
         self.queue_key = queue_key
         self.inprogress_key = inprogress_key
+        self.compression_threshold = compression_threshold
+        self.compression_level = compression_level
+        self.compression_dictionary = compression_dictionary
+        self.dictionary_encoding = dictionary_encoding
+        self.dictionary = StringDictionary(self.client, dictionary_key,
+                dictionary_max_size)
+        self.agent_inprogress_keys = agent_inprogress_keys
+        self.heartbeat_timeout = heartbeat_timeout
+        self.agents_key = queue_key + ":agents"
+        self.shared_inprogress_key = inprogress_key
+        self.agent_id = None
+        self.heartbeat_script = None
+        self.reclaim_script = None
+        self.server_timestamps = server_timestamps
+        self.received_key = inprogress_key + ":received"
+        self.timestamp_scripts = None
+        self.dead_letter_key = queue_key + ":dead"
+        self.dead_letter_script = None
+        self.retry_key = queue_key + ":retry"
+        self.retry_scripts = None
+        self.receive_newest_script = None
 
     def send(self, metrics):
         """Send metrics to a Redis list, which will act as queue for pending
@@ -48,28 +391,34 @@ class RedisChannel(object):
         """
         to_push = metrics.serialize()
         self.logger.debug("Sending %s" % to_push)
-        self.client.lpush(self.queue_key, json.dumps(to_push))
+        self.client.lpush(self.queue_key, self._encode(to_push))
         self.logger.debug("Successfully sent %s" % to_push)
 
-    def receive(self):
+    def receive(self, timeout=10):
         """Receive metrics from the queue so they can be published. Once
         received, the metrics will be moved into a temporary "in progress"
         queue until they have been acknowledged as published (by calling
         :meth:`~kadabra.channels.RedisChannel.complete`). This method will
-        block until there are metrics available on the queue or after 10
-        seconds.
+        block until there are metrics available on the queue or after the
+        timeout.
+
+        :type timeout: int
+        :param timeout: The number of seconds to wait for metrics.
 
         :rtype: ~kadabra.Metrics
         :returns: The metrics to be published, or None if there were no metrics
                   received after the timeout.
         """
         self.logger.debug("Receiving metrics")
-        raw = self.client.brpoplpush(self.queue_key, self.inprogress_key,
-                timeout=10)
+        if self.server_timestamps:
+            raw = self._receive_stamped(timeout)
+        else:
+            raw = self.client.brpoplpush(self.queue_key, self.inprogress_key,
+                    timeout=timeout)
         if raw:
-            rv = json.loads(raw)
-            self.logger.debug("Got metrics: %s" % rv)
-            return Metrics.deserialize(rv)
+            rv = self._deserialize(raw)
+            self.logger.debug("Got metrics: %s" % raw)
+            return rv
         self.logger.debug("No metrics received")
         return None
 
@@ -91,11 +440,58 @@ class RedisChannel(object):
                   empty if there are no metrics in the queue.
         """
         self.logger.debug("Receiving batch of metrics")
+        if self.server_timestamps:
+            return [self._deserialize(m)
+                    for m in self._timestamp_scripts()[0](
+                        keys=[self.queue_key, self.inprogress_key,
+                            self.received_key], args=[max_batch_size])]
         pipeline = self.client.pipeline()
         for i in range(max_batch_size):
             pipeline.rpoplpush(self.queue_key, self.inprogress_key)
-        return [Metrics.deserialize(json.loads(m)) for m in pipeline.execute()
-                if m is not None]
+        return [self._deserialize(m)
+                for m in pipeline.execute() if m is not None]
+
+    def receive_newest(self, max_batch_size):
+        """Receive the most recently sent metrics from the head of the queue,
+        rather than the oldest from its tail, moving them into the "in
+        progress" queue just like
+        :meth:`~kadabra.channels.RedisChannel.receive_batch`. The agent uses
+        this to publish current metrics first while it recovers from a
+        backlog.
+
+        :type max_batch_size: int
+        :param max_batch_size: The maximum number of metrics to receive.
+
+        :rtype: list
+        :returns: The list of metrics to be published, newest first, and
+                  possibly empty if there are no metrics in the queue.
+        """
+        if self.receive_newest_script is None:
+            self.receive_newest_script = self.client.register_script(
+                    self.RECEIVE_NEWEST_SCRIPT)
+        return [self._deserialize(m)
+                for m in self.receive_newest_script(
+                    keys=[self.queue_key, self.inprogress_key,
+                        self.received_key],
+                    args=[max_batch_size, 1 if self.server_timestamps else 0])]
+
+    def backlog_stats(self):
+        """Return the length of the queue and the age, in seconds since they
+        were serialized, of the oldest and newest metrics in it.
+
+        :rtype: dict
+        :returns: The ``length`` of the queue, and its
+                  ``oldest_age_seconds`` and ``newest_age_seconds``, which
+                  are None if the queue is empty.
+        """
+        pipeline = self.client.pipeline()
+        pipeline.llen(self.queue_key)
+        pipeline.lindex(self.queue_key, -1)
+        pipeline.lindex(self.queue_key, 0)
+        length, oldest, newest = pipeline.execute()
+        return {"length": length,
+                "oldest_age_seconds": self._age_seconds(oldest),
+                "newest_age_seconds": self._age_seconds(newest)}
 
     def complete(self, metrics):
         """Mark a list of metrics as completed by removing them from the
@@ -108,12 +504,16 @@ class RedisChannel(object):
         if len(metrics) > 0:
             pipeline = self.client.pipeline()
             for m in metrics:
-                pipeline.lrem(self.inprogress_key, 1,
-                        json.dumps(m.serialize()))
+                for payload in self._payloads(m):
+                    pipeline.lrem(self.inprogress_key, 1, payload)
+                    if self.server_timestamps:
+                        pipeline.hdel(self.received_key, _sha1(payload))
             pipeline.execute()
 
     def in_progress(self, query_limit):
-        """Return a list of the metrics that are in_progress.
+        """Return a list of the metrics that are in_progress. If the agent has
+        its own in-progress list, only that list is returned, and the lists of
+        dead agents are moved back onto the queue first.
 
         :type query_limit: int
         :param query_limit: The maximum number of items to get from the in
@@ -122,9 +522,3128 @@ class RedisChannel(object):
         :rtype: list
         :returns: A list of :class:`Metric`\s that are in progress.
         """
+        if self.agent_id is not None:
+            reclaimed = self._reclaim(query_limit)
+            if reclaimed:
+                self.logger.info("Moved %s metrics of dead agents back onto "
+                        "the queue" % reclaimed)
+        if self.server_timestamps:
+            return self._in_progress_stamped(query_limit)
         in_progress = self.client.lrange(self.inprogress_key, 0,\
                 query_limit - 1)
         self.logger.debug("Found %s in progress metrics" % len(in_progress))
-        return [Metrics.deserialize(json.loads(m))\
-                for m in in_progress]
+        return [self._deserialize(m) for m in in_progress]
+
+    def reset(self):
+        """Reset the channel after the process has forked, so that the child
+        process opens its own connections instead of sharing the sockets it
+        inherited from its parent. This does nothing in the process which
+        created the channel.
+        """
+        pool = getattr(self.client, "connection_pool", None)
+        if pool is not None and pool.pid != os.getpid():
+            self.logger.debug("Resetting connection pool after fork")
+            pool.reset()
+
+    def prewarm(self):
+        """Open a connection to Redis ahead of time, so that sending the first
+        metrics doesn't have to wait for the connection to be established.
+        Failures are logged rather than raised, since sending will try to
+        connect again anyway.
+        """
+        try:
+            self.client.ping()
+        except Exception:
+            self.logger.warn("Failed to prewarm connection to Redis",
+                    exc_info=1)
+
+    def dead_letter(self, metrics):
+        """Move metrics which keep failing to publish from the in-progress
+        queue to a dead letter list (the ``queue_key`` followed by ``:dead``),
+        so they are no longer retried. Metrics which are no longer in progress
+        are ignored.
+
+        :type metrics: list
+        :param metrics: The list of :class:`~kadabra.Metrics` to give up on.
+
+        :rtype: int
+        :returns: The number of metrics moved.
+        """
+        if len(metrics) == 0:
+            return 0
+        payloads = [p for m in metrics for p in self._payloads(m)]
+        if self.dead_letter_script is None:
+            self.dead_letter_script = self.client.register_script(
+                    self.DEAD_LETTER_SCRIPT)
+        return self.dead_letter_script(keys=[self.inprogress_key,
+            self.dead_letter_key, self.received_key], args=payloads)
+
+    def dead_letters(self, limit=100):
+        """Return the metrics in the dead letter list, most recent first, so
+        they can be inspected.
+
+        :type limit: int
+        :param limit: The maximum number of metrics to return.
+
+        :rtype: list
+        :returns: A list of :class:`~kadabra.Metrics`.
+        """
+        return [Metrics.deserialize(self._decode(m)) for m in
+                self.client.lrange(self.dead_letter_key, 0, limit - 1)]
+
+    def requeue_dead_letters(self, count=None):
+        """Move metrics from the dead letter list back onto the queue, oldest
+        first, so the agent tries to publish them again (for example, once the
+        problem with them has been fixed in the backing store).
+
+        :type count: int
+        :param count: The maximum number of metrics to move, or None to move
+                      all of them.
+
+        :rtype: int
+        :returns: The number of metrics moved.
+        """
+        moved = 0
+        while count is None or moved < count:
+            size = 1000 if count is None else min(1000, count - moved)
+            pipeline = self.client.pipeline()
+            for i in range(size):
+                pipeline.rpoplpush(self.dead_letter_key, self.queue_key)
+            results = [r for r in pipeline.execute() if r is not None]
+            moved += len(results)
+            if len(results) < size:
+                break
+        return moved
+
+    def retry(self, metrics, delays):
+        """Move metrics which failed to publish from the in-progress queue to
+        a sorted set (the ``queue_key`` followed by ``:retry``), scored by
+        when they are due to be retried by the agent's clock, so that they are
+        retried after their delay rather than whenever the nanny next finds
+        them. Metrics which are no longer in progress are ignored. Skew
+        between the clocks of agents sharing the channel only shifts when
+        metrics are retried.
+
+        :type metrics: list
+        :param metrics: The list of :class:`~kadabra.Metrics` to retry.
+
+        :type delays: list
+        :param delays: The number of seconds to wait before retrying each of
+                       the metrics.
+
+        :rtype: int
+        :returns: The number of metrics moved.
+        """
+        if len(metrics) == 0:
+            return 0
+        args = [_now_ms()]
+        for m, delay in zip(metrics, delays):
+            delay_ms = int(delay * 1000)
+            for payload in self._payloads(m):
+                args.extend([delay_ms, payload])
+        return self._retry_scripts()[0](keys=[self.inprogress_key,
+            self.retry_key, self.received_key], args=args)
+
+    def requeue_due(self, limit):
+        """Move metrics whose retry is due from the retry sorted set back onto
+        the queue, ahead of the metrics already waiting there, in one atomic
+        step. Agents sharing the channel can all call this, since each due
+        payload is only moved once.
+
+        :type limit: int
+        :param limit: The maximum number of metrics to move.
+
+        :rtype: int
+        :returns: The number of metrics moved.
+        """
+        return self._retry_scripts()[1](keys=[self.retry_key,
+            self.queue_key], args=[_now_ms(), limit])
+
+    def lease(self, owner, ttl_seconds):
+        """Create a lease on this channel, which agents sharing the channel
+        use to make sure only one of their nannies runs at a time.
+
+        :type owner: string
+        :param owner: A unique name for the agent taking the lease.
+
+        :type ttl_seconds: float
+        :param ttl_seconds: How long the lease lasts unless it is renewed.
+
+        :rtype: ~kadabra.channels.RedisLease
+        :returns: The lease, stored next to the in-progress list, or None if
+                  each agent has its own in-progress list, since then each
+                  nanny only scans its own agent's metrics.
+        """
+        if self.agent_inprogress_keys:
+            return None
+        return RedisLease(self.client, self.shared_inprogress_key + ":lease",
+                owner, ttl_seconds)
+
+    def register(self, agent_id):
+        """Register the agent using this channel. If each agent has its own
+        in-progress list, metrics received from now on are moved into the
+        agent's list, and the agent is added to the registry with a first
+        heartbeat. Otherwise this does nothing.
+
+        :type agent_id: string
+        :param agent_id: A unique ID for the agent.
+        """
+        if not self.agent_inprogress_keys:
+            return
+        self.agent_id = agent_id
+        self.inprogress_key = "%s:%s" % (self.shared_inprogress_key,
+                agent_id)
+        self.heartbeat()
+
+    def heartbeat(self):
+        """Record that the registered agent is alive. The agent should call
+        this well within every ``heartbeat_timeout`` seconds, or its
+        in-progress list will be moved back onto the queue by another agent.
+        """
+        if self.agent_id is None:
+            return
+        if self.heartbeat_script is None:
+            self.heartbeat_script = self.client.register_script(
+                    self.HEARTBEAT_SCRIPT)
+        self.heartbeat_script(keys=[self.agents_key], args=[self.agent_id])
+
+    def _receive_stamped(self, timeout):
+        """Receive a payload, recording when it was received by the Redis
+        server's clock. A script moves a waiting payload and records the time
+        in one round trip; only if the queue is empty does this block, and
+        then record the time separately.
+
+        :type timeout: int
+        :param timeout: The number of seconds to wait for metrics.
+
+        :rtype: string
+        :returns: The payload, or None if there were no metrics received
+                  after the timeout.
+        """
+        receive_script, stamp_script, _ = self._timestamp_scripts()
+        received = receive_script(keys=[self.queue_key, self.inprogress_key,
+            self.received_key], args=[1])
+        if received:
+            return received[0]
+        raw = self.client.brpoplpush(self.queue_key, self.inprogress_key,
+                timeout=timeout)
+        if raw:
+            stamp_script(keys=[self.received_key], args=[_sha1(raw)])
+        return raw
+
+    def _in_progress_stamped(self, query_limit):
+        """Return the metrics that are in progress, with how long each has
+        been in progress by the Redis server's clock.
+
+        :type query_limit: int
+        :param query_limit: The maximum number of items to get from the in
+                            progress queue.
+
+        :rtype: list
+        :returns: A list of :class:`Metric`\s that are in progress.
+        """
+        now, raws, stamps = self._timestamp_scripts()[2](
+                keys=[self.inprogress_key, self.received_key],
+                args=[query_limit])
+        self.logger.debug("Found %s in progress metrics" % len(raws))
+        in_progress = []
+        for raw, stamp in zip(raws, stamps):
+            metrics = self._deserialize(raw)
+            if stamp >= 0:
+                metrics.in_progress_seconds = (now - stamp) / 1000.0
+            in_progress.append(metrics)
+        return in_progress
+
+    def _timestamp_scripts(self):
+        if self.timestamp_scripts is None:
+            self.timestamp_scripts = (
+                    self.client.register_script(self.RECEIVE_SCRIPT),
+                    self.client.register_script(self.STAMP_SCRIPT),
+                    self.client.register_script(self.IN_PROGRESS_SCRIPT))
+        return self.timestamp_scripts
+
+    def _age_seconds(self, raw):
+        """Return the age of a payload from the queue, or None if there is no
+        payload."""
+        if raw is None:
+            return None
+        return get_age_seconds(Metrics.deserialize(self._decode(raw)))
+
+    def _retry_scripts(self):
+        if self.retry_scripts is None:
+            self.retry_scripts = (
+                    self.client.register_script(self.RETRY_SCRIPT),
+                    self.client.register_script(self.REQUEUE_DUE_SCRIPT))
+        return self.retry_scripts
+
+    def _reclaim(self, limit):
+        """Move the in-progress metrics of dead agents back onto the queue.
+        The dead agents are found first, so that the script is given every key
+        it touches (as Redis Cluster requires); the script checks again that
+        they haven't sent a heartbeat since.
+
+        :type limit: int
+        :param limit: The maximum number of metrics to move.
+
+        :rtype: int
+        :returns: The number of metrics moved.
+        """
+        cutoff = int(self.client.time()[0]) - self.heartbeat_timeout
+        agents = []
+        for agent in self.client.zrangebyscore(self.agents_key, "-inf",
+                cutoff):
+            if isinstance(agent, bytes):
+                agent = agent.decode("utf-8")
+            agents.append(agent)
+        if len(agents) == 0:
+            return 0
+        if self.reclaim_script is None:
+            self.reclaim_script = self.client.register_script(
+                    self.RECLAIM_SCRIPT)
+        keys = [self.agents_key, self.queue_key]
+        keys.extend(["%s:%s" % (self.shared_inprogress_key, agent)
+            for agent in agents])
+        return self.reclaim_script(keys=keys, args=[cutoff, limit] + agents)
+
+    def _deserialize(self, raw):
+        """Decode and deserialize a payload read from Redis, remembering the
+        payload on the metrics so they can be found again in the in-progress
+        queue however they were encoded by the client.
+
+        :type raw: string
+        :param raw: The payload read from Redis.
+
+        :rtype: ~kadabra.Metrics
+        :returns: The metrics the payload represents.
+        """
+        metrics = Metrics.deserialize(self._decode(raw))
+        metrics.payload = raw
+        return metrics
+
+    def _payloads(self, metrics):
+        """Return the payloads which metrics may be stored as in the
+        in-progress queue. Metrics received from this channel were stored as
+        exactly the payload they were received as. For other metrics, this is
+        the payload this channel would send, and the plain JSON payload a
+        client without compression or dictionary encoding would send.
+
+        :type metrics: ~kadabra.Metrics
+        :param metrics: The metrics to find.
+
+        :rtype: list
+        :returns: The possible payloads.
+        """
+        if metrics.payload is not None:
+            return [metrics.payload]
+        serialized = metrics.serialize()
+        encoded = self._encode(serialized)
+        plain = json.dumps(serialized)
+        if encoded != plain:
+            return [encoded, plain]
+        return [encoded]
+
+    def _encode(self, serialized):
+        """Encode serialized metrics for storage in Redis. If dictionary
+        encoding is enabled, strings are replaced by their IDs, and if the
+        result is at least as large as the compression threshold it is
+        compressed. Encoding is deterministic, which allows completed metrics
+        to be found in the in-progress queue by value.
+
+        :type serialized: dict
+        :param serialized: The serialized metrics.
+
+        :rtype: string
+        :returns: The payload to store in Redis.
+        """
+        if self.dictionary_encoding:
+            payload = DICTIONARY_MARKER +\
+                    json.dumps(self.dictionary.encode(serialized))
+        else:
+            payload = json.dumps(serialized)
+        if self.compression_threshold is None or\
+                len(payload) < self.compression_threshold:
+            return payload
+        data = payload.encode("utf-8")
+        if self.compression_dictionary is not None:
+            compressor = zlib.compressobj(self.compression_level,
+                    zlib.DEFLATED, zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL,
+                    zlib.Z_DEFAULT_STRATEGY, self.compression_dictionary)
+            compressed = compressor.compress(data) + compressor.flush()
+        else:
+            compressed = zlib.compress(data, self.compression_level)
+        return COMPRESSED_MARKER + compressed
+
+    def _decode(self, raw):
+        """Decode a payload read from Redis into serialized metrics,
+        decompressing it if it starts with the
+        :data:`~kadabra.channels.COMPRESSED_MARKER` and looking up string IDs
+        if it starts with the :data:`~kadabra.channels.DICTIONARY_MARKER`.
+
+        :type raw: string
+        :param raw: The payload read from Redis.
+
+        :rtype: dict
+        :returns: The serialized metrics.
+        """
+        if isinstance(raw, bytes):
+            if raw[:1] == COMPRESSED_MARKER:
+                if self.compression_dictionary is not None:
+                    decompressor = zlib.decompressobj(
+                            zdict=self.compression_dictionary)
+                    raw = decompressor.decompress(raw[1:]) +\
+                            decompressor.flush()
+                else:
+                    raw = zlib.decompress(raw[1:])
+            raw = raw.decode("utf-8")
+        if raw[:1] == DICTIONARY_MARKER:
+            return self.dictionary.decode(json.loads(raw[1:]))
+        return json.loads(raw)
+
+class ShardedRedisChannel(object):
+    """A channel which spreads metrics across several Redis lists, each on
+    its own Redis server or under its own keys. Every shard is a
+    :class:`~kadabra.channels.RedisChannel` with its own queue and in-progress
+    list, so no single Redis server or key has to absorb all of the traffic.
+
+    Metrics are sent to shards either in turn (``round_robin``) or by a hash
+    of their dimensions (``dimensions``), which keeps metrics with the same
+    dimensions on the same shard. The agent receives from all shards, and the
+    nanny scans the in-progress list of every shard.
+
+    :type shards: list
+    :param shards: A list of dictionaries, one for each shard, with the
+                   arguments for its :class:`~kadabra.channels.RedisChannel`.
+                   Any arguments which are not specified take their value from
+                   :attr:`RedisChannel.DEFAULT_ARGS
+                   <kadabra.channels.RedisChannel.DEFAULT_ARGS>`.
+
+    :type logger: string
+    :param logger: The name of the logger to use.
+
+    :type sharding: string
+    :param sharding: How to pick the shard to send metrics to, either
+                     ``round_robin`` or ``dimensions``.
+
+    :type receive_timeout: int
+    :param receive_timeout: The number of seconds to wait for metrics when
+                            receiving, if all of the shards are empty.
+    """
+
+    #: Default arguments for the sharded Redis channel. These will be used by
+    #: the client and agent to initialize this channel if custom configuration
+    #: values are not provided.
+    DEFAULT_ARGS = {
+            "shards": [{"host": "localhost", "port": 6379, "db": 0}],
+            "logger": "kadabra.channel",
+            "sharding": "round_robin",
+            "receive_timeout": 10
+    }
+
+    def __init__(self, shards, logger, sharding="round_robin",
+            receive_timeout=10):
+        if sharding not in ("round_robin", "dimensions"):
+            raise Exception("Unrecognized sharding: '%s'" % sharding)
+        self.logger = logging.getLogger(logger)
+        self.sharding = sharding
+        self.receive_timeout = receive_timeout
+
+        self.shards = []
+        for shard in shards:
+            args = RedisChannel.DEFAULT_ARGS.copy()
+            args["logger"] = logger
+            args.update(shard)
+            self.shards.append(RedisChannel(**args))
+
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.origins = weakref.WeakKeyDictionary()
+
+    def send(self, metrics):
+        """Send metrics to one of the shards.
+
+        :type metrics: ~kadabra.Metrics
+        :param metrics: The metrics to be sent.
+        """
+        if self.sharding == "dimensions":
+            key = json.dumps(sorted((d.name, d.value)
+                for d in metrics.dimensions)).encode("utf-8")
+            index = zlib.crc32(key) % len(self.shards)
+        else:
+            index = next(self.counter) % len(self.shards)
+        self.shards[index].send(metrics)
+
+    def receive(self):
+        """Receive metrics from any of the shards so they can be published.
+        Each shard is checked without blocking, starting from a different shard
+        each time so that none of them is favored. If they are all empty, this
+        method blocks on one of the shards for its share of the receive
+        timeout.
+
+        :rtype: ~kadabra.Metrics
+        :returns: The metrics to be published, or None if there were no metrics
+                  received after the timeout.
+        """
+        start = next(self.counter)
+        for i in range(len(self.shards)):
+            index = (start + i) % len(self.shards)
+            batch = self.shards[index].receive_batch(1)
+            if len(batch) > 0:
+                self._track(batch, index)
+                return batch[0]
+
+        index = start % len(self.shards)
+        timeout = max(1, self.receive_timeout // len(self.shards))
+        metrics = self.shards[index].receive(timeout=timeout)
+        if metrics is not None:
+            self._track([metrics], index)
+        return metrics
+
+    def receive_batch(self, max_batch_size):
+        """Receive a list of metrics from the shards so they can be published.
+        The batch is split evenly between the shards.
+
+        :type max_batch_size: int
+        :param max_batch_size: The maximum number of metrics to receive in the
+                               batch.
+
+        :rtype: list
+        :returns: The list of metrics to be published. The size of the list is
+                  less than or equal to the ``max_batch_size``, and possibly
+                  empty if there are no metrics in any of the queues.
+        """
+        batch = []
+        for index, size in self._split(max_batch_size):
+            received = self.shards[index].receive_batch(size)
+            self._track(received, index)
+            batch.extend(received)
+        return batch
+
+    def receive_newest(self, max_batch_size):
+        """Receive the most recently sent metrics from the heads of the
+        shards' queues. The batch is split evenly between the shards. See
+        :meth:`RedisChannel.receive_newest
+        <kadabra.channels.RedisChannel.receive_newest>`.
+        """
+        batch = []
+        for index, size in self._split(max_batch_size):
+            received = self.shards[index].receive_newest(size)
+            self._track(received, index)
+            batch.extend(received)
+        return batch
+
+    def backlog_stats(self):
+        """Return the combined length of the shards' queues and the ages of
+        the oldest and newest metrics in any of them. See
+        :meth:`RedisChannel.backlog_stats
+        <kadabra.channels.RedisChannel.backlog_stats>`.
+        """
+        stats = [shard.backlog_stats() for shard in self.shards]
+        oldest = [s["oldest_age_seconds"] for s in stats
+                if s["oldest_age_seconds"] is not None]
+        newest = [s["newest_age_seconds"] for s in stats
+                if s["newest_age_seconds"] is not None]
+        return {"length": sum(s["length"] for s in stats),
+                "oldest_age_seconds": max(oldest) if oldest else None,
+                "newest_age_seconds": min(newest) if newest else None}
+
+    def complete(self, metrics):
+        """Mark a list of metrics as completed by removing them from the
+        in-progress queue of the shard they were received from. Metrics whose
+        shard isn't known are removed from every shard.
+
+        :type metrics: list
+        :param metrics: The list of :class:`~kadabra.Metrics` to mark as
+                        complete.
+        """
+        by_shard = [[] for shard in self.shards]
+        with self.lock:
+            for m in metrics:
+                index = self.origins.get(m)
+                if index is None:
+                    for shard_metrics in by_shard:
+                        shard_metrics.append(m)
+                else:
+                    by_shard[index].append(m)
+        for shard, shard_metrics in zip(self.shards, by_shard):
+            shard.complete(shard_metrics)
+
+    def in_progress(self, query_limit):
+        """Return a list of the metrics that are in progress on all shards.
+        The query limit is split evenly between the shards.
+
+        :type query_limit: int
+        :param query_limit: The maximum number of items to get from the in
+                            progress queues.
+
+        :rtype: list
+        :returns: A list of :class:`Metric`\s that are in progress.
+        """
+        in_progress = []
+        for index, size in self._split(query_limit):
+            shard_in_progress = self.shards[index].in_progress(size)
+            self._track(shard_in_progress, index)
+            in_progress.extend(shard_in_progress)
+        return in_progress
+
+    def reset(self):
+        """Reset each shard after the process has forked. See
+        :meth:`RedisChannel.reset <kadabra.channels.RedisChannel.reset>`.
+        """
+        for shard in self.shards:
+            shard.reset()
+
+    def prewarm(self):
+        """Open a connection to each shard ahead of time. See
+        :meth:`RedisChannel.prewarm <kadabra.channels.RedisChannel.prewarm>`.
+        """
+        for shard in self.shards:
+            shard.prewarm()
+
+    def dead_letter(self, metrics):
+        """Move metrics to the dead letter list of the shard they were received
+        from. Metrics whose shard isn't known are looked for on every shard.
+        See :meth:`RedisChannel.dead_letter
+        <kadabra.channels.RedisChannel.dead_letter>`.
+
+        :type metrics: list
+        :param metrics: The list of :class:`~kadabra.Metrics` to give up on.
+
+        :rtype: int
+        :returns: The number of metrics moved.
+        """
+        by_shard = [[] for shard in self.shards]
+        with self.lock:
+            for m in metrics:
+                index = self.origins.get(m)
+                if index is None:
+                    for shard_metrics in by_shard:
+                        shard_metrics.append(m)
+                else:
+                    by_shard[index].append(m)
+        return sum(shard.dead_letter(shard_metrics)
+                for shard, shard_metrics in zip(self.shards, by_shard))
+
+    def dead_letters(self, limit=100):
+        """Return up to ``limit`` metrics from the dead letter lists of all
+        shards. See :meth:`RedisChannel.dead_letters
+        <kadabra.channels.RedisChannel.dead_letters>`.
+        """
+        dead = []
+        for shard in self.shards:
+            if len(dead) >= limit:
+                break
+            dead.extend(shard.dead_letters(limit - len(dead)))
+        return dead
+
+    def requeue_dead_letters(self, count=None):
+        """Move metrics from the dead letter lists of all shards back onto
+        their queues. See :meth:`RedisChannel.requeue_dead_letters
+        <kadabra.channels.RedisChannel.requeue_dead_letters>`.
+        """
+        moved = 0
+        for shard in self.shards:
+            moved += shard.requeue_dead_letters(
+                    None if count is None else count - moved)
+            if count is not None and moved >= count:
+                break
+        return moved
+
+    def retry(self, metrics, delays):
+        """Move metrics to the retry sorted set of the shard they were
+        received from. Metrics whose shard isn't known are looked for on
+        every shard. See :meth:`RedisChannel.retry
+        <kadabra.channels.RedisChannel.retry>`.
+
+        :type metrics: list
+        :param metrics: The list of :class:`~kadabra.Metrics` to retry.
+
+        :type delays: list
+        :param delays: The number of seconds to wait before retrying each of
+                       the metrics.
+
+        :rtype: int
+        :returns: The number of metrics moved.
+        """
+        by_shard = [([], []) for shard in self.shards]
+        with self.lock:
+            for m, delay in zip(metrics, delays):
+                index = self.origins.get(m)
+                shards = by_shard if index is None else [by_shard[index]]
+                for shard_metrics, shard_delays in shards:
+                    shard_metrics.append(m)
+                    shard_delays.append(delay)
+        return sum(shard.retry(shard_metrics, shard_delays)
+                for shard, (shard_metrics, shard_delays)
+                in zip(self.shards, by_shard))
+
+    def requeue_due(self, limit):
+        """Move metrics whose retry is due back onto the queue of each shard.
+        The limit is split evenly between the shards. See
+        :meth:`RedisChannel.requeue_due
+        <kadabra.channels.RedisChannel.requeue_due>`.
+        """
+        return sum(self.shards[index].requeue_due(size)
+                for index, size in self._split(limit))
+
+    def lease(self, owner, ttl_seconds):
+        """Create a lease on this channel, stored on the first shard. A single
+        lease covers all of the shards, since the nanny scans all of them. See
+        :meth:`RedisChannel.lease <kadabra.channels.RedisChannel.lease>`.
+        """
+        return self.shards[0].lease(owner, ttl_seconds)
+
+    def register(self, agent_id):
+        """Register the agent with each shard. See
+        :meth:`RedisChannel.register <kadabra.channels.RedisChannel.register>`.
+        """
+        for shard in self.shards:
+            shard.register(agent_id)
+
+    def heartbeat(self):
+        """Record a heartbeat with each shard. See
+        :meth:`RedisChannel.heartbeat
+        <kadabra.channels.RedisChannel.heartbeat>`.
+        """
+        for shard in self.shards:
+            shard.heartbeat()
+
+    def _split(self, size):
+        """Split a number of metrics between the shards, rotating which shards
+        get the remainder.
+
+        :type size: int
+        :param size: The number of metrics to split.
+
+        :rtype: list
+        :returns: A list of (shard index, size) tuples, skipping shards which
+                  get nothing.
+        """
+        start = next(self.counter)
+        per_shard, remainder = divmod(size, len(self.shards))
+        sizes = []
+        for i in range(len(self.shards)):
+            index = (start + i) % len(self.shards)
+            shard_size = per_shard + (1 if i < remainder else 0)
+            if shard_size > 0:
+                sizes.append((index, shard_size))
+        return sizes
+
+    def _track(self, metrics, index):
+        """Remember which shard metrics were received from, so they can be
+        completed on that shard.
+
+        :type metrics: list
+        :param metrics: The list of :class:`~kadabra.Metrics` that were
+                        received.
+
+        :type index: int
+        :param index: The index of the shard they were received from.
+        """
+        with self.lock:
+            for m in metrics:
+                self.origins[m] = index
+
+class RedisClusterChannel(ShardedRedisChannel):
+    """A channel for transporting metrics using Redis Cluster. The
+    :class:`~kadabra.channels.RedisChannel` pops metrics from the queue into
+    the in-progress list atomically, which in a cluster requires both keys to
+    live in the same hash slot. This channel uses several queue and
+    in-progress key pairs, each sharing a hash tag (e.g.
+    ``{kadabra:0}kadabra_queue`` and ``{kadabra:0}kadabra_inprogress``), so
+    that each pair lives in one slot and the pairs are spread across the slots
+    (and so the nodes) of the cluster. It otherwise behaves just like the
+    :class:`~kadabra.channels.ShardedRedisChannel`, with each key pair acting
+    as a shard.
+
+    Requires redis-py 4.1 or later, or the ``redis-py-cluster`` package.
+
+    :type startup_nodes: list
+    :param startup_nodes: A list of dictionaries with the ``host`` and
+                          ``port`` of one or more nodes of the cluster, used
+                          to discover the rest of the cluster.
+
+    :type logger: string
+    :param logger: The name of the logger to use.
+
+    :type key_pairs: int
+    :param key_pairs: The number of queue and in-progress key pairs to use.
+                      This should be at least the number of master nodes in
+                      the cluster.
+
+    :type hash_tag: string
+    :param hash_tag: The prefix of the hash tag for each key pair. The index
+                     of the key pair is appended to it.
+
+    :type queue_key: string
+    :param queue_key: The name of the queue key of each pair, after the hash
+                      tag.
+
+    :type inprogress_key: string
+    :param inprogress_key: The name of the in-progress key of each pair, after
+                           the hash tag.
+
+    :type sharding: string
+    :param sharding: How to pick the key pair to send metrics to, either
+                     ``round_robin`` or ``dimensions``.
+
+    :type receive_timeout: int
+    :param receive_timeout: The number of seconds to wait for metrics when
+                            receiving, if all of the queues are empty.
+
+    :type channel_args: dict
+    :param channel_args: Any other arguments for the
+                         :class:`~kadabra.channels.RedisChannel` of each key
+                         pair, such as the compression settings. Note that a
+                         ``dictionary_key`` must contain a hash tag, since the
+                         string dictionary is stored in two keys.
+    """
+
+    #: Default arguments for the Redis Cluster channel. These will be used by
+    #: the client and agent to initialize this channel if custom configuration
+    #: values are not provided.
+    DEFAULT_ARGS = {
+            "startup_nodes": [{"host": "localhost", "port": 7000}],
+            "logger": "kadabra.channel",
+            "key_pairs": 16,
+            "hash_tag": "kadabra:",
+            "queue_key": "kadabra_queue",
+            "inprogress_key": "kadabra_inprogress",
+            "sharding": "round_robin",
+            "receive_timeout": 10,
+            "channel_args": None
+    }
+
+    def __init__(self, startup_nodes, logger, key_pairs=16,
+            hash_tag="kadabra:", queue_key="kadabra_queue",
+            inprogress_key="kadabra_inprogress", sharding="round_robin",
+            receive_timeout=10, channel_args=None):
+        self.cluster = _create_cluster_client(startup_nodes)
+
+        shards = []
+        for i in range(key_pairs):
+            shard = {"dictionary_key": "{kadabra_dictionary}"}
+            if channel_args:
+                shard.update(channel_args)
+            tag = "{%s%d}" % (hash_tag, i)
+            shard["queue_key"] = tag + queue_key
+            shard["inprogress_key"] = tag + inprogress_key
+            shard["client"] = self.cluster
+            shards.append(shard)
+        super(RedisClusterChannel, self).__init__(shards, logger, sharding,
+                receive_timeout)
+
+class PriorityRedisChannel(ShardedRedisChannel):
+    """A channel which keeps metrics of different priorities in separate
+    Redis queues, called lanes, so that important metrics aren't stuck behind
+    a backlog of less important ones. Each lane is a
+    :class:`~kadabra.channels.RedisChannel` with its own queue and in-progress
+    list, and a weight.
+
+    Metrics are sent to the lane named by the ``priority`` passed to
+    :meth:`~kadabra.channels.PriorityRedisChannel.send` (see
+    :meth:`Kadabra.send <kadabra.Kadabra.send>`), or else to the lane named by
+    the value of their ``lane_dimension`` dimension, or else to the
+    ``default_lane``. The agent receives from the lanes in proportion to their
+    weights, using smooth weighted round robin, so with weights of 4 and 1 it
+    takes four metrics from the first lane for every one from the second while
+    both are backlogged. Lanes which are empty don't hold up the others. It
+    otherwise behaves just like the
+    :class:`~kadabra.channels.ShardedRedisChannel`, with each lane acting as a
+    shard.
+
+    :type lanes: list
+    :param lanes: A list of dictionaries, one for each lane, with its
+                  ``name``, its ``weight``, and the arguments for its
+                  :class:`~kadabra.channels.RedisChannel` (which must include
+                  a ``queue_key`` and ``inprogress_key`` of its own). Any
+                  arguments which are not specified take their value from
+                  :attr:`RedisChannel.DEFAULT_ARGS
+                  <kadabra.channels.RedisChannel.DEFAULT_ARGS>`.
+
+    :type logger: string
+    :param logger: The name of the logger to use.
+
+    :type default_lane: string
+    :param default_lane: The name of the lane for metrics which don't name
+                         one.
+
+    :type lane_dimension: string
+    :param lane_dimension: If set, the name of the dimension whose value names
+                           the lane for metrics sent without a priority.
+
+    :type receive_timeout: int
+    :param receive_timeout: The number of seconds to wait for metrics when
+                            receiving, if all of the lanes are empty.
+    """
+
+    #: Default arguments for the priority Redis channel. These will be used by
+    #: the client and agent to initialize this channel if custom configuration
+    #: values are not provided.
+    DEFAULT_ARGS = {
+            "lanes": [
+                {"name": "high", "weight": 4,
+                    "queue_key": "kadabra_queue_high",
+                    "inprogress_key": "kadabra_inprogress_high"},
+                {"name": "default", "weight": 1,
+                    "queue_key": "kadabra_queue",
+                    "inprogress_key": "kadabra_inprogress"}],
+            "logger": "kadabra.channel",
+            "default_lane": "default",
+            "lane_dimension": None,
+            "receive_timeout": 10
+    }
+
+    def __init__(self, lanes, logger, default_lane="default",
+            lane_dimension=None, receive_timeout=10):
+        shards = []
+        self.names = []
+        self.weights = []
+        for lane in lanes:
+            shard = dict(lane)
+            self.names.append(shard.pop("name"))
+            self.weights.append(shard.pop("weight", 1))
+            shards.append(shard)
+        if default_lane not in self.names:
+            raise Exception("Unrecognized default lane: '%s'" % default_lane)
+        self.default_lane = default_lane
+        self.lane_dimension = lane_dimension
+        self.current_weights = [0] * len(shards)
+        super(PriorityRedisChannel, self).__init__(shards, logger,
+                receive_timeout=receive_timeout)
+
+    def send(self, metrics, priority=None):
+        """Send metrics to the lane for their priority.
+
+        :type metrics: ~kadabra.Metrics
+        :param metrics: The metrics to be sent.
+
+        :type priority: string
+        :param priority: The name of the lane to send the metrics to. If None,
+                         the lane is picked by the ``lane_dimension`` or is the
+                         ``default_lane``.
+        """
+        self.shards[self._lane_index(metrics, priority)].send(metrics)
+
+    def has_lane(self, priority):
+        """Check whether this channel has a lane for a priority, so that
+        clients can reject unknown priorities before sending.
+
+        :type priority: string
+        :param priority: The name of the lane.
+
+        :rtype: bool
+        :returns: True if there is a lane with this name, False otherwise.
+        """
+        return priority in self.names
+
+    def receive(self):
+        """Receive metrics from the lane whose turn it is, by weight, so they
+        can be published. If that lane is empty, the other lanes are checked
+        in order of preference without blocking. If they are all empty, this
+        method blocks on the heaviest lane for its share of the receive
+        timeout.
+
+        :rtype: ~kadabra.Metrics
+        :returns: The metrics to be published, or None if there were no metrics
+                  received after the timeout.
+        """
+        for index in self._preference():
+            batch = self.shards[index].receive_batch(1)
+            if len(batch) > 0:
+                self._track(batch, index)
+                return batch[0]
+
+        index = self.weights.index(max(self.weights))
+        timeout = max(1, self.receive_timeout // len(self.shards))
+        metrics = self.shards[index].receive(timeout=timeout)
+        if metrics is not None:
+            self._track([metrics], index)
+        return metrics
+
+    def receive_batch(self, max_batch_size):
+        """Receive a list of metrics from the lanes so they can be published.
+        The batch is split between the lanes in proportion to their weights,
+        and whatever the lanes which run out of metrics leave unused goes to
+        the others, heaviest first.
+
+        :type max_batch_size: int
+        :param max_batch_size: The maximum number of metrics to receive in the
+                               batch.
+
+        :rtype: list
+        :returns: The list of metrics to be published. The size of the list is
+                  less than or equal to the ``max_batch_size``, and possibly
+                  empty if there are no metrics in any of the queues.
+        """
+        batch = []
+        full = []
+        for index, size in self._weighted_split(max_batch_size):
+            received = self.shards[index].receive_batch(size)
+            self._track(received, index)
+            batch.extend(received)
+            if len(received) == size:
+                full.append(index)
+        for index in sorted(full, key=lambda i: -self.weights[i]):
+            if len(batch) >= max_batch_size:
+                break
+            received = self.shards[index].receive_batch(
+                    max_batch_size - len(batch))
+            self._track(received, index)
+            batch.extend(received)
+        return batch
+
+    def _lane_index(self, metrics, priority):
+        """Return the index of the lane to send metrics to."""
+        if priority is None and self.lane_dimension is not None:
+            for d in metrics.dimensions:
+                if d.name == self.lane_dimension and d.value in self.names:
+                    priority = d.value
+                    break
+        if priority is None:
+            priority = self.default_lane
+        if priority not in self.names:
+            raise Exception("Unrecognized lane: '%s'" % priority)
+        return self.names.index(priority)
+
+    def _preference(self):
+        """Return the indexes of the lanes in the order they should be
+        received from, using smooth weighted round robin: every lane's current
+        weight grows by its weight, the lane with the highest current weight
+        goes first and has the total weight taken off.
+
+        :rtype: list
+        :returns: The lane indexes, the lane whose turn it is first.
+        """
+        with self.lock:
+            for i, weight in enumerate(self.weights):
+                self.current_weights[i] += weight
+            order = sorted(range(len(self.shards)),
+                    key=lambda i: -self.current_weights[i])
+            self.current_weights[order[0]] -= sum(self.weights)
+            return order
+
+    def _weighted_split(self, size):
+        """Split a number of metrics between the lanes in proportion to their
+        weights, giving the remainder to the lanes with the largest fractional
+        shares.
+
+        :type size: int
+        :param size: The number of metrics to split.
+
+        :rtype: list
+        :returns: A list of (lane index, size) tuples, skipping lanes which
+                  get nothing.
+        """
+        total = float(sum(self.weights))
+        shares = [size * weight / total for weight in self.weights]
+        sizes = [int(share) for share in shares]
+        by_remainder = sorted(range(len(shares)),
+                key=lambda i: sizes[i] - shares[i])
+        for i in by_remainder[:size - sum(sizes)]:
+            sizes[i] += 1
+        return [(i, s) for i, s in enumerate(sizes) if s > 0]
+
+class MemoryChannel(object):
+    """A channel which keeps metrics in memory, for applications which run the
+    :class:`~kadabra.Agent` in the same process as the client, and for
+    benchmarking the agent without a network in the way. Clients and agents
+    which use the same ``name`` in the same process share a
+    :class:`~kadabra.channels.LocalQueue`.
+
+    Note that metrics only live as long as the process does: anything that
+    hasn't been published when the process exits is lost.
+
+    :type name: string
+    :param name: The name of the queue to use. Channels with the same name in
+                 the same process share their queue.
+
+    :type logger: string
+    :param logger: The name of the logger to use.
+
+    :type receive_timeout: int
+    :param receive_timeout: The number of seconds to wait for metrics when
+                            receiving.
+    """
+
+    #: Default arguments for the memory channel. These will be used by the
+    #: client and agent to initialize this channel if custom configuration
+    #: values are not provided.
+    DEFAULT_ARGS = {
+            "name": "kadabra",
+            "logger": "kadabra.channel",
+            "receive_timeout": 10
+    }
+
+    def __init__(self, name, logger, receive_timeout=10):
+        self.name = name
+        self.logger = logging.getLogger(logger)
+        self.receive_timeout = receive_timeout
+        self.queue = get_local_queue(name)
+
+    def send(self, metrics):
+        """Send metrics by adding them to the in-memory queue. The metrics are
+        copied (through serialization), so they are stamped with the time they
+        were sent just like they would be by any other channel.
+
+        :type metrics: ~kadabra.Metrics
+        :param metrics: The metrics to be sent.
+        """
+        self.queue.put([Metrics.deserialize(metrics.serialize())])
+
+    def receive(self):
+        """Receive metrics from the queue so they can be published. Once
+        received, the metrics will be considered in progress until they have
+        been acknowledged as published (by calling
+        :meth:`~kadabra.channels.MemoryChannel.complete`). This method will
+        block until there are metrics available on the queue or until the
+        receive timeout.
+
+        :rtype: ~kadabra.Metrics
+        :returns: The metrics to be published, or None if there were no metrics
+                  received after the timeout.
+        """
+        batch = self.queue.get(1, self.receive_timeout)
+        return batch[0] if len(batch) > 0 else None
+
+    def receive_batch(self, max_batch_size):
+        """Receive a list of metrics from the queue so they can be published,
+        without waiting for metrics if the queue is empty.
+
+        :type max_batch_size: int
+        :param max_batch_size: The maximum number of metrics to receive in the
+                               batch.
+
+        :rtype: list
+        :returns: The list of metrics to be published. The size of the list is
+                  less than or equal to the ``max_batch_size``, and possibly
+                  empty if there are no metrics in the queue.
+        """
+        return self.queue.get(max_batch_size)
+
+    def complete(self, metrics):
+        """Mark a list of metrics as completed, so they are no longer in
+        progress.
+
+        :type metrics: list
+        :param metrics: The list of :class:`~kadabra.Metrics` to mark as
+                        complete.
+        """
+        self.queue.complete(metrics)
+
+    def in_progress(self, query_limit):
+        """Return a list of the metrics that are in progress, oldest first.
+
+        :type query_limit: int
+        :param query_limit: The maximum number of metrics to return.
+
+        :rtype: list
+        :returns: A list of :class:`Metric`\s that are in progress.
+        """
+        return self.queue.in_progress(query_limit)
+
+class SharedMemoryChannel(object):
+    """A channel for clients and an agent running on the same host, which
+    passes metrics through a ring buffer in shared memory instead of making a
+    round trip to Redis. Any number of client processes write to the ring
+    buffer, and a single agent drains it. Writers take a lock file for just
+    long enough to copy their metrics into the buffer.
+
+    If the ring buffer doesn't have room for metrics, they are dropped rather
+    than blocking the application, and the number of dropped metrics is kept
+    in the ring buffer's header (see
+    :meth:`~kadabra.channels.SharedMemoryChannel.stats`). Once the agent has
+    taken metrics from the ring buffer they are only held in the agent's
+    memory until they are published, so they are lost if the agent crashes.
+
+    Requires Python 3.8 or later and a POSIX platform.
+
+    :type name: string
+    :param name: The name of the shared memory block. The client and agent
+                 must use the same name.
+
+    :type logger: string
+    :param logger: The name of the logger to use.
+
+    :type capacity: int
+    :param capacity: The size of the ring buffer in bytes. This is only used
+                     by whichever process creates the shared memory block.
+
+    :type lock_path: string
+    :param lock_path: The path of the lock file used to coordinate writers.
+                      Defaults to a file named after the shared memory block
+                      in the temporary directory.
+
+    :type receive_timeout: int
+    :param receive_timeout: The number of seconds to wait for metrics when
+                            receiving.
+
+    :type poll_interval: float
+    :param poll_interval: How often, in seconds, to check for new metrics
+                          while waiting.
+    """
+
+    #: Default arguments for the shared memory channel. These will be used by
+    #: the client and agent to initialize this channel if custom configuration
+    #: values are not provided.
+    DEFAULT_ARGS = {
+            "name": "kadabra",
+            "logger": "kadabra.channel",
+            "capacity": 16 * 1024 * 1024,
+            "lock_path": None,
+            "receive_timeout": 10,
+            "poll_interval": 0.01
+    }
+
+    #: The header of the ring buffer: a magic number, the capacity, the total
+    #: number of bytes written (the head), the total number of bytes read (the
+    #: tail), the number of metrics written and the number of metrics dropped.
+    HEADER = struct.Struct("<QQQQQQ")
+
+    #: Each record in the ring buffer is the length of the payload followed by
+    #: the payload (serialized metrics as UTF-8 JSON).
+    RECORD_HEADER = struct.Struct("<I")
+
+    MAGIC = 0x6b61646162726121
+
+    def __init__(self, name, logger, capacity=16 * 1024 * 1024,
+            lock_path=None, receive_timeout=10, poll_interval=0.01):
+        self.name = name
+        self.logger = logging.getLogger(logger)
+        self.lock_path = lock_path if lock_path is not None else\
+                os.path.join(tempfile.gettempdir(), "%s.lock" % name)
+        self.receive_timeout = receive_timeout
+        self.poll_interval = poll_interval
+
+        self.lock = threading.Lock()
+        self.lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.memory = _attach_shared_memory(name,
+                self.HEADER.size + capacity)
+        self.buffer = self.memory.buf
+        with self._locked():
+            magic = self.HEADER.unpack_from(self.buffer, 0)[0]
+            if magic != self.MAGIC:
+                self.HEADER.pack_into(self.buffer, 0, self.MAGIC,
+                        len(self.buffer) - self.HEADER.size, 0, 0, 0, 0)
+            self.capacity = self.HEADER.unpack_from(self.buffer, 0)[1]
+
+        self.local = LocalQueue()
+
+    def send(self, metrics):
+        """Send metrics by copying them into the ring buffer. If there isn't
+        room for them, they are dropped and counted.
+
+        :type metrics: ~kadabra.Metrics
+        :param metrics: The metrics to be sent.
+        """
+        data = json.dumps(metrics.serialize()).encode("utf-8")
+        record = self.RECORD_HEADER.pack(len(data)) + data
+        with self._locked():
+            magic, capacity, head, tail, written, dropped =\
+                    self.HEADER.unpack_from(self.buffer, 0)
+            if len(record) > capacity - (head - tail):
+                self.HEADER.pack_into(self.buffer, 0, magic, capacity, head,
+                        tail, written, dropped + 1)
+                return
+            self._copy_in(head, record)
+            self.HEADER.pack_into(self.buffer, 0, magic, capacity,
+                    head + len(record), tail, written + 1, dropped)
+
+    def receive(self):
+        """Receive metrics from the ring buffer so they can be published. Once
+        received, the metrics will be considered in progress until they have
+        been acknowledged as published (by calling
+        :meth:`~kadabra.channels.SharedMemoryChannel.complete`). This method
+        will block until there are metrics available or until the receive
+        timeout.
+
+        :rtype: ~kadabra.Metrics
+        :returns: The metrics to be published, or None if there were no metrics
+                  received after the timeout.
+        """
+        deadline = time.time() + self.receive_timeout
+        while True:
+            batch = self.receive_batch(1)
+            if len(batch) > 0:
+                return batch[0]
+            if time.time() >= deadline:
+                return None
+            time.sleep(self.poll_interval)
+
+    def receive_batch(self, max_batch_size):
+        """Receive a list of metrics from the ring buffer so they can be
+        published, without waiting if there are none.
+
+        :type max_batch_size: int
+        :param max_batch_size: The maximum number of metrics to receive in the
+                               batch.
+
+        :rtype: list
+        :returns: The list of metrics to be published. The size of the list is
+                  less than or equal to the ``max_batch_size``, and possibly
+                  empty if the ring buffer is empty.
+        """
+        with self.lock:
+            with self._locked():
+                head, tail = self.HEADER.unpack_from(self.buffer, 0)[2:4]
+            records = []
+            while tail < head and len(records) < max_batch_size:
+                length = self.RECORD_HEADER.unpack(self._copy_out(tail,
+                    self.RECORD_HEADER.size))[0]
+                records.append(self._copy_out(
+                    tail + self.RECORD_HEADER.size, length))
+                tail += self.RECORD_HEADER.size + length
+            if len(records) > 0:
+                # Only this process moves the tail, and writers only need a
+                # consistent value to work out how much room there is.
+                with self._locked():
+                    header = list(self.HEADER.unpack_from(self.buffer, 0))
+                    header[3] = tail
+                    self.HEADER.pack_into(self.buffer, 0, *header)
+            self.local.put([Metrics.deserialize(json.loads(
+                r.decode("utf-8"))) for r in records])
+        return self.local.get(max_batch_size)
+
+    def complete(self, metrics):
+        """Mark a list of metrics as completed, so they are no longer in
+        progress.
+
+        :type metrics: list
+        :param metrics: The list of :class:`~kadabra.Metrics` to mark as
+                        complete.
+        """
+        self.local.complete(metrics)
+
+    def in_progress(self, query_limit):
+        """Return a list of the metrics that are in progress, oldest first.
+
+        :type query_limit: int
+        :param query_limit: The maximum number of metrics to return.
+
+        :rtype: list
+        :returns: A list of :class:`Metric`\s that are in progress.
+        """
+        return self.local.in_progress(query_limit)
+
+    def stats(self):
+        """Return statistics about the ring buffer.
+
+        :rtype: dict
+        :returns: The ``capacity`` and ``used`` bytes of the ring buffer, and
+                  the number of metrics ``written`` to it and ``dropped``
+                  because it was full.
+        """
+        with self._locked():
+            magic, capacity, head, tail, written, dropped =\
+                    self.HEADER.unpack_from(self.buffer, 0)
+        return {"capacity": capacity, "used": head - tail,
+                "written": written, "dropped": dropped}
+
+    def reset(self):
+        """Reopen the lock file after the process has forked. ``flock`` locks
+        belong to the open file, which is shared with the parent after a fork,
+        so without this the parent and child could write at the same time."""
+        with self.lock:
+            os.close(self.lock_fd)
+            self.lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT,
+                    0o644)
+
+    def _locked(self):
+        """Return a context manager which holds the lock file."""
+        return _FileLock(self.lock_fd)
+
+    def _copy_in(self, position, data):
+        """Copy data into the ring buffer at a position, wrapping around the
+        end of the buffer if needed.
+
+        :type position: int
+        :param position: The position (the total number of bytes written
+                         before this data).
+
+        :type data: bytes
+        :param data: The data to copy.
+        """
+        start = position % self.capacity
+        first = min(len(data), self.capacity - start)
+        offset = self.HEADER.size + start
+        self.buffer[offset:offset + first] = data[:first]
+        if first < len(data):
+            self.buffer[self.HEADER.size:self.HEADER.size + len(data) -
+                    first] = data[first:]
+
+    def _copy_out(self, position, length):
+        """Copy data out of the ring buffer from a position, wrapping around
+        the end of the buffer if needed.
+
+        :type position: int
+        :param position: The position (the total number of bytes written
+                         before the data).
+
+        :type length: int
+        :param length: The number of bytes to copy.
+
+        :rtype: bytes
+        :returns: The data.
+        """
+        start = position % self.capacity
+        first = min(length, self.capacity - start)
+        offset = self.HEADER.size + start
+        data = bytes(self.buffer[offset:offset + first])
+        if first < length:
+            data += bytes(self.buffer[self.HEADER.size:self.HEADER.size +
+                length - first])
+        return data
+
+class _FileLock(object):
+    """Holds an exclusive ``flock`` on a file descriptor, as a context
+    manager."""
+    def __init__(self, fd):
+        self.fd = fd
+
+    def __enter__(self):
+        import fcntl
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *args):
+        import fcntl
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+def _attach_shared_memory(name, size):
+    """Attach to the shared memory block with the given name, creating it if
+    it doesn't exist. The block is not tracked by Python's resource tracker,
+    which would otherwise destroy it when the first process using it exits.
+
+    :type name: string
+    :param name: The name of the shared memory block.
+
+    :type size: int
+    :param size: The size of the block, if it needs to be created.
+
+    :rtype: ~multiprocessing.shared_memory.SharedMemory
+    :returns: The shared memory block.
+    """
+    from multiprocessing import shared_memory, resource_tracker
+    try:
+        memory = shared_memory.SharedMemory(name=name, create=True,
+                size=size)
+    except FileExistsError:
+        memory = shared_memory.SharedMemory(name=name)
+    try:
+        resource_tracker.unregister(memory._name, "shared_memory")
+    except Exception:
+        pass
+    return memory
+
+class SocketChannel(object):
+    """A channel which streams metrics from clients straight to the agent over
+    persistent TCP connections, without a broker in between. Each metrics
+    object is sent as a frame: its length as a 4 byte big-endian integer
+    followed by the serialized metrics as UTF-8 JSON.
+
+    Clients buffer up to ``batch_size`` metrics and write them with a single
+    call; if ``batch_size`` is greater than 1, a background thread also writes
+    whatever is buffered every ``flush_interval`` seconds. With ``acks``
+    enabled, the client waits for the agent to acknowledge each write, so a
+    write only succeeds once the agent has the metrics. If a write fails the
+    metrics stay buffered (up to ``max_buffer_size`` of them, after which the
+    oldest are dropped) and are sent on the next attempt.
+
+    The agent listens on ``host`` and ``port`` once it starts receiving, and
+    serves every client connection from a single thread using
+    :mod:`selectors`, so the agent needs Python 3 (clients only need
+    :mod:`socket`). Received metrics are kept in the agent's memory until
+    they are published, so they are lost if the agent crashes.
+
+    :type host: string
+    :param host: The host the agent listens on and clients connect to.
+
+    :type port: int
+    :param port: The port the agent listens on and clients connect to.
+
+    :type logger: string
+    :param logger: The name of the logger to use.
+
+    :type batch_size: int
+    :param batch_size: The number of metrics the client buffers before
+                       writing them.
+
+    :type flush_interval: float
+    :param flush_interval: How often, in seconds, the client writes buffered
+                           metrics if ``batch_size`` is greater than 1.
+
+    :type max_buffer_size: int
+    :param max_buffer_size: The maximum number of metrics the client buffers
+                            while it can't reach the agent.
+
+    :type acks: bool
+    :param acks: Whether the client waits for the agent to acknowledge each
+                 write.
+
+    :type socket_timeout: float
+    :param socket_timeout: The timeout in seconds for the client connecting,
+                           writing and waiting for acknowledgements.
+
+    :type receive_timeout: int
+    :param receive_timeout: The number of seconds to wait for metrics when
+                            receiving.
+
+    :type max_frame_size: int
+    :param max_frame_size: The largest frame the agent accepts. Connections
+                           which send a larger frame are closed.
+    """
+
+    #: Default arguments for the socket channel. These will be used by the
+    #: client and agent to initialize this channel if custom configuration
+    #: values are not provided.
+    DEFAULT_ARGS = {
+            "host": "localhost",
+            "port": 6380,
+            "logger": "kadabra.channel",
+            "batch_size": 1,
+            "flush_interval": 0.1,
+            "max_buffer_size": 10000,
+            "acks": False,
+            "socket_timeout": 5,
+            "receive_timeout": 10,
+            "max_frame_size": 16 * 1024 * 1024
+    }
+
+    #: The header of each frame (and of each acknowledgement, which is the
+    #: number of frames received).
+    HEADER = struct.Struct(">I")
+
+    #: The first byte a client sends on a new connection, saying whether it
+    #: wants acknowledgements.
+    ACKS = b"A"
+    NO_ACKS = b"N"
+
+    def __init__(self, host, port, logger, batch_size=1, flush_interval=0.1,
+            max_buffer_size=10000, acks=False, socket_timeout=5,
+            receive_timeout=10, max_frame_size=16 * 1024 * 1024):
+        self.host = host
+        self.port = port
+        self.logger = logging.getLogger(logger)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer_size = max_buffer_size
+        self.acks = acks
+        self.socket_timeout = socket_timeout
+        self.receive_timeout = receive_timeout
+        self.max_frame_size = max_frame_size
+
+        self.lock = threading.Lock()
+        self.buffer = collections.deque()
+        self.dropped = 0
+        self.sock = None
+        self.flusher = None
+
+        self.queue = LocalQueue()
+        self.listener = None
+        self.dropped_connections = 0
+
+    def send(self, metrics):
+        """Send metrics to the agent. The metrics are buffered, and written
+        once there are ``batch_size`` of them.
+
+        :type metrics: ~kadabra.Metrics
+        :param metrics: The metrics to be sent.
+
+        :raises socket.error: If the buffer is full and couldn't be written to
+                              the agent. The metrics stay buffered.
+        """
+        data = json.dumps(metrics.serialize()).encode("utf-8")
+        with self.lock:
+            self.buffer.append(self.HEADER.pack(len(data)) + data)
+            while len(self.buffer) > self.max_buffer_size:
+                self.buffer.popleft()
+                self.dropped = self.dropped + 1
+            if len(self.buffer) >= self.batch_size:
+                self._flush()
+            elif self.flusher is None:
+                self.flusher = threading.Thread(target=self._run_flusher)
+                self.flusher.daemon = True
+                self.flusher.start()
+
+    def flush(self):
+        """Write any buffered metrics to the agent.
+
+        :raises socket.error: If the metrics couldn't be written. The metrics
+                              stay buffered.
+        """
+        with self.lock:
+            self._flush()
+
+    def receive(self):
+        """Receive metrics from clients so they can be published. Once
+        received, the metrics will be considered in progress until they have
+        been acknowledged as published (by calling
+        :meth:`~kadabra.channels.SocketChannel.complete`). This method will
+        block until there are metrics available or until the receive timeout.
+
+        :rtype: ~kadabra.Metrics
+        :returns: The metrics to be published, or None if there were no metrics
+                  received after the timeout.
+        """
+        self.listen()
+        batch = self.queue.get(1, self.receive_timeout)
+        return batch[0] if len(batch) > 0 else None
+
+    def receive_batch(self, max_batch_size):
+        """Receive a list of metrics from clients so they can be published,
+        without waiting if there are none.
+
+        :type max_batch_size: int
+        :param max_batch_size: The maximum number of metrics to receive in the
+                               batch.
+
+        :rtype: list
+        :returns: The list of metrics to be published. The size of the list is
+                  less than or equal to the ``max_batch_size``, and possibly
+                  empty if no metrics have been received.
+        """
+        self.listen()
+        return self.queue.get(max_batch_size)
+
+    def complete(self, metrics):
+        """Mark a list of metrics as completed, so they are no longer in
+        progress.
+
+        :type metrics: list
+        :param metrics: The list of :class:`~kadabra.Metrics` to mark as
+                        complete.
+        """
+        self.queue.complete(metrics)
+
+    def in_progress(self, query_limit):
+        """Return a list of the metrics that are in progress, oldest first.
+
+        :type query_limit: int
+        :param query_limit: The maximum number of metrics to return.
+
+        :rtype: list
+        :returns: A list of :class:`Metric`\s that are in progress.
+        """
+        return self.queue.in_progress(query_limit)
+
+    def stats(self):
+        """Return counts of the metrics and connections this channel has
+        dropped.
+
+        :rtype: dict
+        :returns: The number of metrics ``dropped`` by the client because its
+                  buffer was full, and the number of client connections the
+                  agent dropped because they sent something it couldn't read
+                  (``dropped_connections``).
+        """
+        with self.lock:
+            return {"dropped": self.dropped,
+                    "dropped_connections": self.dropped_connections}
+
+    def listen(self):
+        """Start listening for client connections, if the agent isn't already
+        listening. This is called automatically the first time metrics are
+        received."""
+        with self.lock:
+            if self.listener is None:
+                self.listener = _SocketListener(self)
+                self.listener.start()
+
+    def close(self):
+        """Stop listening for client connections and close the client's
+        connection to the agent."""
+        with self.lock:
+            if self.listener is not None:
+                self.listener.stop()
+                self.listener = None
+            self._disconnect()
+
+    def reset(self):
+        """Discard the connection and buffered metrics inherited from the
+        parent after the process has forked."""
+        with self.lock:
+            self.sock = None
+            self.buffer.clear()
+            self.flusher = None
+
+    def _run_flusher(self):
+        """Write buffered metrics every ``flush_interval`` seconds."""
+        while True:
+            time.sleep(self.flush_interval)
+            with self.lock:
+                if self.flusher is not threading.current_thread():
+                    return
+                try:
+                    self._flush()
+                except (socket.error, socket.timeout):
+                    self.logger.warning("Could not write %s metrics to the "
+                            "agent at %s:%s, will retry" % (len(self.buffer),
+                                self.host, self.port), exc_info=True)
+
+    def _flush(self):
+        """Write all the buffered metrics to the agent, reconnecting once if
+        the connection has gone away. The lock must be held."""
+        if len(self.buffer) == 0:
+            return
+        frames = list(self.buffer)
+        try:
+            self._write(frames)
+        except (socket.error, socket.timeout):
+            self._disconnect()
+            try:
+                self._write(frames)
+            except (socket.error, socket.timeout):
+                self._disconnect()
+                raise
+        for _ in frames:
+            self.buffer.popleft()
+
+    def _write(self, frames):
+        """Write frames to the agent, connecting first if needed, and wait for
+        the agent to acknowledge them if acks are enabled.
+
+        :type frames: list
+        :param frames: The list of frames to write.
+        """
+        if self.sock is None:
+            sock = socket.create_connection((self.host, self.port),
+                    self.socket_timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.sendall(self.ACKS if self.acks else self.NO_ACKS)
+            self.sock = sock
+        self.sock.sendall(b"".join(frames))
+        if self.acks:
+            acknowledged = 0
+            while acknowledged < len(frames):
+                acknowledged += self.HEADER.unpack(
+                        _read_exactly(self.sock, self.HEADER.size))[0]
+
+    def _disconnect(self):
+        """Close the client's connection to the agent, if it is open. The lock
+        must be held."""
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
+
+class DatagramChannel(object):
+    """A fire-and-forget channel which sends metrics to the agent in UDP or
+    Unix domain datagrams. Sending never blocks or waits for the agent, so
+    metrics can be lost: when the agent isn't running, when its socket buffer
+    is full, or (for UDP) on the network. Use it for metrics where losing a few
+    points is acceptable.
+
+    Each metrics object is encoded as a frame: its length as a 4 byte
+    big-endian integer followed by the serialized metrics as UTF-8 JSON. If
+    ``flush_interval`` is greater than 0, the client packs as many frames as
+    fit into ``max_datagram_size`` bytes into each datagram, and a background
+    thread sends whatever is left every ``flush_interval`` seconds; otherwise
+    each metrics object is sent in its own datagram straight away. Metrics
+    which are too large for a datagram are dropped. The client and agent count
+    what they drop (see :meth:`~kadabra.channels.DatagramChannel.stats`).
+
+    The agent binds the socket once it starts receiving, and reads it in a
+    background thread. Received metrics are kept in the agent's memory until
+    they are published.
+
+    :type host: string
+    :param host: The host the agent listens on and clients send to, for UDP.
+
+    :type port: int
+    :param port: The port the agent listens on and clients send to, for UDP.
+
+    :type logger: string
+    :param logger: The name of the logger to use.
+
+    :type unix_socket_path: string
+    :param unix_socket_path: If set, use a Unix domain datagram socket at this
+                             path instead of UDP.
+
+    :type max_datagram_size: int
+    :param max_datagram_size: The largest datagram to send, in bytes. The
+                              default fits in a single Ethernet frame.
+
+    :type flush_interval: float
+    :param flush_interval: How often, in seconds, to send partly filled
+                           datagrams, or 0 to send each metrics object
+                           straight away.
+
+    :type receive_timeout: int
+    :param receive_timeout: The number of seconds to wait for metrics when
+                            receiving.
+
+    :type receive_buffer_size: int
+    :param receive_buffer_size: If set, the size of the agent's socket receive
+                                buffer. A larger buffer drops fewer datagrams
+                                during bursts.
+    """
+
+    #: Default arguments for the datagram channel. These will be used by the
+    #: client and agent to initialize this channel if custom configuration
+    #: values are not provided.
+    DEFAULT_ARGS = {
+            "host": "localhost",
+            "port": 6381,
+            "logger": "kadabra.channel",
+            "unix_socket_path": None,
+            "max_datagram_size": 1400,
+            "flush_interval": 0,
+            "receive_timeout": 10,
+            "receive_buffer_size": None
+    }
+
+    #: The header of each frame in a datagram.
+    HEADER = struct.Struct(">I")
+
+    def __init__(self, host, port, logger, unix_socket_path=None,
+            max_datagram_size=1400, flush_interval=0, receive_timeout=10,
+            receive_buffer_size=None):
+        self.host = host
+        self.port = port
+        self.logger = logging.getLogger(logger)
+        self.unix_socket_path = unix_socket_path
+        self.max_datagram_size = max_datagram_size
+        self.flush_interval = flush_interval
+        self.receive_timeout = receive_timeout
+        self.receive_buffer_size = receive_buffer_size
+
+        self.lock = threading.Lock()
+        self.sock = None
+        self.pending = bytearray()
+        self.pending_count = 0
+        self.flusher = None
+        self.counts = collections.Counter()
+
+        self.queue = LocalQueue()
+        self.listener = None
+
+    def send(self, metrics):
+        """Send metrics to the agent, without waiting. If the metrics can't be
+        sent they are dropped and counted.
+
+        :type metrics: ~kadabra.Metrics
+        :param metrics: The metrics to be sent.
+        """
+        data = json.dumps(metrics.serialize()).encode("utf-8")
+        frame = self.HEADER.pack(len(data)) + data
+        with self.lock:
+            if len(frame) > self.max_datagram_size:
+                self.counts["too_large"] += 1
+                return
+            if self.flush_interval <= 0:
+                self._send(frame, 1)
+                return
+            if len(self.pending) + len(frame) > self.max_datagram_size:
+                self._flush()
+            self.pending.extend(frame)
+            self.pending_count += 1
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self._run_flusher)
+                self.flusher.daemon = True
+                self.flusher.start()
+
+    def flush(self):
+        """Send any metrics packed into a partly filled datagram."""
+        with self.lock:
+            self._flush()
+
+    def receive(self):
+        """Receive metrics from clients so they can be published. Once
+        received, the metrics will be considered in progress until they have
+        been acknowledged as published (by calling
+        :meth:`~kadabra.channels.DatagramChannel.complete`). This method will
+        block until there are metrics available or until the receive timeout.
+
+        :rtype: ~kadabra.Metrics
+        :returns: The metrics to be published, or None if there were no metrics
+                  received after the timeout.
+        """
+        self.listen()
+        batch = self.queue.get(1, self.receive_timeout)
+        return batch[0] if len(batch) > 0 else None
+
+    def receive_batch(self, max_batch_size):
+        """Receive a list of metrics from clients so they can be published,
+        without waiting if there are none.
+
+        :type max_batch_size: int
+        :param max_batch_size: The maximum number of metrics to receive in the
+                               batch.
+
+        :rtype: list
+        :returns: The list of metrics to be published. The size of the list is
+                  less than or equal to the ``max_batch_size``, and possibly
+                  empty if no metrics have been received.
+        """
+        self.listen()
+        return self.queue.get(max_batch_size)
+
+    def complete(self, metrics):
+        """Mark a list of metrics as completed, so they are no longer in
+        progress.
+
+        :type metrics: list
+        :param metrics: The list of :class:`~kadabra.Metrics` to mark as
+                        complete.
+        """
+        self.queue.complete(metrics)
+
+    def in_progress(self, query_limit):
+        """Return a list of the metrics that are in progress, oldest first.
+
+        :type query_limit: int
+        :param query_limit: The maximum number of metrics to return.
+
+        :rtype: list
+        :returns: A list of :class:`Metric`\s that are in progress.
+        """
+        return self.queue.in_progress(query_limit)
+
+    def stats(self):
+        """Return counts of the metrics this channel has sent, received and
+        dropped.
+
+        :rtype: dict
+        :returns: The number of metrics ``sent`` by the client, dropped by the
+                  client because they were ``too_large`` for a datagram or the
+                  send ``failed``, ``received`` by the agent, and ``truncated``
+                  (received incomplete or unreadable) by the agent.
+        """
+        with self.lock:
+            return dict((k, self.counts[k]) for k in
+                    ("sent", "too_large", "failed", "received", "truncated"))
+
+    def listen(self):
+        """Bind the agent's socket and start reading datagrams, if the agent
+        isn't already. This is called automatically the first time metrics are
+        received."""
+        with self.lock:
+            if self.listener is None:
+                self.listener = _DatagramListener(self)
+                self.listener.start()
+
+    def close(self):
+        """Stop reading datagrams, and close the client's socket."""
+        with self.lock:
+            if self.listener is not None:
+                self.listener.stop()
+                self.listener = None
+            if self.sock is not None:
+                self.sock.close()
+                self.sock = None
+
+    def reset(self):
+        """Discard the socket and partly filled datagram inherited from the
+        parent after the process has forked."""
+        with self.lock:
+            self.sock = None
+            self.pending = bytearray()
+            self.pending_count = 0
+            self.flusher = None
+
+    def _address(self):
+        """Return the address the agent listens on."""
+        if self.unix_socket_path is not None:
+            return self.unix_socket_path
+        return (self.host, self.port)
+
+    def _socket(self):
+        """Return a new socket of the right family for this channel."""
+        if self.unix_socket_path is not None:
+            return socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        family = socket.getaddrinfo(self.host, self.port, 0,
+                socket.SOCK_DGRAM)[0][0]
+        return socket.socket(family, socket.SOCK_DGRAM)
+
+    def _run_flusher(self):
+        """Send partly filled datagrams every ``flush_interval`` seconds."""
+        while True:
+            time.sleep(self.flush_interval)
+            with self.lock:
+                if self.flusher is not threading.current_thread():
+                    return
+                self._flush()
+
+    def _flush(self):
+        """Send the partly filled datagram, if there is one. The lock must be
+        held."""
+        if len(self.pending) > 0:
+            self._send(bytes(self.pending), self.pending_count)
+            self.pending = bytearray()
+            self.pending_count = 0
+
+    def _send(self, datagram, count):
+        """Send a datagram without blocking, counting its metrics as sent or
+        failed. The lock must be held.
+
+        :type datagram: bytes
+        :param datagram: The datagram to send.
+
+        :type count: int
+        :param count: The number of metrics in the datagram.
+        """
+        try:
+            if self.sock is None:
+                self.sock = self._socket()
+                self.sock.setblocking(False)
+            self.sock.sendto(datagram, self._address())
+            self.counts["sent"] += count
+        except socket.error:
+            self.counts["failed"] += count
+
+class _DatagramListener(object):
+    """Reads datagrams for a :class:`~kadabra.channels.DatagramChannel` in a
+    background thread.
+
+    :type channel: ~kadabra.channels.DatagramChannel
+    :param channel: The channel to put received metrics on.
+    """
+    def __init__(self, channel):
+        self.channel = channel
+        self.sock = channel._socket()
+        if channel.receive_buffer_size is not None:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                    channel.receive_buffer_size)
+        if channel.unix_socket_path is not None and\
+                os.path.exists(channel.unix_socket_path):
+            os.unlink(channel.unix_socket_path)
+        self.sock.bind(channel._address())
+        self.sock.settimeout(0.1)
+        self.address = self.sock.getsockname()
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        self.thread.join()
+        self.sock.close()
+
+    def _run(self):
+        # Read one byte more than the largest datagram, so that datagrams
+        # which were truncated to fit the buffer can be told apart.
+        buf = bytearray(max(self.channel.max_datagram_size, 65535) + 1)
+        while not self.stopped:
+            try:
+                size = self.sock.recv_into(buf)
+            except socket.timeout:
+                continue
+            except socket.error:
+                self.channel.logger.warning("Error reading a datagram",
+                        exc_info=True)
+                continue
+            metrics, truncated = self._parse(memoryview(buf)[:size],
+                    size == len(buf))
+            with self.channel.lock:
+                self.channel.counts["received"] += len(metrics)
+                self.channel.counts["truncated"] += truncated
+            if len(metrics) > 0:
+                self.channel.queue.put(metrics)
+
+    def _parse(self, datagram, cut_off):
+        """Parse the frames in a datagram.
+
+        :type datagram: memoryview
+        :param datagram: The datagram.
+
+        :type cut_off: bool
+        :param cut_off: Whether the datagram filled the whole buffer, and so
+                        may have been cut off.
+
+        :rtype: tuple
+        :returns: The list of :class:`~kadabra.Metrics` and the number of
+                  frames which were truncated or couldn't be read.
+        """
+        header = DatagramChannel.HEADER
+        metrics = []
+        truncated = 0
+        offset = 0
+        while offset < len(datagram):
+            if len(datagram) - offset < header.size:
+                truncated += 1
+                break
+            length = header.unpack_from(datagram, offset)[0]
+            start = offset + header.size
+            if start + length > len(datagram):
+                truncated += 1
+                break
+            try:
+                metrics.append(Metrics.deserialize(json.loads(
+                    bytes(datagram[start:start + length]).decode("utf-8"))))
+            except Exception:
+                # Anyone can send to the port, so a frame which can't be
+                # read as metrics is counted rather than allowed to stop the
+                # listener.
+                truncated += 1
+            offset = start + length
+        if cut_off and truncated == 0:
+            truncated = 1
+        return metrics, truncated
+
+class _SocketListener(object):
+    """Accepts client connections for a
+    :class:`~kadabra.channels.SocketChannel` and reads metrics from them in a
+    background thread.
+
+    :type channel: ~kadabra.channels.SocketChannel
+    :param channel: The channel to put received metrics on.
+    """
+    def __init__(self, channel):
+        import selectors
+        self.channel = channel
+        self.selector = selectors.DefaultSelector()
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((channel.host, channel.port))
+        self.server.listen(1024)
+        self.server.setblocking(False)
+        self.selector.register(self.server, selectors.EVENT_READ, None)
+        self.address = self.server.getsockname()
+        self.stopped = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        self.thread.join()
+
+    def _run(self):
+        import selectors
+        while not self.stopped:
+            for key, events in self.selector.select(0.1):
+                if key.data is None:
+                    self._accept()
+                    continue
+                try:
+                    if events & selectors.EVENT_READ:
+                        self._read(key.fileobj, key.data)
+                    if events & selectors.EVENT_WRITE:
+                        self._write(key.fileobj, key.data)
+                except Exception:
+                    # Whatever one client sends, only its own connection is
+                    # dropped, so the others keep being served.
+                    self.channel.logger.warning("Dropping connection from a "
+                            "client", exc_info=True)
+                    with self.channel.lock:
+                        self.channel.dropped_connections += 1
+                    self._close(key.fileobj)
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+        self.selector.close()
+
+    def _accept(self):
+        import selectors
+        try:
+            sock, _ = self.server.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        except socket.error:
+            # For example, too many open files. The connection stays in the
+            # backlog, so wait a little before trying to accept it again.
+            self.channel.logger.warning("Error accepting a connection",
+                    exc_info=True)
+            time.sleep(0.1)
+            return
+        sock.setblocking(False)
+        self.selector.register(sock, selectors.EVENT_READ,
+                _SocketConnection())
+
+    def _read(self, sock, connection):
+        data = sock.recv(65536)
+        if not data:
+            self._close(sock)
+            return
+        connection.incoming.extend(data)
+        if connection.acks is None:
+            connection.acks = bytes(connection.incoming[:1]) ==\
+                    SocketChannel.ACKS
+            del connection.incoming[:1]
+
+        header = SocketChannel.HEADER
+        incoming = connection.incoming
+        metrics = []
+        offset = 0
+        while len(incoming) - offset >= header.size:
+            length = header.unpack_from(incoming, offset)[0]
+            if length > self.channel.max_frame_size:
+                raise ValueError("Frame of %s bytes is too large" % length)
+            if len(incoming) - offset - header.size < length:
+                break
+            start = offset + header.size
+            metrics.append(Metrics.deserialize(json.loads(
+                bytes(incoming[start:start + length]).decode("utf-8"))))
+            offset = start + length
+        del incoming[:offset]
+
+        if len(metrics) > 0:
+            self.channel.queue.put(metrics)
+            if connection.acks:
+                connection.outgoing.extend(header.pack(len(metrics)))
+                self._write(sock, connection)
+
+    def _write(self, sock, connection):
+        import selectors
+        if len(connection.outgoing) > 0:
+            try:
+                sent = sock.send(connection.outgoing)
+                del connection.outgoing[:sent]
+            except (BlockingIOError, InterruptedError):
+                pass
+        events = selectors.EVENT_READ
+        if len(connection.outgoing) > 0:
+            events = events | selectors.EVENT_WRITE
+        self.selector.modify(sock, events, connection)
+
+    def _close(self, sock):
+        try:
+            self.selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+        sock.close()
+
+class _SocketConnection(object):
+    """The state of a client connection to a
+    :class:`~kadabra.channels.SocketChannel` listener."""
+    def __init__(self):
+        self.acks = None
+        self.incoming = bytearray()
+        self.outgoing = bytearray()
+
+def _read_exactly(sock, size):
+    """Read exactly ``size`` bytes from a blocking socket.
+
+    :raises socket.error: If the connection is closed first.
+    """
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise socket.error("Connection closed by the agent")
+        data += chunk
+    return data
+
+class LocalQueue(object):
+    """A thread-safe queue of metrics held in memory, along with the metrics
+    which have been taken from it and are in progress. It is used by channels
+    which hand metrics to the agent within a single process.
+
+    In-progress metrics are tracked by identity, so they must be completed
+    with the same :class:`~kadabra.Metrics` instances that were received.
+    """
+    def __init__(self):
+        self.queue = collections.deque()
+        self.in_flight = collections.OrderedDict()
+        self.condition = threading.Condition()
+
+    def put(self, metrics):
+        """Add metrics to the end of the queue.
+
+        :type metrics: list
+        :param metrics: The list of :class:`~kadabra.Metrics` to add.
+        """
+        with self.condition:
+            self.queue.extend(metrics)
+            self.condition.notify_all()
+
+    def get(self, max_size, timeout=None):
+        """Take metrics from the front of the queue and mark them as in
+        progress.
+
+        :type max_size: int
+        :param max_size: The maximum number of metrics to take.
+
+        :type timeout: int
+        :param timeout: If specified, the number of seconds to wait for
+                        metrics if the queue is empty. Otherwise, this method
+                        doesn't wait.
+
+        :rtype: list
+        :returns: The list of metrics taken from the queue, possibly empty.
+        """
+        with self.condition:
+            if len(self.queue) == 0 and timeout:
+                self.condition.wait(timeout)
+            batch = []
+            while len(batch) < max_size and len(self.queue) > 0:
+                m = self.queue.popleft()
+                self.in_flight[id(m)] = m
+                batch.append(m)
+            return batch
+
+    def complete(self, metrics):
+        """Remove metrics from the in-progress metrics.
+
+        :type metrics: list
+        :param metrics: The list of :class:`~kadabra.Metrics` to complete.
+        """
+        with self.condition:
+            for m in metrics:
+                self.in_flight.pop(id(m), None)
+
+    def in_progress(self, query_limit):
+        """Return the metrics which are in progress, oldest first.
+
+        :type query_limit: int
+        :param query_limit: The maximum number of metrics to return.
+
+        :rtype: list
+        :returns: The list of in-progress metrics.
+        """
+        with self.condition:
+            return list(itertools.islice(self.in_flight.values(), query_limit))
+
+    def __len__(self):
+        with self.condition:
+            return len(self.queue)
+
+class SpoolChannel(object):
+    """A channel which spools metrics to log files on local disk, for hosts
+    where running Redis isn't desirable. Clients append metrics to the current
+    segment file without any network hop, and several client processes on the
+    same host can write to the same spool, coordinated by a lock file. Once a
+    segment reaches the segment size, the next write starts a new one.
+
+    The agent memory-maps the segments and reads them in order. It persists
+    its read offset, and an acknowledgement watermark below which every
+    metrics has been completed, to a state file in the spool directory.
+    Segments entirely below the watermark are deleted. If the agent restarts,
+    metrics between the watermark and the read offset are treated as in
+    progress (so the nanny will republish them) and reading resumes from the
+    read offset. The state file is written at most once per
+    ``checkpoint_interval``, so after a crash some metrics may be received
+    again; like the other channels, delivery is at least once. Each record is
+    copied out of the memory map as it is read, since the map is replaced
+    whenever a segment grows. Records which can't be read as metrics (for
+    example, left half written by a client which crashed) are logged, counted
+    and skipped.
+
+    Only one agent may read from a spool at a time. Requires a POSIX
+    platform.
+
+    :type path: string
+    :param path: The directory to spool metrics in. It is created if it
+                 doesn't exist.
+
+    :type logger: string
+    :param logger: The name of the logger to use.
+
+    :type segment_size: int
+    :param segment_size: The size in bytes after which a new segment file is
+                         started.
+
+    :type fsync: bool
+    :param fsync: Whether to fsync each write. Without it, spooled metrics
+                  survive the process crashing but not the host crashing.
+
+    :type receive_timeout: int
+    :param receive_timeout: The number of seconds to wait for metrics when
+                            receiving.
+
+    :type poll_interval: float
+    :param poll_interval: How often, in seconds, to check for new metrics
+                          while waiting.
+
+    :type checkpoint_interval: float
+    :param checkpoint_interval: The minimum number of seconds between writes
+                                of the state file.
+    """
+
+    #: Default arguments for the spool channel. These will be used by the
+    #: client and agent to initialize this channel if custom configuration
+    #: values are not provided.
+    DEFAULT_ARGS = {
+            "path": "/var/spool/kadabra",
+            "logger": "kadabra.channel",
+            "segment_size": 64 * 1024 * 1024,
+            "fsync": False,
+            "receive_timeout": 10,
+            "poll_interval": 0.1,
+            "checkpoint_interval": 1.0
+    }
+
+    #: Each record in a segment is the length of the payload followed by the
+    #: payload (serialized metrics as UTF-8 JSON).
+    HEADER = struct.Struct(">I")
+
+    SEGMENT_SUFFIX = ".spool"
+
+    def __init__(self, path, logger, segment_size=64 * 1024 * 1024,
+            fsync=False, receive_timeout=10, poll_interval=0.1,
+            checkpoint_interval=1.0):
+        self.path = path
+        self.logger = logging.getLogger(logger)
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.receive_timeout = receive_timeout
+        self.poll_interval = poll_interval
+        self.checkpoint_interval = checkpoint_interval
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
+        self.write_lock = threading.Lock()
+        self.write_lock_fd = None
+        self.write_segment = None
+        self.write_fd = None
+
+        self.read_lock = threading.Lock()
+        self.read_lock_fd = None
+        self.read_position = None
+        self.mapped_segment = None
+        self.mapped = None
+        self.in_flight = collections.OrderedDict()
+        self.positions = {}
+        self.checkpointed_at = 0
+        self.unreadable = 0
+
+    def send(self, metrics):
+        """Send metrics by appending them to the current segment of the spool.
+
+        :type metrics: ~kadabra.Metrics
+        :param metrics: The metrics to be sent.
+        """
+        import fcntl
+        data = json.dumps(metrics.serialize()).encode("utf-8")
+        record = self.HEADER.pack(len(data)) + data
+        with self.write_lock:
+            if self.write_lock_fd is None:
+                self.write_lock_fd = os.open(
+                        os.path.join(self.path, "write.lock"),
+                        os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(self.write_lock_fd, fcntl.LOCK_EX)
+            try:
+                self._rotate()
+                os.write(self.write_fd, record)
+                if self.fsync:
+                    os.fsync(self.write_fd)
+            finally:
+                fcntl.flock(self.write_lock_fd, fcntl.LOCK_UN)
+
+    def receive(self):
+        """Receive metrics from the spool so they can be published. Once
+        received, the metrics will be considered in progress until they have
+        been acknowledged as published (by calling
+        :meth:`~kadabra.channels.SpoolChannel.complete`). This method will
+        block until there are metrics available or until the receive timeout.
+
+        :rtype: ~kadabra.Metrics
+        :returns: The metrics to be published, or None if there were no metrics
+                  received after the timeout.
+        """
+        deadline = time.time() + self.receive_timeout
+        while True:
+            batch = self.receive_batch(1)
+            if len(batch) > 0:
+                return batch[0]
+            if time.time() >= deadline:
+                return None
+            time.sleep(self.poll_interval)
+
+    def receive_batch(self, max_batch_size):
+        """Receive a list of metrics from the spool so they can be published,
+        without waiting if there are none.
+
+        :type max_batch_size: int
+        :param max_batch_size: The maximum number of metrics to receive in the
+                               batch.
+
+        :rtype: list
+        :returns: The list of metrics to be published. The size of the list is
+                  less than or equal to the ``max_batch_size``, and possibly
+                  empty if there are no new metrics in the spool.
+        """
+        with self.read_lock:
+            self._open_reader()
+            batch = self._read(max_batch_size)
+            if len(batch) > 0:
+                self._checkpoint()
+            return batch
+
+    def complete(self, metrics):
+        """Mark a list of metrics as completed. This advances the
+        acknowledgement watermark past any metrics at the start of the spool
+        which have all been completed, and deletes segments which are entirely
+        below it.
+
+        :type metrics: list
+        :param metrics: The list of :class:`~kadabra.Metrics` to mark as
+                        complete.
+        """
+        with self.read_lock:
+            for m in metrics:
+                position = self.positions.pop(id(m), None)
+                if position is not None:
+                    self.in_flight.pop(position, None)
+            self._checkpoint()
+
+    def in_progress(self, query_limit):
+        """Return a list of the metrics that are in progress, oldest first.
+
+        :type query_limit: int
+        :param query_limit: The maximum number of metrics to return.
+
+        :rtype: list
+        :returns: A list of :class:`Metric`\s that are in progress.
+        """
+        with self.read_lock:
+            self._open_reader()
+            return list(itertools.islice(self.in_flight.values(),
+                query_limit))
+
+    def stats(self):
+        """Return the number of records the agent has skipped because they
+        couldn't be read as metrics.
+
+        :rtype: dict
+        :returns: The number of ``unreadable`` records.
+        """
+        with self.read_lock:
+            return {"unreadable": self.unreadable}
+
+    def reset(self):
+        """Close the files inherited from a parent process after a fork, so
+        the child opens its own. In particular, ``flock`` locks are shared by
+        file descriptors inherited across a fork, so sharing them would let
+        parent and child write at the same time."""
+        with self.write_lock:
+            for fd in (self.write_lock_fd, self.write_fd):
+                if fd is not None:
+                    os.close(fd)
+            self.write_lock_fd = None
+            self.write_fd = None
+            self.write_segment = None
+
+    def _rotate(self):
+        """Make sure the write file descriptor points to a segment which isn't
+        full yet, starting a new segment if the last one is full. Must be
+        called with the write lock file locked."""
+        if self.write_fd is not None and\
+                os.fstat(self.write_fd).st_size < self.segment_size:
+            return
+        segments = self._segments()
+        segment = segments[-1] if len(segments) > 0 else 0
+        path = self._segment_path(segment)
+        if os.path.exists(path) and\
+                os.path.getsize(path) >= self.segment_size:
+            segment += 1
+        if self.write_fd is not None:
+            os.close(self.write_fd)
+        self.write_fd = os.open(self._segment_path(segment),
+                os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.write_segment = segment
+
+    def _open_reader(self):
+        """Take the reader lock and load the persisted state the first time
+        metrics are read. Metrics between the acknowledgement watermark and
+        the read offset are loaded as in progress."""
+        if self.read_lock_fd is not None:
+            return
+        import fcntl
+        fd = os.open(os.path.join(self.path, "read.lock"),
+                os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            os.close(fd)
+            raise Exception("Another agent is reading from spool '%s'" %\
+                    self.path)
+        self.read_lock_fd = fd
+
+        state = self._load_state()
+        if state is None:
+            segments = self._segments()
+            start = (segments[0] if len(segments) > 0 else 0, 0)
+            state = {"ack": start, "read": start}
+        self.read_position = tuple(state["ack"])
+        read = tuple(state["read"])
+        while self.read_position < read:
+            if len(self._read(1)) == 0:
+                break
+        self.logger.info("Opened spool '%s' at %s with %s metrics in "
+                "progress" % (self.path, self.read_position,
+                    len(self.in_flight)))
+
+    def _read(self, max_count):
+        """Read the next records from the spool and mark them as in progress.
+        The read position is advanced past each record as it is handled, and
+        records which can't be read are skipped, so that they don't stop the
+        records after them from being read.
+
+        :type max_count: int
+        :param max_count: The maximum number of records to read.
+
+        :rtype: list
+        :returns: The list of :class:`~kadabra.Metrics` read.
+        """
+        batch = []
+        while len(batch) < max_count:
+            segment, offset = self.read_position
+            start = offset + self.HEADER.size
+            view = self._map_full(segment, start)
+            if view is None:
+                if not self._segment_finished(segment):
+                    break
+                self.read_position = (segment + 1, 0)
+                continue
+            end = start + self.HEADER.unpack_from(view, offset)[0]
+            view = self._map_full(segment, end)
+            if view is None:
+                if not self._segment_finished(segment):
+                    # The record is still being written.
+                    break
+                self.logger.warn("Skipping a record cut off at the end of "
+                        "segment %s" % segment)
+                self.unreadable += 1
+                self.read_position = (segment + 1, 0)
+                continue
+            data = view[start:end]
+            self.read_position = (segment, end)
+            try:
+                metrics = Metrics.deserialize(json.loads(
+                    data.decode("utf-8")))
+            except Exception:
+                self.logger.warn("Skipping unreadable record at %s" %\
+                        ((segment, offset),), exc_info=1)
+                self.unreadable += 1
+                continue
+            batch.append(self._track((segment, offset), metrics))
+        return batch
+
+    def _map_full(self, segment, size):
+        """Get a memory map of a segment which is at least the given size,
+        mapping it again if the next segment has been started, since this one
+        may have been appended to before it filled up.
+
+        :rtype: mmap.mmap
+        :returns: The memory map, or None if the segment isn't that large.
+        """
+        view = self._map(segment, size)
+        if view is None and self._segment_finished(segment):
+            view = self._map(segment, size)
+        return view
+
+    def _segment_finished(self, segment):
+        """Return whether a segment won't be written to any more, which is
+        the case once the next segment exists."""
+        return os.path.exists(self._segment_path(segment + 1))
+
+    def _map(self, segment, size):
+        """Get a memory map of a segment which is at least the given size,
+        remapping the segment if it has grown since it was mapped.
+
+        :type segment: int
+        :param segment: The segment number.
+
+        :type size: int
+        :param size: The minimum size needed.
+
+        :rtype: mmap.mmap
+        :returns: The memory map, or None if the segment isn't that large.
+        """
+        if self.mapped_segment == segment and len(self.mapped) >= size:
+            return self.mapped
+        path = self._segment_path(segment)
+        try:
+            file_size = os.path.getsize(path)
+        except OSError:
+            return None
+        if file_size < size or file_size == 0:
+            return None
+        if self.mapped is not None:
+            self.mapped.close()
+        with open(path, "rb") as f:
+            self.mapped = mmap.mmap(f.fileno(), file_size,
+                    access=mmap.ACCESS_READ)
+        self.mapped_segment = segment
+        return self.mapped
+
+    def _track(self, position, metrics):
+        """Mark metrics read from the spool as in progress.
+
+        :type position: tuple
+        :param position: The (segment, offset) of the record.
+
+        :type metrics: ~kadabra.Metrics
+        :param metrics: The metrics read from the record.
+
+        :rtype: ~kadabra.Metrics
+        :returns: The metrics.
+        """
+        self.in_flight[position] = metrics
+        self.positions[id(metrics)] = position
+        return metrics
+
+    def _checkpoint(self):
+        """Persist the read position and acknowledgement watermark, and delete
+        segments below the watermark, if the checkpoint interval has
+        passed."""
+        now = time.time()
+        if now - self.checkpointed_at < self.checkpoint_interval:
+            return
+        self.checkpointed_at = now
+
+        if len(self.in_flight) > 0:
+            ack = next(iter(self.in_flight))
+        else:
+            ack = self.read_position
+        state_path = os.path.join(self.path, "state.json")
+        with open(state_path + ".tmp", "w") as f:
+            json.dump({"ack": list(ack), "read": list(self.read_position)},
+                    f)
+        os.rename(state_path + ".tmp", state_path)
+
+        for segment in self._segments():
+            if segment >= ack[0]:
+                break
+            self.logger.debug("Deleting acknowledged segment %s" % segment)
+            os.remove(self._segment_path(segment))
+
+    def _load_state(self):
+        """Load the persisted state, if there is any.
+
+        :rtype: dict
+        :returns: The state, with ``ack`` and ``read`` positions, or None.
+        """
+        try:
+            with open(os.path.join(self.path, "state.json")) as f:
+                return json.load(f)
+        except (IOError, OSError):
+            return None
+
+    def _segments(self):
+        """List the segment numbers in the spool, in order.
+
+        :rtype: list
+        :returns: The segment numbers.
+        """
+        return sorted(int(name[:-len(self.SEGMENT_SUFFIX)])
+                for name in os.listdir(self.path)
+                if name.endswith(self.SEGMENT_SUFFIX))
+
+    def _segment_path(self, segment):
+        """Get the path of a segment file.
+
+        :type segment: int
+        :param segment: The segment number.
+
+        :rtype: string
+        :returns: The path of the segment file.
+        """
+        return os.path.join(self.path,
+                "%016d%s" % (segment, self.SEGMENT_SUFFIX))
+
+_local_queues = {}
+_local_queues_lock = threading.Lock()
+
+def _sha1(payload):
+    """Helper to hash a Redis payload the same way as ``redis.sha1hex`` does
+    in Lua scripts.
+
+    :type payload: string
+    :param payload: The payload, as text or bytes.
+
+    :rtype: string
+    :returns: The hex SHA1 of the payload's bytes.
+    """
+    if not isinstance(payload, bytes):
+        payload = payload.encode("utf-8")
+    return hashlib.sha1(payload).hexdigest()
+
+def _now_ms():
+    """Helper to get the current time in milliseconds, as scored in the
+    retry sorted set.
+
+    :rtype: int
+    :returns: The milliseconds since the epoch.
+    """
+    return int(time.time() * 1000)
+
+def get_local_queue(name):
+    """Get the :class:`~kadabra.channels.LocalQueue` with the given name,
+    creating it if it doesn't exist yet.
+
+    :type name: string
+    :param name: The name of the queue.
+
+    :rtype: ~kadabra.channels.LocalQueue
+    :returns: The queue.
+    """
+    with _local_queues_lock:
+        if name not in _local_queues:
+            _local_queues[name] = LocalQueue()
+        return _local_queues[name]
+
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+
+def get_connection_pool(host, port, db, unix_socket_path=None,
+        max_connections=None, pool_timeout=20, socket_timeout=None,
+        socket_connect_timeout=None, socket_keepalive=False,
+        health_check_interval=0):
+    """Get a Redis connection pool for the given settings. Pools are shared by
+    every channel in the process which uses the same settings, so that (for
+    example) a client and an agent running in the same process, or several
+    :class:`~kadabra.Kadabra` instances, don't each hold their own connections.
+    See :class:`~kadabra.channels.RedisChannel` for a description of the
+    arguments.
+
+    :rtype: ~redis.ConnectionPool
+    :returns: The connection pool.
+    """
+    from redis import ConnectionPool, BlockingConnectionPool,\
+            UnixDomainSocketConnection
+
+    kwargs = {"db": db, "socket_timeout": socket_timeout,
+            "socket_connect_timeout": socket_connect_timeout}
+    if unix_socket_path is not None:
+        kwargs["connection_class"] = UnixDomainSocketConnection
+        kwargs["path"] = unix_socket_path
+    else:
+        kwargs["host"] = host
+        kwargs["port"] = port
+        kwargs["socket_keepalive"] = socket_keepalive
+    if health_check_interval:
+        kwargs["health_check_interval"] = health_check_interval
+    if max_connections is not None:
+        pool_class = BlockingConnectionPool
+        kwargs["max_connections"] = max_connections
+        kwargs["timeout"] = pool_timeout
+    else:
+        pool_class = ConnectionPool
+
+    key = (pool_class, tuple(sorted(kwargs.items(), key=lambda kv: kv[0])))
+    with _connection_pools_lock:
+        if key not in _connection_pools:
+            _connection_pools[key] = pool_class(**kwargs)
+        return _connection_pools[key]
+
+def _create_cluster_client(startup_nodes):
+    """Create a Redis Cluster client, using redis-py's cluster support if it is
+    available and falling back to the ``redis-py-cluster`` package.
+
+    :type startup_nodes: list
+    :param startup_nodes: A list of dictionaries with the ``host`` and
+                          ``port`` of nodes in the cluster.
+
+    :rtype: ~redis.cluster.RedisCluster
+    :returns: The cluster client.
+    """
+    try:
+        from redis.cluster import RedisCluster, ClusterNode
+    except ImportError:
+        from rediscluster import RedisCluster
+        return RedisCluster(startup_nodes=startup_nodes)
+    return RedisCluster(startup_nodes=[ClusterNode(n["host"], n["port"])
+        for n in startup_nodes])
+
+class StringDictionary(object):
+    """An append-only dictionary which maps strings to small integer IDs,
+    shared by clients and agents through Redis. It is used by the
+    :class:`~kadabra.channels.RedisChannel` to avoid repeating the same metric
+    names and dimensions in every payload. IDs are assigned atomically by a Lua
+    script and never change once assigned, so they are cached in-process
+    indefinitely.
+
+    Strings are only sent as literals once the dictionary is full, and since
+    the dictionary never changes after that, encoding the same metrics always
+    yields the same payload.
+
+    :type client: ~redis.StrictRedis
+    :param client: The Redis client to use.
+
+    :type key: string
+    :param key: The key of the Redis hash mapping strings to IDs. The reverse
+                mapping is stored at this key with ``:ids`` appended.
+
+    :type max_size: int
+    :param max_size: The maximum number of strings in the dictionary.
+    """
+
+    #: Returns the ID for a string, assigning the next ID if the string isn't
+    #: in the dictionary yet, or -1 if the dictionary is full.
+    ASSIGN_SCRIPT = """
+        local id = redis.call('HGET', KEYS[1], ARGV[1])
+        if id then
+            return tonumber(id)
+        end
+        local size = redis.call('HLEN', KEYS[1])
+        if size >= tonumber(ARGV[2]) then
+            return -1
+        end
+        redis.call('HSET', KEYS[1], ARGV[1], size)
+        redis.call('HSET', KEYS[2], size, ARGV[1])
+        return size
+    """
+
+    def __init__(self, client, key, max_size):
+        self.client = client
+        self.key = key
+        self.ids_key = key + ":ids"
+        self.max_size = max_size
+
+        self.ids = {}
+        self.strings = {}
+        self.full = False
+        self.assign_script = None
+
+    def encode(self, serialized):
+        """Replace the metric names, dimension names and dimension values of
+        serialized metrics with their IDs. Values which are not strings are
+        wrapped in a list so they aren't mistaken for IDs.
+
+        :type serialized: dict
+        :param serialized: The serialized metrics.
+
+        :rtype: dict
+        :returns: The serialized metrics with strings replaced by IDs.
+        """
+        strings = [d["name"] for d in serialized["dimensions"]] +\
+                [d["value"] for d in serialized["dimensions"]] +\
+                [c["name"] for c in serialized["counters"]] +\
+                [t["name"] for t in serialized["timers"]]
+        self._assign([s for s in strings if isinstance(s, string_types)])
+
+        def encode_string(value):
+            if not isinstance(value, string_types):
+                return [value]
+            return self.ids.get(value, value)
+
+        encoded = dict(serialized)
+        encoded["dimensions"] = [{"name": encode_string(d["name"]),
+            "value": encode_string(d["value"])}
+            for d in serialized["dimensions"]]
+        encoded["counters"] = [dict(c, name=encode_string(c["name"]))
+                for c in serialized["counters"]]
+        encoded["timers"] = [dict(t, name=encode_string(t["name"]))
+                for t in serialized["timers"]]
+        return encoded
+
+    def decode(self, encoded):
+        """Replace the IDs in dictionary-encoded metrics with their strings.
+
+        :type encoded: dict
+        :param encoded: The dictionary-encoded metrics.
+
+        :rtype: dict
+        :returns: The serialized metrics.
+        """
+        def decode_string(value):
+            if isinstance(value, list):
+                return value[0]
+            if isinstance(value, string_types):
+                return value
+            return self._lookup(value)
+
+        serialized = dict(encoded)
+        serialized["dimensions"] = [{"name": decode_string(d["name"]),
+            "value": decode_string(d["value"])}
+            for d in encoded["dimensions"]]
+        serialized["counters"] = [dict(c, name=decode_string(c["name"]))
+                for c in encoded["counters"]]
+        serialized["timers"] = [dict(t, name=decode_string(t["name"]))
+                for t in encoded["timers"]]
+        return serialized
+
+    def _assign(self, strings):
+        """Make sure the given strings have IDs (if there is room in the
+        dictionary), assigning them in a single round trip to Redis.
+
+        :type strings: list
+        :param strings: The strings which need IDs.
+        """
+        if self.full:
+            return
+        missing = sorted(set(s for s in strings if s not in self.ids))
+        if len(missing) == 0:
+            return
+        if self.assign_script is None:
+            self.assign_script = self.client.register_script(
+                    self.ASSIGN_SCRIPT)
+        pipeline = self.client.pipeline(transaction=False)
+        for s in missing:
+            self.assign_script(keys=[self.key, self.ids_key],
+                    args=[s, self.max_size], client=pipeline)
+        for s, string_id in zip(missing, pipeline.execute()):
+            if string_id < 0:
+                self.full = True
+            else:
+                self.ids[s] = string_id
+                self.strings[string_id] = s
+
+    def _lookup(self, string_id):
+        """Get the string for an ID, reading it from Redis if it isn't cached
+        yet.
+
+        :type string_id: int
+        :param string_id: The ID of the string.
+
+        :rtype: string
+        :returns: The string with that ID.
+        """
+        if string_id not in self.strings:
+            value = self.client.hget(self.ids_key, string_id)
+            if value is None:
+                raise Exception("Unknown string ID: %s" % string_id)
+            if isinstance(value, bytes):
+                value = value.decode("utf-8")
+            self.strings[string_id] = value
+            self.ids[value] = string_id
+        return self.strings[string_id]
+
+class RedisLease(object):
+    """A lease on a Redis key, used so that only one of several agents sharing
+    a channel runs its nanny at a time. The lease is taken with ``SET NX`` and
+    a TTL, so if the agent holding it dies another agent takes over once the
+    TTL expires. Each time the lease is taken it gets a new token from an
+    ``INCR`` counter, which is stored in the lease's value; the holder only
+    renews or releases the lease while the value is still its own, so a holder
+    that stalled past the TTL can't extend or delete its successor's lease.
+
+    The nanny also checks the token against Redis right before each republish
+    (see :meth:`~kadabra.channels.RedisLease.check`), so a holder that stalled
+    past the TTL finds out it has lost the lease before it publishes anything
+    more. The backing store itself can't check the token, so a holder that
+    stalls in the middle of a publish can still finish it, which only costs
+    duplicates.
+
+    The holder considers the lease lost a little before the TTL expires (as
+    measured from before it asked Redis), so it stops working before another
+    agent can take over.
+
+    :type client: ~redis.StrictRedis
+    :param client: The Redis client to use.
+
+    :type key: string
+    :param key: The key of the lease. The token counter is stored at this
+                key with ``:token`` appended.
+
+    :type owner: string
+    :param owner: A unique name for the agent taking the lease.
+
+    :type ttl_seconds: float
+    :param ttl_seconds: How long the lease lasts unless it is renewed.
+    """
+
+    #: Takes the lease if it is free, returning the new token, or 0 if
+    #: another owner holds it.
+    ACQUIRE_SCRIPT = """
+        if not redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+            return 0
+        end
+        local token = redis.call('INCR', KEYS[2])
+        redis.call('SET', KEYS[1], ARGV[1] .. ':' .. token, 'PX', ARGV[2])
+        return token
+    """
+
+    #: Extends the lease if it still holds the given value, returning 1, or 0
+    #: if it has been lost.
+    RENEW_SCRIPT = """
+        if redis.call('GET', KEYS[1]) == ARGV[1] then
+            return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+        end
+        return 0
+    """
+
+    #: Deletes the lease if it still holds the given value.
+    RELEASE_SCRIPT = """
+        if redis.call('GET', KEYS[1]) == ARGV[1] then
+            return redis.call('DEL', KEYS[1])
+        end
+        return 0
+    """
+
+    #: The fraction of the TTL after which the holder considers the lease
+    #: lost unless it has been renewed.
+    SAFETY_FACTOR = 0.9
+
+    def __init__(self, client, key, owner, ttl_seconds):
+        self.client = client
+        self.key = key
+        self.token_key = key + ":token"
+        self.owner = owner
+        self.ttl_seconds = ttl_seconds
+
+        self.token = None
+        self.expires_at = 0
+        self.scripts = None
+
+    def acquire(self):
+        """Take the lease, or renew it if it is already held.
+
+        :rtype: bool
+        :returns: True if this owner holds the lease, False otherwise.
+        """
+        scripts = self._scripts()
+        ttl = int(self.ttl_seconds * 1000)
+        started_at = time.time()
+        if self.token is not None:
+            if scripts[1](keys=[self.key], args=[self._value(), ttl]):
+                self._extend(started_at)
+                return True
+            self.token = None
+        token = scripts[0](keys=[self.key, self.token_key],
+                args=[self.owner, ttl])
+        if not token:
+            return False
+        self.token = token
+        self._extend(started_at)
+        return True
+
+    def held(self):
+        """Return whether this owner still holds the lease, without asking
+        Redis.
+
+        :rtype: bool
+        :returns: True if the lease was taken or renewed recently enough that
+                  it can't have expired.
+        """
+        return self.token is not None and time.time() < self.expires_at
+
+    def check(self):
+        """Confirm with Redis that this owner still holds the lease, with the
+        same token, as the last step before acting on it. Unlike
+        :meth:`~kadabra.channels.RedisLease.held`, this notices that the lease
+        was taken over even if this owner's clock or process stalled.
+
+        :rtype: bool
+        :returns: True if this owner still holds the lease, False otherwise.
+        """
+        if not self.held():
+            return False
+        value = self.client.get(self.key)
+        if isinstance(value, bytes):
+            value = value.decode("utf-8")
+        if value != self._value():
+            self.token = None
+            return False
+        return True
+
+    def release(self):
+        """Give up the lease, so that another owner can take it right away."""
+        if self.token is None:
+            return
+        value = self._value()
+        self.token = None
+        self._scripts()[2](keys=[self.key], args=[value])
+
+    def _value(self):
+        return "%s:%s" % (self.owner, self.token)
+
+    def _extend(self, started_at):
+        self.expires_at = started_at +\
+                self.ttl_seconds * self.SAFETY_FACTOR
 
+    def _scripts(self):
+        if self.scripts is None:
+            self.scripts = (self.client.register_script(self.ACQUIRE_SCRIPT),
+                    self.client.register_script(self.RENEW_SCRIPT),
+                    self.client.register_script(self.RELEASE_SCRIPT))
+        return self.scripts
@@ -1,6 +1,9 @@
-import datetime, threading, json
+import datetime, threading, json, os, weakref, logging, time, uuid
 
-from .channels import RedisChannel
+from .channels import RedisChannel, ShardedRedisChannel,\
+                       RedisClusterChannel, PriorityRedisChannel,\
+                       MemoryChannel, SpoolChannel, SharedMemoryChannel,\
+                       SocketChannel, DatagramChannel
 from .config import DEFAULT_CONFIG
 from .metrics import Dimension, Counter, Timer, Metrics
 from .utils import get_now
@@ -23,6 +26,18 @@ class Kadabra(object):
         ...
         kadabra.send(metrics.close())
 
+    It is safe to create the client before forking worker processes (for
+    example in a pre-fork server like gunicorn or uWSGI). Each child process
+    detects the fork and resets the channel, so that it opens its own
+    connections instead of sharing the parent's. If ``CLIENT_CHANNEL_PREWARM``
+    is set, the child also connects right away, so its first request doesn't
+    pay for connection setup.
+
+    If ``CLIENT_FAILOVER_PATH`` is set, metrics which can't be sent (for
+    example because Redis is down) are written to a file in that directory
+    instead of raising, and replayed to the channel in the background once it
+    is reachable again (see :class:`~kadabra.client.FailoverBuffer`).
+
     :type configuration: dict
     :param configuration: Dictionary of configuration to use in place of the
                           defaults.
@@ -39,6 +54,22 @@ class Kadabra(object):
         custom_channel_args = config["CLIENT_CHANNEL_ARGS"]
         if channel_type == 'redis':
             channel_type = RedisChannel
+        elif channel_type == 'sharded_redis':
+            channel_type = ShardedRedisChannel
+        elif channel_type == 'redis_cluster':
+            channel_type = RedisClusterChannel
+        elif channel_type == 'priority_redis':
+            channel_type = PriorityRedisChannel
+        elif channel_type == 'memory':
+            channel_type = MemoryChannel
+        elif channel_type == 'spool':
+            channel_type = SpoolChannel
+        elif channel_type == 'shared_memory':
+            channel_type = SharedMemoryChannel
+        elif channel_type == 'socket':
+            channel_type = SocketChannel
+        elif channel_type == 'datagram':
+            channel_type = DatagramChannel
         else:
             raise Exception("Unrecognized channel type: '%s'" % channel_type)
 
@@ -51,6 +82,22 @@ class Kadabra(object):
 
         self.timestamp_format = config["CLIENT_TIMESTAMP_FORMAT"]
 
+        self.failover = None
+        if config["CLIENT_FAILOVER_PATH"]:
+            self.failover = FailoverBuffer(self.channel,
+                    config["CLIENT_FAILOVER_PATH"],
+                    config["CLIENT_FAILOVER_MAX_BYTES"],
+                    config["CLIENT_FAILOVER_REPLAY_RATE"],
+                    config["CLIENT_FAILOVER_RETRY_SECONDS"])
+            self.failover.start()
+
+        self.pid = os.getpid()
+        self.fork_lock = threading.Lock()
+        self.prewarm = config["CLIENT_CHANNEL_PREWARM"]
+        if self.prewarm:
+            self._prewarm()
+        _register_after_fork(self)
+
     def metrics(self):
         """Return a :class:`~kadabra.client.MetricsCollector` initialized with
         any dimensions as specified by the default dimensions. The collector
@@ -62,16 +109,384 @@ class Kadabra(object):
         return MetricsCollector(self.timestamp_format,
                 **self.default_dimensions)
 
-    def send(self, metrics):
+    def send(self, metrics, priority=None):
         """Send a :class:`Metrics` instance to this client's configured channel
         so that it can be received and published by the agent. Note that a
         Metrics instance can be retrieved from a collector by calling its
         :meth:`~kadabra.client.MetricsCollector.close` method.
 
+        If failover is configured and the channel can't be reached, the
+        metrics are written to the failover buffer instead, and the channel
+        isn't tried again until ``CLIENT_FAILOVER_RETRY_SECONDS`` have passed.
+
         :type metrics: ~kadabra.Metrics
         :param metrics: The :class:`Metrics` instance to be published.
+
+        :type priority: string
+        :param priority: The name of the lane to send the metrics to, for
+                         channels with priority lanes (see
+                         :class:`~kadabra.channels.PriorityRedisChannel`).
+                         Metrics written to the failover buffer lose their
+                         priority. An exception is raised, without trying the
+                         channel or the failover buffer, if the channel has
+                         no lane for this priority.
         """
-        self.channel.send(metrics)
+        if priority is not None:
+            self._check_priority(priority)
+        if os.getpid() != self.pid:
+            self._after_fork()
+        if self.failover is None:
+            self._send(metrics, priority)
+        elif self.failover.is_down():
+            self.failover.append(metrics)
+        else:
+            try:
+                self._send(metrics, priority)
+            except Exception:
+                self.failover.mark_down()
+                self.failover.append(metrics)
+
+    def _check_priority(self, priority):
+        """Make sure the channel has a lane for a priority. This is checked
+        before sending, since otherwise the channel's error would be mistaken
+        for the channel being down and the metrics written to the failover
+        buffer."""
+        has_lane = getattr(self.channel, "has_lane", None)
+        if has_lane is None:
+            raise Exception("The channel doesn't have priority lanes")
+        if not has_lane(priority):
+            raise Exception("Unrecognized lane: '%s'" % priority)
+
+    def _send(self, metrics, priority):
+        """Send metrics to the channel, passing the priority only if there is
+        one, since only channels with priority lanes accept it."""
+        if priority is None:
+            self.channel.send(metrics)
+        else:
+            self.channel.send(metrics, priority=priority)
+
+    def _after_fork(self):
+        """Reset the channel in a child process, discarding any connections
+        and buffered metrics inherited from the parent, and prewarm it if
+        configured to. This is called right after a fork where the platform
+        supports it, and otherwise by the first call to
+        :meth:`~kadabra.Kadabra.send` in the child."""
+        with self.fork_lock:
+            if os.getpid() == self.pid:
+                return
+            self.pid = os.getpid()
+            reset = getattr(self.channel, "reset", None)
+            if reset is not None:
+                reset()
+            if self.failover is not None:
+                self.failover.reset()
+            if self.prewarm:
+                self._prewarm()
+
+    def _prewarm(self):
+        """Prewarm the channel's connections, if the channel supports it."""
+        prewarm = getattr(self.channel, "prewarm", None)
+        if prewarm is not None:
+            prewarm()
+
+def _register_after_fork(client):
+    """Reset a client in child processes as soon as they are forked, if the
+    platform supports it (Python 3.7 and later). Only a weak reference to the
+    client is kept, so registering doesn't keep it alive.
+
+    :type client: ~kadabra.Kadabra
+    :param client: The client to reset after a fork.
+    """
+    if not hasattr(os, "register_at_fork"):
+        return
+    client_ref = weakref.ref(client)
+    def after_in_child():
+        client = client_ref()
+        if client is not None:
+            client._after_fork()
+    os.register_at_fork(after_in_child=after_in_child)
+
+class FailoverBuffer(object):
+    """Buffers metrics on local disk while the channel can't be reached, and
+    replays them to the channel once it can.
+
+    Each process appends metrics (one serialized JSON object per line) to its
+    own file in the failover directory, holding a lock on the file for as long
+    as the process lives. Once a send fails, the channel is considered down
+    for ``retry_seconds``, so that requests don't keep paying for a dead
+    connection. A background thread replays buffered metrics at no more than
+    ``replay_rate`` per second once the channel is up again, and truncates the
+    file once it has all been replayed. Files left behind by processes which
+    have exited are picked up and replayed too, both when the buffer is
+    started and in each newly forked child, so the files of recycled workers
+    in a pre-fork server are replayed by their replacements.
+
+    The metrics keep the time they were first serialized, so the agent's nanny
+    treats them the same as if they had been delayed in the channel. If a
+    write to the file fails (for example, because the disk is full) the file
+    is rolled back, so it never holds a partial line, and the metrics are
+    dropped. Lines which can't be read back as metrics are logged, counted in
+    ``unreadable`` and skipped.
+
+    :type channel: :ref:`api-channels`
+    :param channel: The channel to replay metrics to.
+
+    :type path: string
+    :param path: The failover directory.
+
+    :type max_bytes: int
+    :param max_bytes: The maximum size of each process' file. Metrics which
+                      don't fit are dropped.
+
+    :type replay_rate: float
+    :param replay_rate: The maximum number of metrics to replay per second.
+
+    :type retry_seconds: float
+    :param retry_seconds: How long to wait after a failure before trying the
+                          channel again.
+    """
+
+    #: The prefix of the name of each process' file.
+    FILE_PREFIX = "kadabra-failover-"
+
+    def __init__(self, channel, path, max_bytes, replay_rate, retry_seconds):
+        self.channel = channel
+        self.path = path
+        self.max_bytes = max_bytes
+        self.replay_rate = replay_rate
+        self.retry_seconds = retry_seconds
+        self.logger = logging.getLogger("kadabra.client")
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        self.lock = threading.Lock()
+        self.down_until = 0
+        self.dropped = 0
+        self.unreadable = 0
+        self.fd = None
+        self.size = 0
+        self.offset = 0
+        self.replayer = None
+
+    def start(self):
+        """Pick up any metrics left behind by processes which have exited, and
+        start replaying them."""
+        with self.lock:
+            self._open()
+            self._adopt_orphans()
+            if self.size > 0:
+                self._start_replayer()
+
+    def is_down(self):
+        """Return whether the channel is considered down.
+
+        :rtype: bool
+        :returns: True if a send failed less than ``retry_seconds`` ago.
+        """
+        return time.time() < self.down_until
+
+    def mark_down(self):
+        """Consider the channel down for the next ``retry_seconds``."""
+        if not self.is_down():
+            self.logger.warning("Failed to send metrics, buffering them in %s"
+                    " for %s seconds" % (self.path, self.retry_seconds),
+                    exc_info=True)
+        self.down_until = time.time() + self.retry_seconds
+
+    def append(self, metrics):
+        """Append metrics to this process' file, and make sure they will be
+        replayed.
+
+        :type metrics: ~kadabra.Metrics
+        :param metrics: The metrics to buffer.
+
+        :rtype: bool
+        :returns: True if the metrics were buffered, False if they were
+                  dropped because the file is full or couldn't be written.
+        """
+        line = (json.dumps(metrics.serialize()) + "\n").encode("utf-8")
+        with self.lock:
+            self._open()
+            if self.size + len(line) > self.max_bytes or\
+                    not self._write(line):
+                self.dropped = self.dropped + 1
+                return False
+            self._start_replayer()
+        return True
+
+    def reset(self):
+        """Forget the parent's file after the process has forked; the parent
+        keeps replaying it. The child opens its own file the next time it needs
+        one, or right away if there are files left behind by processes which
+        have exited (such as workers which were recycled), which it adopts and
+        replays."""
+        self.lock = threading.Lock()
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = None
+        self.size = 0
+        self.offset = 0
+        self.down_until = 0
+        self.replayer = None
+        try:
+            with self.lock:
+                self._adopt_orphans()
+                if self.size > 0:
+                    self._start_replayer()
+        except Exception:
+            self.logger.warning("Failed to adopt failover files in %s" %
+                    self.path, exc_info=True)
+
+    def _file_path(self):
+        """Return the path of this process' file."""
+        return os.path.join(self.path, "%s%d.log" % (self.FILE_PREFIX,
+            os.getpid()))
+
+    def _open(self):
+        """Open and lock this process' file, if it isn't already. The lock
+        must be held."""
+        import fcntl
+        if self.fd is None:
+            fd = os.open(self._file_path(),
+                    os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            self.fd = fd
+            self.size = os.fstat(fd).st_size
+            self.offset = 0
+
+    def _adopt_orphans(self):
+        """Move the metrics from files whose processes have exited into this
+        process' file, opening it if there are any. The lock must be held."""
+        import fcntl
+        own = os.path.basename(self._file_path())
+        for name in sorted(os.listdir(self.path)):
+            if not name.startswith(self.FILE_PREFIX) or name == own:
+                continue
+            orphan = os.path.join(self.path, name)
+            try:
+                fd = os.open(orphan, os.O_RDWR)
+            except OSError:
+                continue
+            try:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    continue
+                data = b""
+                while True:
+                    chunk = os.read(fd, 1024 * 1024)
+                    if not chunk:
+                        break
+                    data += chunk
+                data = data[:data.rfind(b"\n") + 1]
+                if len(data) > 0:
+                    self._open()
+                if self.size + len(data) > self.max_bytes:
+                    self.dropped = self.dropped + data.count(b"\n")
+                elif not self._write(data):
+                    # Leave the file to be adopted later.
+                    continue
+                os.unlink(orphan)
+            finally:
+                os.close(fd)
+
+    def _write(self, data):
+        """Append data to this process' file. If it can't all be written, the
+        file is truncated back to its previous size, so that a partial line is
+        never left for the next line to be appended to. The lock must be held.
+
+        :type data: bytes
+        :param data: The lines to append.
+
+        :rtype: bool
+        :returns: True if the data was written, False otherwise.
+        """
+        written = 0
+        try:
+            while written < len(data):
+                written = written + os.write(self.fd, data[written:])
+        except OSError:
+            self.logger.warning("Failed to write metrics to %s" %
+                    self._file_path(), exc_info=True)
+            try:
+                os.ftruncate(self.fd, self.size)
+            except OSError:
+                self.logger.warning("Failed to roll back %s" %
+                        self._file_path(), exc_info=True)
+            return False
+        self.size = self.size + len(data)
+        return True
+
+    def _start_replayer(self):
+        """Start the replayer thread, if it isn't already running. The lock
+        must be held."""
+        if self.replayer is None:
+            self.replayer = threading.Thread(target=self._run_replayer)
+            self.replayer.name = "KadabraFailoverReplayer"
+            self.replayer.daemon = True
+            self.replayer.start()
+
+    def _next(self):
+        """Return the next line to replay from this process' file, or None if
+        everything has been replayed, in which case the replayer is done."""
+        with self.lock:
+            if self.replayer is not threading.current_thread():
+                return None
+            data = b""
+            while True:
+                # The file is opened for appending, so moving the position to
+                # read doesn't affect where lines are written.
+                os.lseek(self.fd, self.offset + len(data), os.SEEK_SET)
+                chunk = os.read(self.fd, 64 * 1024)
+                if not chunk:
+                    break
+                end = chunk.find(b"\n")
+                if end >= 0:
+                    return data + chunk[:end + 1]
+                data += chunk
+            self.replayer = None
+            return None
+
+    def _advance(self, length):
+        """Move past a line which has been replayed, truncating the file once
+        everything in it has been replayed."""
+        with self.lock:
+            self.offset = self.offset + length
+            if self.offset >= self.size:
+                os.ftruncate(self.fd, 0)
+                self.size = 0
+                self.offset = 0
+
+    def _run_replayer(self):
+        """Replay buffered metrics to the channel until there are none left."""
+        interval = 1.0 / self.replay_rate
+        while True:
+            delay = self.down_until - time.time()
+            if delay > 0:
+                time.sleep(delay)
+                continue
+            line = self._next()
+            if line is None:
+                return
+            try:
+                metrics = Metrics.deserialize(json.loads(
+                    line.decode("utf-8")))
+            except Exception:
+                # A line which can't be read will never be sent, so it is
+                # skipped rather than mistaken for the channel being down.
+                self.logger.warning("Skipping unreadable line in %s" %
+                        self._file_path(), exc_info=True)
+                self.unreadable = self.unreadable + 1
+                self._advance(len(line))
+                continue
+            try:
+                self.channel.send(metrics)
+            except Exception:
+                self.mark_down()
+                continue
+            self._advance(len(line))
+            time.sleep(interval)
 
 class MetricsCollector(object):
     """A class for collecting metrics. Once initialized, instances of this
@@ -253,8 +668,9 @@ class MetricsCollector(object):
 
     def close(self):
         """Close this collector object and return an equivalent
-        :class:`Metrics` object. After this method is called, you can no longer
-        set dimensions, set timers, or add counts to this object.
+        :class:`Metrics` object, stamped with a unique ID. After this method is
+        called, you can no longer set dimensions, set timers, or add counts to
+        this object.
 
         :rtype: ~kadabra.Metrics
         :returns: A :class:`Metrics` instance from the collector's dimensions,
@@ -275,7 +691,8 @@ class MetricsCollector(object):
                     for n,c in self.counters.items()]
             timers = [Timer(n, t["timestamp"], t["metadata"], t["value"],\
                     t["unit"]) for n,t in self.timers.items()]
-            return Metrics(dimensions, counters, timers, self.timestamp_format)
+            return Metrics(dimensions, counters, timers, self.timestamp_format,
+                    id=uuid.uuid4().hex)
         finally:
             self.lock.release()
 
@@ -3,6 +3,11 @@ DEFAULT_CONFIG = {
     "CLIENT_TIMESTAMP_FORMAT": "%Y-%m-%dT%H:%M:%S.%fZ",
     "CLIENT_CHANNEL_TYPE" : "redis",
     "CLIENT_CHANNEL_ARGS" : None,
+    "CLIENT_CHANNEL_PREWARM" : False,
+    "CLIENT_FAILOVER_PATH" : None,
+    "CLIENT_FAILOVER_MAX_BYTES" : 64 * 1024 * 1024,
+    "CLIENT_FAILOVER_REPLAY_RATE" : 100.0,
+    "CLIENT_FAILOVER_RETRY_SECONDS" : 5.0,
     "AGENT_TYPE": "default",
     "AGENT_LOGGER_NAME": "kadabra.agent",
     "AGENT_CHANNEL_TYPE" : "redis",
@@ -16,5 +21,33 @@ DEFAULT_CONFIG = {
     "AGENT_NANNY_THRESHOLD_SECONDS" : 60.0,
     "AGENT_NANNY_QUERY_LIMIT": 5000,
     "AGENT_NANNY_THREADS": 3,
-    "BATCHED_AGENT_NANNY_MAX_BATCH_SIZE": 10000
+    "AGENT_NANNY_RATE_LIMIT": None,
+    "AGENT_NANNY_BACKOFF_SECONDS": 30.0,
+    "AGENT_NANNY_MAX_BACKOFF_SECONDS": 600.0,
+    "AGENT_NANNY_MAX_ATTEMPTS": 10,
+    "AGENT_NANNY_QUEUE_SIZE": 10000,
+    "AGENT_NANNY_DEDUPLICATE": False,
+    "AGENT_NANNY_LEASE_SECONDS": None,
+    "BATCHED_AGENT_NANNY_MAX_BATCH_SIZE": 10000,
+    "AGENT_RETRY_QUEUE_ENABLED": False,
+    "AGENT_RETRY_QUEUE_FREQUENCY_SECONDS": 1.0,
+    "AGENT_RETRY_QUEUE_MAX_BATCH_SIZE": 1000,
+    "AGENT_MAX_AGE_SECONDS": None,
+    "AGENT_MAX_AGE_ACTION": "drop",
+    "AGENT_RECOVERY_BACKLOG_SECONDS": None,
+    "AGENT_RECOVERY_CHECK_SECONDS": 10.0,
+    "AGENT_RECOVERY_BACKFILL_RATE": 100,
+    "AGENT_RECOVERY_BACKFILL_BATCH_SIZE": 100,
+    "AGENT_DEDUP_ENABLED": False,
+    "AGENT_DEDUP_WINDOW_SECONDS": 600.0,
+    "AGENT_DEDUP_CAPACITY": 1000000,
+    "AGENT_DEDUP_ERROR_RATE": 0.0001,
+    "AGENT_CIRCUIT_BREAKER_FAILURES": 0,
+    "AGENT_CIRCUIT_BREAKER_BACKOFF_SECONDS": 1.0,
+    "AGENT_CIRCUIT_BREAKER_MAX_BACKOFF_SECONDS": 60.0,
+    "AGENT_CIRCUIT_BREAKER_PROBE_SIZE": 10,
+    "AGENT_STATSD_ENABLED": False,
+    "AGENT_STATSD_HOST": "localhost",
+    "AGENT_STATSD_PORT": 8125,
+    "AGENT_STATSD_FLUSH_SECONDS": 10.0
 }
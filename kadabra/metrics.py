@@ -248,16 +248,28 @@ class Metrics(object):
     :type serialized_at: string
     :param serialized_at: The timestamp string for when the metrics were
                           serialized, if they were previously serialized.
+
+    :type id: string
+    :param id: A unique ID for this set of metrics, which the agent uses to
+               avoid publishing the same metrics twice.
+
+    Channels which track when metrics were received by their own clock set
+    ``in_progress_seconds`` on the metrics they return as in progress.
+    Channels which find received metrics again by value set ``payload`` to
+    the exact payload they were received as. Neither is serialized.
     """
     def __init__(self, dimensions, counters, timers,
             timestamp_format="%Y-%m-%dT%H:%M:%S.%fZ",
-            serialized_at=None):
+            serialized_at=None, id=None):
         self.dimensions = dimensions
         self.counters = counters
         self.timers = timers
 
         self.timestamp_format = timestamp_format
         self.serialized_at = serialized_at
+        self.id = id
+        self.in_progress_seconds = None
+        self.payload = None
 
     def serialize(self):
         """Serializes this set of metrics into a dictionary.
@@ -265,7 +277,7 @@ class Metrics(object):
         :rtype: dict
         :returns: The metrics as a dictionary.
         """
-        return {
+        serialized = {
             "dimensions": [d.serialize() for d in self.dimensions],
             "counters": [c.serialize(self.timestamp_format)\
                     for c in self.counters],
@@ -276,6 +288,9 @@ class Metrics(object):
                     self.timestamp_format) if self.serialized_at is None\
                     else self.serialized_at
         }
+        if self.id is not None:
+            serialized["id"] = self.id
+        return serialized
 
     @staticmethod
     def deserialize(value):
@@ -299,5 +314,6 @@ class Metrics(object):
                 [Timer.deserialize(t, timestamp_format)\
                         for t in value["timers"]],
                 timestamp_format,
-                serialized_at)
+                serialized_at,
+                value.get("id"))
 
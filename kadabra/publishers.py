@@ -25,9 +25,13 @@ class DebugPublisher(object):
 
         :type metrics: list
         :param metrics: The list of ~kadabra.Metrics to publish.
+
+        :rtype: list
+        :returns: The list of metrics which failed, which is always empty.
         """
         if len(metrics) > 0:
             self.logger.info([m.serialize() for m in metrics])
+        return []
 
 class InfluxDBPublisher(object):
     """Publish metrics by persisting them into an InfluxDB database. Series
@@ -69,41 +73,83 @@ class InfluxDBPublisher(object):
                 timeout=timeout)
 
     def publish(self, metrics):
-        """Publish the metrics by writing them to InfluxDB.
+        """Publish the metrics by writing them to InfluxDB. If InfluxDB
+        rejects the points as bad data, the points are written again in
+        halves, and so on, to find the points it won't accept, so that the
+        rest of the points are still written. Any other error (for example,
+        if InfluxDB can't be reached) is raised.
 
         :type metrics: ~kadabra.Metrics
         :param metrics: The metrics to publish.
+
+        :rtype: list
+        :returns: The list of :class:`~kadabra.Metrics` with points that
+                  InfluxDB rejected, which is empty if all the points were
+                  written.
         """
         data = []
+        owners = []
+
+        for i, m in enumerate(metrics):
+            points = self._points(m)
+            data.extend(points)
+            owners.extend([i] * len(points))
 
-        for m in metrics:
-            tags = dict([(d.name, d.value) for d in m.dimensions])
-
-            for timer in m.timers:
-                fields = dict([(k, v) for k,v in timer.metadata.items()])
-                fields["value"] = timedelta_total_seconds(timer.value) *\
-                        timer.unit.seconds_offset
-                fields["unit"] = timer.unit.name
-                datum = {
-                    "measurement": timer.name,
-                    "tags": tags,
-                    "time": datetime.datetime.strftime(timer.timestamp,
-                        m.timestamp_format),
-                    "fields": fields
-                }
-                data.append(datum)
-
-            for counter in m.counters:
-                fields = dict([(k, v) for k,v in counter.metadata.items()])
-                fields["value"] = counter.value
-                datum = {
-                    "measurement": counter.name,
-                    "tags": tags,
-                    "time": datetime.datetime.strftime(counter.timestamp,
-                        m.timestamp_format),
-                    "fields": fields
-                }
-                data.append(datum)
-
-        if len(data) > 0:
+        if len(data) == 0:
+            return []
+        rejected = self._write(data, owners)
+        return [m for i, m in enumerate(metrics) if i in rejected]
+
+    def _points(self, m):
+        """Convert a metrics object into a list of InfluxDB points."""
+        data = []
+        tags = dict([(d.name, d.value) for d in m.dimensions])
+
+        for timer in m.timers:
+            fields = dict([(k, v) for k,v in timer.metadata.items()])
+            fields["value"] = timedelta_total_seconds(timer.value) *\
+                    timer.unit.seconds_offset
+            fields["unit"] = timer.unit.name
+            datum = {
+                "measurement": timer.name,
+                "tags": tags,
+                "time": datetime.datetime.strftime(timer.timestamp,
+                    m.timestamp_format),
+                "fields": fields
+            }
+            data.append(datum)
+
+        for counter in m.counters:
+            fields = dict([(k, v) for k,v in counter.metadata.items()])
+            fields["value"] = counter.value
+            datum = {
+                "measurement": counter.name,
+                "tags": tags,
+                "time": datetime.datetime.strftime(counter.timestamp,
+                    m.timestamp_format),
+                "fields": fields
+            }
+            data.append(datum)
+
+        return data
+
+    def _write(self, data, owners):
+        """Write the points, splitting them in half whenever InfluxDB rejects
+        them as bad data (a 400 response).
+
+        :rtype: set
+        :returns: The indexes (from ``owners``) of the metrics which had
+                  points rejected.
+        """
+        from influxdb.exceptions import InfluxDBClientError
+        try:
             self.client.write_points(data)
+            return set()
+        except InfluxDBClientError as e:
+            if e.code != 400:
+                raise
+            if len(data) == 1:
+                return set(owners)
+        middle = len(data) // 2
+        return self._write(data[:middle], owners[:middle]) |\
+                self._write(data[middle:], owners[middle:])
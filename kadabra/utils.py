@@ -1,4 +1,4 @@
-import datetime
+import datetime, threading, time
 
 def get_now():
     return datetime.datetime.utcnow()
@@ -9,3 +9,68 @@ def get_datetime_from_timestamp_string(timestamp_string, timestamp_format):
 def timedelta_total_seconds(td):
     return (td.microseconds + (td.seconds + td.days * 24 * 3600) * 10**6) /\
             10.0**6
+
+def get_age_seconds(metrics):
+    """Return how many seconds ago metrics were serialized, or None if they
+    don't have a valid serialized_at timestamp."""
+    if metrics.serialized_at is None:
+        return None
+    try:
+        serialized_at = get_datetime_from_timestamp_string(
+                metrics.serialized_at, metrics.timestamp_format)
+    except (ValueError, TypeError):
+        return None
+    return timedelta_total_seconds(get_now() - serialized_at)
+
+class TokenBucket(object):
+    """A thread-safe token bucket, for limiting how fast something happens.
+    Tokens are added at ``rate`` per second, up to ``capacity``, and each
+    action takes one.
+
+    :type rate: float
+    :param rate: The number of tokens added per second.
+
+    :type capacity: float
+    :param capacity: The maximum number of tokens the bucket holds, which is
+                     the largest burst allowed. Defaults to ``rate``.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def take(self, count):
+        """Take up to ``count`` tokens without waiting.
+
+        :type count: int
+        :param count: The number of tokens wanted.
+
+        :rtype: int
+        :returns: The number of tokens taken, which may be 0.
+        """
+        with self.lock:
+            self._refill()
+            taken = int(min(count, self.tokens))
+            self.tokens = self.tokens - taken
+            return taken
+
+    def acquire(self):
+        """Take a single token, waiting until one is available."""
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens = self.tokens - 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def _refill(self):
+        """Add the tokens accumulated since the last refill. The lock must be
+        held."""
+        now = time.time()
+        self.tokens = min(self.capacity,
+                self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
@@ -1,5 +1,6 @@
 import kadabra
 import pytest
+import datetime
 
 from mock import MagicMock, mock, call
 
@@ -41,15 +42,20 @@ def test_ctor_defaults(mock_nanny, mock_receiver, mock_redis_channel,
 
     expected_receiver_args = {
         "channel": channel,
-        "publisher": publisher,
+        "publisher": agent.publisher,
         "logger": agent.logger,
-        "receiver_threads":
+        "circuit_breaker": agent.circuit_breaker,
+        "num_threads":
                 kadabra.config.DEFAULT_CONFIG["AGENT_RECEIVER_THREADS"]
     }
     expected_nanny_args = {
         "channel": channel,
-        "publisher": publisher,
+        "publisher": agent.publisher,
         "logger": agent.logger,
+        "circuit_breaker": agent.circuit_breaker,
+        "rate_limiter": None,
+        "backoff": mock.ANY,
+        "lease": None,
         "frequency_seconds": 
             kadabra.config.DEFAULT_CONFIG["AGENT_NANNY_FREQUENCY_SECONDS"],
         "threshold_seconds":
@@ -57,15 +63,25 @@ def test_ctor_defaults(mock_nanny, mock_receiver, mock_redis_channel,
         "query_limit": 
             kadabra.config.DEFAULT_CONFIG["AGENT_NANNY_QUERY_LIMIT"],
         "num_threads": 
-            kadabra.config.DEFAULT_CONFIG["AGENT_NANNY_THREADS"]
+            kadabra.config.DEFAULT_CONFIG["AGENT_NANNY_THREADS"],
+        "max_queue_size":
+            kadabra.config.DEFAULT_CONFIG["AGENT_NANNY_QUEUE_SIZE"],
+        "deduplicate":
+            kadabra.config.DEFAULT_CONFIG["AGENT_NANNY_DEDUPLICATE"]
     }
 
     mock_redis_channel.assert_called_with(**channel_default_args)
     mock_debug_publisher.assert_called_with(**publisher_default_args)
     mock_receiver.assert_called_with(**expected_receiver_args)
     mock_nanny.assert_called_with(**expected_nanny_args)
+    backoff = mock_nanny.call_args[1]["backoff"]
+    assert isinstance(backoff, kadabra.agent.RetryBackoff)
+    assert backoff.base_seconds ==\
+            kadabra.config.DEFAULT_CONFIG["AGENT_NANNY_BACKOFF_SECONDS"]
     assert agent.receiver == receiver
     assert agent.nanny == nanny
+    assert agent.publisher == publisher
+    assert agent.dedup_filter is None
 
 @mock.patch('kadabra.agent.DebugPublisher')
 @mock.patch('kadabra.agent.RedisChannel')
@@ -93,8 +109,9 @@ def test_ctor_batched_defaults(mock_nanny, mock_receiver, mock_redis_channel,
 
     expected_receiver_args = {
         "channel": channel,
-        "publisher": publisher,
+        "publisher": agent.publisher,
         "logger": agent.logger,
+        "circuit_breaker": agent.circuit_breaker,
         "publishing_interval":
             kadabra.config.DEFAULT_CONFIG["BATCHED_AGENT_INTERVAL_SECONDS"],
         "max_batch_size":
@@ -102,8 +119,12 @@ def test_ctor_batched_defaults(mock_nanny, mock_receiver, mock_redis_channel,
     }
     expected_nanny_args = {
         "channel": channel,
-        "publisher": publisher,
+        "publisher": agent.publisher,
         "logger": agent.logger,
+        "circuit_breaker": agent.circuit_breaker,
+        "rate_limiter": None,
+        "backoff": mock.ANY,
+        "lease": None,
         "frequency_seconds": 
             kadabra.config.DEFAULT_CONFIG["AGENT_NANNY_FREQUENCY_SECONDS"],
         "threshold_seconds":
@@ -116,8 +137,14 @@ def test_ctor_batched_defaults(mock_nanny, mock_receiver, mock_redis_channel,
     mock_debug_publisher.assert_called_with(**publisher_default_args)
     mock_receiver.assert_called_with(**expected_receiver_args)
     mock_nanny.assert_called_with(**expected_nanny_args)
+    backoff = mock_nanny.call_args[1]["backoff"]
+    assert isinstance(backoff, kadabra.agent.RetryBackoff)
+    assert backoff.base_seconds ==\
+            kadabra.config.DEFAULT_CONFIG["AGENT_NANNY_BACKOFF_SECONDS"]
     assert agent.receiver == receiver
     assert agent.nanny == nanny
+    assert agent.publisher == publisher
+    assert agent.dedup_filter is None
 
 @mock.patch('kadabra.agent.InfluxDBPublisher')
 @mock.patch('kadabra.agent.RedisChannel')
@@ -300,3 +327,232 @@ def test_stop(mock_sleep, mock_nanny, mock_receiver, mock_redis_channel,
     assert agent._check_stopped() == True
     nanny.stop.assert_called_with()
     receiver.stop.assert_called_with()
+
+@mock.patch('kadabra.agent.DebugPublisher')
+@mock.patch('kadabra.agent.ShardedRedisChannel')
+@mock.patch('kadabra.agent.Receiver')
+@mock.patch('kadabra.agent.Nanny')
+def test_ctor_sharded_redis_channel(mock_nanny, mock_receiver,
+        mock_sharded_redis_channel, mock_debug_publisher):
+    channel = "testChannel"
+    channel_default_args = {"channelArg1": "1", "channelArg2": 2}
+    mock_sharded_redis_channel.return_value = channel
+    mock_sharded_redis_channel.DEFAULT_ARGS = channel_default_args
+    mock_debug_publisher.DEFAULT_ARGS = {}
+
+    agent = kadabra.Agent(configuration={
+        "AGENT_CHANNEL_TYPE": "sharded_redis"})
+
+    mock_sharded_redis_channel.assert_called_with(**channel_default_args)
+    assert mock_receiver.call_args[1]["channel"] == channel
+    assert mock_nanny.call_args[1]["channel"] == channel
+
+@mock.patch('kadabra.agent.DebugPublisher')
+def test_ctor_dedup(mock_debug_publisher):
+    mock_debug_publisher.DEFAULT_ARGS = {}
+    publisher = mock_debug_publisher.return_value
+
+    agent = kadabra.Agent(configuration={"AGENT_DEDUP_ENABLED": True})
+
+    assert isinstance(agent.publisher, kadabra.agent.DedupPublisher)
+    assert agent.publisher.publisher == publisher
+    assert agent.publisher.dedup_filter == agent.dedup_filter
+    assert agent.dedup_filter.num_hashes > 0
+
+def test_ctor_statsd():
+    agent = kadabra.Agent(configuration={"AGENT_STATSD_ENABLED": True,
+        "AGENT_STATSD_PORT": 9125})
+
+    assert agent.statsd.port == 9125
+    assert agent.statsd.publisher == agent.receiver.threads[0].publisher
+    assert kadabra.Agent().statsd is None
+
+def get_statsd_metrics(parser):
+    return dict((tuple((d.name, d.value) for d in m.dimensions), m)
+            for m in parser.flush())
+
+def metrics_counters(parser):
+    return [(c.name, c.value) for m in parser.flush() for c in m.counters]
+
+def test_statsd_parser():
+    parser = kadabra.agent.StatsdParser()
+
+    parser.parse(b"hits:1|c\nhits:2|c|@0.5\nlatency:320|ms|#env:prod,canary\n"
+            b"queue:7|g\nqueue:5|g\nusers:a|s\nbad line\n\n")
+
+    assert parser.parsed == 5
+    assert parser.skipped == 2
+    metrics = get_statsd_metrics(parser)
+    assert sorted(metrics) == [
+            (("env", "prod"), ("canary", "true"), ("metric_type", "timing")),
+            (("metric_type", "counter"),), (("metric_type", "gauge"),)]
+    assert [(c.name, c.value) for c in
+            metrics[(("metric_type", "counter"),)].counters] ==\
+            [("hits", 5.0)]
+    assert [(c.name, c.value) for c in
+            metrics[(("metric_type", "gauge"),)].counters] == [("queue", 5.0)]
+    timer = metrics[(("env", "prod"), ("canary", "true"),
+        ("metric_type", "timing"))].timers[0]
+    assert timer.name == "latency"
+    assert timer.unit == kadabra.Units.MILLISECONDS
+    assert timer.value.total_seconds() == 0.32
+    assert parser.flush() == []
+
+def test_statsd_parser_aggregates_timers():
+    parser = kadabra.agent.StatsdParser(percentiles=(50, 90))
+
+    parser.parse(b"\n".join(b"latency:%d|ms" % v for v in range(1, 10)))
+    parser.parse(b"latency:55|ms|@0.5\nsize:3|h")
+
+    metrics = get_statsd_metrics(parser)
+    timers = metrics[(("metric_type", "timing"),)].timers
+    assert len(timers) == 1
+    assert timers[0].value.total_seconds() == 0.01
+    assert timers[0].metadata["count"] == 11.0
+    assert timers[0].metadata["sum"] == 100.0
+    assert timers[0].metadata["lower"] == 1.0
+    assert timers[0].metadata["upper"] == 55.0
+    assert timers[0].metadata["50_percentile"] == 5.0
+    assert timers[0].metadata["90_percentile"] == 9.0
+    assert round(timers[0].metadata["stddev"], 3) == 15.199
+    histogram = metrics[(("metric_type", "histogram"),)].timers[0]
+    assert histogram.name == "size"
+    assert histogram.metadata["count"] == 1.0
+
+def test_statsd_parser_relative_gauges():
+    parser = kadabra.agent.StatsdParser()
+
+    parser.parse(b"queue:-2|g\nqueue:10|g\nqueue:+3|g\nqueue:-1|g")
+    assert metrics_counters(parser) == [("queue", 12.0)]
+
+    parser.parse(b"queue:+4|g")
+    assert metrics_counters(parser) == [("queue", 16.0)]
+
+def test_statsd_receiver():
+    import socket, time
+    publisher = MagicMock()
+    receiver = kadabra.agent.StatsdReceiver(publisher, MagicMock(),
+            "127.0.0.1", 0, 0.01)
+    receiver.start()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.sendto(b"hits:1|c", receiver.sock.getsockname())
+
+    deadline = time.time() + 5
+    while not publisher.publish.called and time.time() < deadline:
+        time.sleep(0.01)
+    receiver.stop()
+
+    metrics = publisher.publish.call_args[0][0]
+    assert metrics[0].counters[0].name == "hits"
+    assert metrics[0].counters[0].value == 1.0
+
+def test_ctor_circuit_breaker():
+    agent = kadabra.Agent(configuration={
+        "AGENT_CIRCUIT_BREAKER_FAILURES": 3,
+        "AGENT_CIRCUIT_BREAKER_PROBE_SIZE": 2})
+
+    assert agent.circuit_breaker.failure_threshold == 3
+    assert agent.circuit_breaker.probe_size == 2
+    assert agent.receiver.circuit_breaker == agent.circuit_breaker
+    assert agent.nanny.circuit_breaker == agent.circuit_breaker
+    assert kadabra.Agent(configuration={
+        "AGENT_CIRCUIT_BREAKER_FAILURES": 0}).circuit_breaker is None
+    assert kadabra.Agent().circuit_breaker is None
+
+def test_ctor_nanny_max_attempts():
+    assert kadabra.Agent().nanny.backoff.max_attempts is None
+    agent = kadabra.Agent(configuration={"AGENT_CIRCUIT_BREAKER_FAILURES": 3,
+        "AGENT_NANNY_MAX_ATTEMPTS": 4})
+    assert agent.nanny.backoff.max_attempts == 4
+
+def test_outage_dead_letters_nothing_by_default():
+    backoff = kadabra.Agent().nanny.backoff
+    backoff.base_seconds = backoff.max_seconds = 0
+    serialized_at = (datetime.datetime.utcnow() -
+            datetime.timedelta(seconds=300)).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    metrics = [kadabra.Metrics([], [], [], serialized_at=serialized_at,
+        id=str(i)) for i in range(4)]
+    channel = MagicMock()
+    channel.in_progress.return_value = metrics
+    publisher = MagicMock()
+    publisher.publish.side_effect = IOError("Backing store is down")
+    nanny = kadabra.agent.BatchedNanny(channel, publisher, MagicMock(), 10.0,
+            0, 100, backoff=backoff)
+
+    with mock.patch('kadabra.agent.Timer'):
+        for _ in range(kadabra.config.DEFAULT_CONFIG[
+            "AGENT_NANNY_MAX_ATTEMPTS"] + 2):
+            nanny._run_nanny()
+
+    assert publisher.publish.called
+    assert not channel.dead_letter.called
+
+def test_ctor_nanny_lease():
+    agent = kadabra.Agent(configuration={"AGENT_NANNY_LEASE_SECONDS": 45})
+
+    assert isinstance(agent.nanny.lease, kadabra.channels.RedisLease)
+    assert agent.nanny.lease.key == "kadabra_inprogress:lease"
+    assert agent.nanny.lease.ttl_seconds == 45
+    assert kadabra.Agent(configuration={"AGENT_CHANNEL_TYPE": "memory",
+        "AGENT_CHANNEL_ARGS": {"name": "lease"}}).nanny.lease is None
+    assert kadabra.Agent(configuration={
+        "AGENT_NANNY_LEASE_SECONDS": None}).nanny.lease is None
+    assert kadabra.Agent().nanny.lease is None
+
+def test_ctor_retry_queue():
+    agent = kadabra.Agent(configuration={"AGENT_RETRY_QUEUE_ENABLED": True,
+        "AGENT_RETRY_QUEUE_FREQUENCY_SECONDS": 2.0})
+
+    assert agent.retry_requeuer.frequency_seconds == 2.0
+    assert agent.nanny.retry_queue
+    assert agent.receiver.retry_queue
+    assert agent.receiver.backoff is agent.nanny.backoff
+    assert kadabra.Agent().retry_requeuer is None
+    assert kadabra.Agent(configuration={"AGENT_RETRY_QUEUE_ENABLED": True,
+        "AGENT_CHANNEL_TYPE": "memory", "AGENT_CHANNEL_ARGS":
+        {"name": "retry"}}).retry_requeuer is None
+
+def test_ctor_max_age_and_recovery():
+    agent = kadabra.Agent(configuration={"AGENT_MAX_AGE_SECONDS": 3600,
+        "AGENT_MAX_AGE_ACTION": "divert",
+        "AGENT_RECOVERY_BACKLOG_SECONDS": 600,
+        "AGENT_RECOVERY_BACKFILL_RATE": 50})
+
+    assert agent.max_age.max_age_seconds == 3600
+    assert agent.max_age.action == "divert"
+    assert agent.receiver.max_age is agent.max_age
+    assert agent.nanny.max_age is agent.max_age
+    assert agent.recovery.backlog_seconds == 600
+    assert agent.receiver.recovery is agent.recovery
+    assert agent.backfiller.recovery is agent.recovery
+    assert agent.backfiller.rate_limiter.rate == 50
+    assert agent.backfiller.max_age is agent.max_age
+    assert agent.backfiller.backoff is None
+    assert not agent.backfiller.retry_queue
+
+    agent = kadabra.Agent(configuration={"AGENT_RETRY_QUEUE_ENABLED": True,
+        "AGENT_RECOVERY_BACKLOG_SECONDS": 600})
+    assert agent.backfiller.backoff is agent.nanny.backoff
+    assert agent.backfiller.retry_queue
+
+    agent = kadabra.Agent(configuration={"AGENT_CHANNEL_TYPE": "memory",
+        "AGENT_CHANNEL_ARGS": {"name": "recovery"},
+        "AGENT_RECOVERY_BACKLOG_SECONDS": 600})
+    assert agent.max_age is None
+    assert agent.recovery is None
+    assert agent.backfiller is None
+
+@mock.patch('kadabra.agent.time.sleep')
+def test_start_heartbeat(mock_sleep):
+    agent = kadabra.Agent(configuration={"AGENT_CHANNEL_ARGS":
+        {"agent_inprogress_keys": True, "client": MagicMock()}})
+    assert agent.nanny.lease is None
+    agent.receiver = MagicMock()
+    agent.nanny = MagicMock()
+    agent._check_stopped = MagicMock(side_effect=[False, False, True])
+    agent.channel.heartbeat = MagicMock(side_effect=[Exception(), None])
+
+    agent.start()
+
+    assert agent.channel.agent_id == agent.agent_id
+    assert agent.channel.heartbeat.call_count == 2
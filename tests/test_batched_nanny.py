@@ -138,8 +138,8 @@ def test_run_no_inprogress_metrics(mock_timer, mock_now, mock_get_datetime):
     channel.in_progress.assert_called_with(max_batch_size)
     assert mock_get_datetime.call_count == 0
     assert logger.debug.call_count == 2
-    publisher.publish.assert_called_with([])
-    channel.complete.assert_called_with([])
+    assert not publisher.publish.called
+    assert not channel.complete.called
     mock_timer.assert_called_with(frequency_seconds, nanny._run_nanny)
     assert timer.name == "KadabraBatchedNanny"
     timer.start.assert_called_with()
@@ -165,14 +165,18 @@ def test_run(mock_timer, mock_now, mock_get_datetime):
     m1 = MagicMock()
     m1.serialized_at = MagicMock()
     m1.timestamp_format = MagicMock()
+    m1.in_progress_seconds = None
     m2 = MagicMock()
     m2.serialized_at = MagicMock()
     m2.timestamp_format = MagicMock()
+    m2.in_progress_seconds = None
     m3 = MagicMock()
     m3.serialized_at = MagicMock()
     m3.timestamp_format = MagicMock()
+    m3.in_progress_seconds = None
     m4 = MagicMock()
     m4.serialized_at = None
+    m4.in_progress_seconds = None
     metrics = [m1, m2, m3, m4]
     channel.in_progress.return_value = metrics
     mock_get_datetime.side_effect = [
@@ -196,3 +200,101 @@ def test_run(mock_timer, mock_now, mock_get_datetime):
     mock_timer.assert_called_with(frequency_seconds, nanny._run_nanny)
     assert timer.name == "KadabraBatchedNanny"
     timer.start.assert_called_with()
+
+@mock.patch('kadabra.agent.Timer')
+def test_run_rate_limited_freshest_first(mock_timer):
+    timestamp_format = "%Y-%m-%dT%H:%M:%S.%fZ"
+    old = kadabra.Metrics([], [], [], serialized_at=(NOW -
+        datetime.timedelta(seconds=300)).strftime(timestamp_format))
+    new = kadabra.Metrics([], [], [], serialized_at=(NOW -
+        datetime.timedelta(seconds=100)).strftime(timestamp_format))
+    channel = MagicMock()
+    channel.in_progress.return_value = [old, new]
+    publisher = MagicMock()
+    rate_limiter = kadabra.utils.TokenBucket(1)
+
+    nanny = kadabra.agent.BatchedNanny(channel, publisher, MagicMock(), 10.0,
+            5.0, 100, rate_limiter=rate_limiter)
+    nanny._run_nanny()
+
+    publisher.publish.assert_called_with([new])
+    channel.complete.assert_called_with([new])
+
+@mock.patch('kadabra.agent.Timer')
+def test_run_lease_held_elsewhere(mock_timer):
+    channel = MagicMock()
+    lease = MagicMock()
+    lease.acquire.return_value = False
+
+    nanny = kadabra.agent.BatchedNanny(channel, MagicMock(), MagicMock(), 10,
+            5, 3, lease=lease)
+    nanny._run_nanny()
+
+    assert not channel.in_progress.called
+    assert mock_timer.return_value.start.called
+
+    nanny.stop()
+    lease.release.assert_called_with()
+
+@mock.patch('kadabra.agent.Timer')
+def test_run_lease_lost_before_publishing(mock_timer):
+    serialized_at = (NOW - datetime.timedelta(seconds=300)).strftime(
+            "%Y-%m-%dT%H:%M:%S.%fZ")
+    channel = MagicMock()
+    channel.in_progress.return_value = [kadabra.Metrics([], [], [],
+        serialized_at=serialized_at)]
+    publisher = MagicMock()
+    lease = MagicMock()
+    lease.check.return_value = False
+
+    nanny = kadabra.agent.BatchedNanny(channel, publisher, MagicMock(), 10,
+            5, 3, lease=lease)
+    nanny._run_nanny()
+
+    lease.check.assert_called_with()
+    assert not publisher.publish.called
+    assert not channel.complete.called
+
+@mock.patch('kadabra.agent.Timer')
+def test_run_breaker_not_taken_without_lease(mock_timer):
+    lease = MagicMock()
+    lease.acquire.return_value = False
+    breaker = MagicMock()
+
+    nanny = kadabra.agent.BatchedNanny(MagicMock(), MagicMock(), MagicMock(),
+            10, 5, 3, circuit_breaker=breaker, lease=lease)
+    nanny._run_nanny()
+
+    assert not breaker.allow.called
+
+def reject(bad):
+    def publish(metrics):
+        if bad in metrics:
+            raise Exception("Bad metrics")
+    return publish
+
+@mock.patch('kadabra.agent.Timer')
+def test_run_dead_letters_after_max_attempts(mock_timer):
+    timestamp_format = "%Y-%m-%dT%H:%M:%S.%fZ"
+    serialized_at = (NOW - datetime.timedelta(seconds=300)).strftime(
+            timestamp_format)
+    metrics = [kadabra.Metrics([], [], [], serialized_at=serialized_at,
+        id=str(i)) for i in range(4)]
+    bad = metrics[2]
+    channel = MagicMock()
+    channel.in_progress.side_effect = [list(metrics), [bad]]
+    publisher = MagicMock()
+    publisher.publish.side_effect = reject(bad)
+    backoff = kadabra.agent.RetryBackoff(0, 0, max_attempts=2)
+
+    nanny = kadabra.agent.BatchedNanny(channel, publisher, MagicMock(), 10.0,
+            5.0, 100, backoff=backoff)
+    nanny._run_nanny()
+
+    channel.complete.assert_called_with([metrics[0], metrics[1], metrics[3]])
+    assert not channel.dead_letter.called
+
+    nanny._run_nanny()
+
+    channel.dead_letter.assert_called_with([bad])
+    assert backoff.exhausted([bad]) == []
@@ -73,6 +73,7 @@ def test_stop(mock_timer):
 @mock.patch('kadabra.agent.Timer')
 def test_run_exception(mock_timer):
     batch = MagicMock()
+    batch.__len__.return_value = 2
     channel = MagicMock()
     channel.receive_batch = MagicMock(return_value=batch)
     channel.complete = MagicMock()
@@ -105,6 +106,7 @@ def test_run_exception(mock_timer):
 @mock.patch('kadabra.agent.Timer')
 def test_run(mock_timer):
     batch = MagicMock()
+    batch.__len__.return_value = 2
     channel = MagicMock()
     channel.receive_batch = MagicMock(return_value=batch)
     channel.complete = MagicMock()
@@ -132,3 +134,114 @@ def test_run(mock_timer):
     assert receiver.timer == timer
     timer.start.assert_called_with()
 
+
+def reject(bad):
+    def publish(metrics):
+        if bad in metrics:
+            raise Exception("Bad metrics")
+    return publish
+
+@mock.patch('kadabra.agent.Timer')
+def test_run_bisects_failures(mock_timer):
+    metrics = [kadabra.Metrics([], [], [], serialized_at="now", id=str(i))
+            for i in range(8)]
+    channel = MagicMock()
+    channel.receive_batch.return_value = metrics
+    publisher = MagicMock()
+    publisher.publish.side_effect = reject(metrics[5])
+    logger = MagicMock()
+
+    receiver = kadabra.agent.BatchedReceiver(channel, publisher, logger,
+            10.0, 8)
+    receiver._run_batched_receiver()
+
+    completed = channel.complete.call_args[0][0]
+    assert completed == metrics[:5] + metrics[6:]
+    assert publisher.publish.call_count == 7
+    assert logger.warn.call_count == 1
+
+@mock.patch('kadabra.agent.Timer')
+def test_run_no_bisect_when_both_halves_fail(mock_timer):
+    metrics = [MagicMock() for i in range(1000)]
+    channel = MagicMock()
+    channel.receive_batch.return_value = metrics
+    publisher = MagicMock()
+    publisher.publish.side_effect = IOError("Backing store is down")
+
+    receiver = kadabra.agent.BatchedReceiver(channel, publisher, MagicMock(),
+            10.0, 1000)
+    receiver._run_batched_receiver()
+
+    assert publisher.publish.call_count == 3
+    channel.complete.assert_called_with([])
+
+@mock.patch('kadabra.agent.Timer')
+def test_run_publisher_rejects(mock_timer):
+    metrics = [MagicMock() for i in range(4)]
+    channel = MagicMock()
+    channel.receive_batch.return_value = metrics
+    publisher = MagicMock()
+    publisher.publish.return_value = [metrics[2]]
+
+    receiver = kadabra.agent.BatchedReceiver(channel, publisher, MagicMock(),
+            10.0, 4)
+    receiver._run_batched_receiver()
+
+    assert publisher.publish.call_count == 1
+    channel.complete.assert_called_with([metrics[0], metrics[1], metrics[3]])
+
+@mock.patch('kadabra.agent.Timer')
+def test_run_retry_queue(mock_timer):
+    metrics = [kadabra.Metrics([], [], [], id=str(i)) for i in range(4)]
+    channel = MagicMock()
+    channel.receive_batch.return_value = metrics
+    publisher = MagicMock()
+    publisher.publish.return_value = [metrics[2]]
+    backoff = kadabra.agent.RetryBackoff(10, 10, max_attempts=2)
+
+    receiver = kadabra.agent.BatchedReceiver(channel, publisher, MagicMock(),
+            10.0, 4, backoff=backoff, retry_queue=True)
+    receiver._run_batched_receiver()
+
+    assert channel.retry.call_args[0][0] == [metrics[2]]
+    assert not channel.dead_letter.called
+
+    receiver._run_batched_receiver()
+
+    channel.dead_letter.assert_called_with([metrics[2]])
+    assert channel.retry.call_count == 1
+
+@mock.patch('kadabra.agent.Timer')
+def test_run_recovering(mock_timer):
+    metrics = [MagicMock(), MagicMock()]
+    channel = MagicMock()
+    channel.receive_newest.return_value = metrics
+    publisher = MagicMock()
+    recovery = MagicMock()
+    recovery.active.return_value = True
+    max_age = MagicMock()
+    max_age.expire.return_value = metrics[:1]
+
+    receiver = kadabra.agent.BatchedReceiver(channel, publisher, MagicMock(),
+            10.0, 4, max_age=max_age, recovery=recovery)
+    receiver._run_batched_receiver()
+
+    channel.receive_newest.assert_called_with(4)
+    assert not channel.receive_batch.called
+    publisher.publish.assert_called_with(metrics[:1])
+
+@mock.patch('kadabra.agent.Timer')
+def test_run_no_bisect_when_breaker_opens(mock_timer):
+    metrics = [MagicMock() for i in range(8)]
+    channel = MagicMock()
+    channel.receive_batch.return_value = metrics
+    publisher = MagicMock()
+    publisher.publish.side_effect = Exception("Backend is down")
+    breaker = kadabra.agent.CircuitBreaker(MagicMock(), 2, 10, 60, 5)
+
+    receiver = kadabra.agent.BatchedReceiver(channel, publisher, MagicMock(),
+            10.0, 8, circuit_breaker=breaker)
+    receiver._run_batched_receiver()
+
+    assert publisher.publish.call_count == 2
+    channel.complete.assert_called_with([])
@@ -0,0 +1,233 @@
+import kadabra
+import pytest
+
+from mock import MagicMock, mock
+
+def get_breaker(**kwargs):
+    args = {"failure_threshold": 2, "backoff_seconds": 10,
+            "max_backoff_seconds": 25, "probe_size": 5}
+    args.update(kwargs)
+    return kadabra.agent.CircuitBreaker(MagicMock(), **args)
+
+def test_ctor():
+    breaker = get_breaker()
+
+    assert breaker.state == kadabra.agent.CircuitBreaker.CLOSED
+    assert breaker.failure_threshold == 2
+    assert breaker.probe_size == 5
+    assert breaker.allow()
+    assert not breaker.is_open()
+
+@mock.patch('kadabra.agent.time.time', return_value=100)
+def test_opens_after_failures(mock_time):
+    breaker = get_breaker()
+
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+
+    assert breaker.is_open()
+    assert not breaker.allow()
+    assert breaker.next_probe == 110
+
+@mock.patch('kadabra.agent.time.time', return_value=100)
+def test_success_resets_failures(mock_time):
+    breaker = get_breaker()
+
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+
+    assert not breaker.is_open()
+
+@mock.patch('kadabra.agent.time.time')
+def test_probe(mock_time):
+    mock_time.return_value = 100
+    breaker = get_breaker()
+    breaker.record_failure()
+    breaker.record_failure()
+
+    mock_time.return_value = 110
+    assert breaker.allow()
+    assert breaker.probing
+    # Only one caller probes at a time.
+    assert not breaker.allow()
+
+    breaker.record_success()
+    assert not breaker.is_open()
+    assert breaker.allow()
+
+@mock.patch('kadabra.agent.time.time')
+def test_failed_probe_backs_off(mock_time):
+    mock_time.return_value = 100
+    breaker = get_breaker()
+    breaker.record_failure()
+    breaker.record_failure()
+
+    mock_time.return_value = 110
+    breaker.record_failure(breaker.allow())
+    assert breaker.next_probe == 130
+
+    mock_time.return_value = 130
+    breaker.record_failure(breaker.allow())
+    assert breaker.next_probe == 155
+
+@mock.patch('kadabra.agent.time.time', return_value=100)
+def test_abandon_probe(mock_time):
+    breaker = get_breaker(backoff_seconds=0)
+    breaker.record_failure()
+    breaker.record_failure()
+    permit = breaker.allow()
+    assert breaker.is_probe(permit)
+
+    breaker.abandon_probe(True)
+    assert breaker.probing
+
+    breaker.abandon_probe(permit)
+
+    assert breaker.state == kadabra.agent.CircuitBreaker.OPEN
+    assert breaker.allow()
+
+@mock.patch('kadabra.agent.time.time', return_value=100)
+def test_other_callers_leave_probe_alone(mock_time):
+    breaker = get_breaker(backoff_seconds=0)
+    closed_permit = breaker.allow()
+    breaker.record_failure()
+    breaker.record_failure()
+    probe = breaker.allow()
+
+    # A publish which started before the breaker opened fails late.
+    breaker.record_failure(closed_permit)
+    breaker.abandon_probe(closed_permit)
+
+    assert breaker.probing
+    assert not breaker.is_probe(closed_permit)
+    assert breaker.is_probe(probe)
+    assert not breaker.allow()
+
+def test_receiver_thread_waits_when_open():
+    channel = MagicMock()
+    breaker = MagicMock()
+    breaker.allow.return_value = False
+    receiver_thread = kadabra.agent.ReceiverThread(channel, MagicMock(),
+            MagicMock(), circuit_breaker=breaker)
+
+    receiver_thread._run_once()
+
+    breaker.wait.assert_called_with()
+    assert not channel.receive.called
+
+def test_receiver_thread_records_failure():
+    channel = MagicMock()
+    publisher = MagicMock()
+    publisher.publish.side_effect = Exception("InfluxDB is down")
+    breaker = get_breaker(failure_threshold=1)
+    receiver_thread = kadabra.agent.ReceiverThread(channel, publisher,
+            MagicMock(), circuit_breaker=breaker)
+
+    receiver_thread._run_once()
+
+    assert breaker.is_open()
+    assert not channel.complete.called
+
+@mock.patch('kadabra.agent.Timer')
+def test_batched_receiver_probes_small_batch(mock_timer):
+    channel = MagicMock()
+    channel.receive_batch.return_value = ["metrics"]
+    publisher = MagicMock()
+    breaker = get_breaker(backoff_seconds=0)
+    breaker.record_failure()
+    breaker.record_failure()
+    receiver = kadabra.agent.BatchedReceiver(channel, publisher, MagicMock(),
+            60, 1000, circuit_breaker=breaker)
+
+    receiver._run_batched_receiver()
+
+    channel.receive_batch.assert_called_with(5)
+    publisher.publish.assert_called_with(["metrics"])
+    assert not breaker.is_open()
+
+@mock.patch('kadabra.agent.Timer')
+def test_nanny_skips_when_open(mock_timer):
+    channel = MagicMock()
+    breaker = get_breaker()
+    breaker.record_failure()
+    breaker.record_failure()
+    nanny = kadabra.agent.Nanny(channel, MagicMock(), MagicMock(), 30, 60,
+            100, 1, circuit_breaker=breaker)
+
+    nanny._run_nanny()
+
+    assert not channel.in_progress.called
+    mock_timer.return_value.start.assert_called_with()
+
+@mock.patch('kadabra.agent.time.time', return_value=100)
+def test_receiver_thread_finishes_probe_on_error(mock_time):
+    channel = MagicMock()
+    channel.receive.side_effect = Exception("Redis is down")
+    breaker = get_breaker(backoff_seconds=0)
+    breaker.record_failure()
+    breaker.record_failure()
+    receiver_thread = kadabra.agent.ReceiverThread(channel, MagicMock(),
+            MagicMock(), circuit_breaker=breaker)
+
+    receiver_thread._run_once()
+
+    assert breaker.state == kadabra.agent.CircuitBreaker.OPEN
+    assert breaker.allow()
+
+@mock.patch('kadabra.agent.time.time', return_value=100)
+def test_nanny_thread_finishes_probe_when_lease_lost(mock_time):
+    channel = MagicMock()
+    publisher = MagicMock()
+    lease = MagicMock()
+    lease.check.return_value = False
+    breaker = get_breaker(backoff_seconds=0)
+    breaker.record_failure()
+    breaker.record_failure()
+    queue = kadabra.agent.Queue()
+    queue.put(MagicMock())
+    nanny_thread = kadabra.agent.NannyThread(channel, publisher, queue,
+            MagicMock(), circuit_breaker=breaker, lease=lease)
+
+    nanny_thread._run_once()
+
+    assert not publisher.publish.called
+    assert breaker.state == kadabra.agent.CircuitBreaker.OPEN
+    assert breaker.allow()
+
+@mock.patch('kadabra.agent.Timer')
+@mock.patch('kadabra.agent.time.time', return_value=100)
+def test_batched_finishes_probe_on_error(mock_time, mock_timer):
+    channel = MagicMock()
+    channel.receive_batch.side_effect = Exception("Redis is down")
+    channel.in_progress.side_effect = Exception("Redis is down")
+    breaker = get_breaker(backoff_seconds=0)
+    breaker.record_failure()
+    breaker.record_failure()
+    receiver = kadabra.agent.BatchedReceiver(channel, MagicMock(),
+            MagicMock(), 60, 1000, circuit_breaker=breaker)
+    nanny = kadabra.agent.BatchedNanny(channel, MagicMock(), MagicMock(), 30,
+            60, 100, circuit_breaker=breaker)
+
+    receiver._run_batched_receiver()
+    assert breaker.state == kadabra.agent.CircuitBreaker.OPEN
+    nanny._run_nanny()
+
+    assert breaker.state == kadabra.agent.CircuitBreaker.OPEN
+    assert breaker.allow()
+
+@mock.patch('kadabra.agent.Timer')
+def test_batched_receiver_skips_empty_batch(mock_timer):
+    channel = MagicMock()
+    channel.receive_batch.return_value = []
+    publisher = MagicMock()
+    breaker = get_breaker()
+    breaker.record_failure()
+    receiver = kadabra.agent.BatchedReceiver(channel, publisher, MagicMock(),
+            60, 1000, circuit_breaker=breaker)
+
+    receiver._run_batched_receiver()
+
+    assert not publisher.publish.called
+    assert breaker.failures == 1
@@ -1,6 +1,8 @@
 import kadabra
 import pytest
 import datetime
+import os
+import json
 
 from mock import MagicMock, mock, call
 
@@ -100,6 +102,40 @@ def test_client_send(mock_redis_channel):
 
     mock_channel_instance.send.assert_called_with(to_send)
 
+@mock.patch('kadabra.client.RedisChannel')
+def test_client_send_priority(mock_redis_channel):
+    mock_redis_channel.DEFAULT_ARGS = {}
+    mock_channel_instance = mock_redis_channel.return_value
+
+    client = kadabra.Kadabra()
+    client.send("to_send", priority="high")
+
+    mock_channel_instance.send.assert_called_with("to_send", priority="high")
+    mock_channel_instance.has_lane.assert_called_with("high")
+
+def test_client_send_priority_unsupported():
+    client = kadabra.Kadabra(configuration={"CLIENT_CHANNEL_TYPE": "memory",
+        "CLIENT_CHANNEL_ARGS": {"name": "priority"}})
+    client.failover = MagicMock()
+
+    with pytest.raises(Exception):
+        client.send("to_send", priority="high")
+    assert not client.failover.append.called
+
+@mock.patch('kadabra.client.RedisChannel')
+def test_client_send_unrecognized_priority(mock_redis_channel):
+    mock_redis_channel.DEFAULT_ARGS = {}
+    mock_channel_instance = mock_redis_channel.return_value
+    mock_channel_instance.has_lane.return_value = False
+
+    client = kadabra.Kadabra()
+    client.failover = MagicMock()
+
+    with pytest.raises(Exception):
+        client.send("to_send", priority="low")
+    assert not mock_channel_instance.send.called
+    assert not client.failover.append.called
+
 def test_collector_ctor_no_dimensions():
     timestamp_format = "timestamp_format"
     collector = kadabra.client.MetricsCollector(timestamp_format)
@@ -518,4 +554,260 @@ def test_collector_close(mock_metrics, mock_timer, mock_counter,
         any_order=True)
 
     mock_metrics.assert_called_with(dimensions_expected, counters_expected,
-            timers_expected, timestamp_format)
+            timers_expected, timestamp_format, id=mock.ANY)
+    assert len(mock_metrics.call_args[1]["id"]) == 32
+
+def test_collector_close_unique_ids():
+    ids = set(kadabra.client.MetricsCollector("%Y").close().id
+            for _ in range(100))
+    assert len(ids) == 100
+
+@mock.patch('kadabra.client.ShardedRedisChannel')
+def test_client_ctor_sharded_redis_channel(mock_sharded_redis_channel):
+    channel = "test"
+    channel_default_args = {"arg1": "1", "arg2": 2}
+
+    mock_sharded_redis_channel.return_value = channel
+    mock_sharded_redis_channel.DEFAULT_ARGS = channel_default_args
+
+    client = kadabra.Kadabra(\
+            configuration={"CLIENT_CHANNEL_TYPE": "sharded_redis"})
+
+    mock_sharded_redis_channel.assert_called_with(**channel_default_args)
+    assert client.channel == channel
+
+@mock.patch('kadabra.client.RedisClusterChannel')
+def test_client_ctor_redis_cluster_channel(mock_redis_cluster_channel):
+    channel = "test"
+    channel_default_args = {"arg1": "1", "arg2": 2}
+
+    mock_redis_cluster_channel.return_value = channel
+    mock_redis_cluster_channel.DEFAULT_ARGS = channel_default_args
+
+    client = kadabra.Kadabra(\
+            configuration={"CLIENT_CHANNEL_TYPE": "redis_cluster"})
+
+    mock_redis_cluster_channel.assert_called_with(**channel_default_args)
+    assert client.channel == channel
+
+@mock.patch('kadabra.client.PriorityRedisChannel')
+def test_client_ctor_priority_redis_channel(mock_priority_redis_channel):
+    channel = "test"
+    channel_default_args = {"arg1": "1", "arg2": 2}
+
+    mock_priority_redis_channel.return_value = channel
+    mock_priority_redis_channel.DEFAULT_ARGS = channel_default_args
+
+    client = kadabra.Kadabra(\
+            configuration={"CLIENT_CHANNEL_TYPE": "priority_redis"})
+
+    mock_priority_redis_channel.assert_called_with(**channel_default_args)
+    assert client.channel == channel
+
+@mock.patch('kadabra.client.RedisChannel')
+def test_client_ctor_prewarm(mock_redis_channel):
+    mock_redis_channel.DEFAULT_ARGS = {}
+    channel = mock_redis_channel.return_value
+
+    kadabra.Kadabra(configuration={"CLIENT_CHANNEL_PREWARM": True})
+
+    channel.prewarm.assert_called_with()
+
+@mock.patch('kadabra.client.os.getpid')
+@mock.patch('kadabra.client.RedisChannel')
+def test_client_send_after_fork(mock_redis_channel, mock_getpid):
+    mock_redis_channel.DEFAULT_ARGS = {}
+    channel = mock_redis_channel.return_value
+    metrics = MagicMock()
+    mock_getpid.return_value = 1
+
+    client = kadabra.Kadabra(configuration={"CLIENT_CHANNEL_PREWARM": True})
+    channel.prewarm.reset_mock()
+    client.send(metrics)
+
+    assert channel.reset.call_count == 0
+
+    mock_getpid.return_value = 2
+    client.send(metrics)
+    client.send(metrics)
+
+    channel.reset.assert_called_once_with()
+    channel.prewarm.assert_called_once_with()
+    channel.send.assert_has_calls([call(metrics) for i in range(3)])
+    assert client.pid == 2
+
+@pytest.mark.skipif(not hasattr(os, "fork") or\
+        not hasattr(os, "register_at_fork"), reason="requires os.fork")
+@mock.patch('kadabra.client.RedisChannel')
+def test_client_reset_in_forked_child(mock_redis_channel):
+    mock_redis_channel.DEFAULT_ARGS = {}
+    channel = mock_redis_channel.return_value
+
+    client = kadabra.Kadabra()
+
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0 if channel.reset.call_count == 1 and\
+                client.pid == os.getpid() else 1)
+    _, status = os.waitpid(pid, 0)
+
+    assert os.WEXITSTATUS(status) == 0
+    assert channel.reset.call_count == 0
+
+def get_failover_metrics(name="value"):
+    return kadabra.Metrics([kadabra.Dimension("name", name)], [], [])
+
+def wait_for_sends(channel, count):
+    import time
+    deadline = time.time() + 5
+    while channel.send.call_count < count and time.time() < deadline:
+        time.sleep(0.01)
+
+@mock.patch('kadabra.client.RedisChannel')
+def test_client_send_failover(mock_redis_channel, tmpdir):
+    mock_redis_channel.DEFAULT_ARGS = {}
+    channel = mock_redis_channel.return_value
+    channel.send.side_effect = Exception("Redis is down")
+
+    client = kadabra.Kadabra(configuration={
+        "CLIENT_FAILOVER_PATH": str(tmpdir),
+        "CLIENT_FAILOVER_RETRY_SECONDS": 60})
+    client.send(get_failover_metrics("one"))
+    client.send(get_failover_metrics("two"))
+
+    # The channel isn't retried while it is down.
+    assert channel.send.call_count == 1
+    assert client.failover.is_down()
+    with open(client.failover._file_path()) as f:
+        lines = [kadabra.Metrics.deserialize(json.loads(l)) for l in f]
+    assert [m.dimensions[0].value for m in lines] == ["one", "two"]
+
+@mock.patch('kadabra.client.RedisChannel')
+def test_client_failover_replay(mock_redis_channel, tmpdir):
+    mock_redis_channel.DEFAULT_ARGS = {}
+    channel = mock_redis_channel.return_value
+    channel.send.side_effect = [Exception("Redis is down"), None, None]
+
+    client = kadabra.Kadabra(configuration={
+        "CLIENT_FAILOVER_PATH": str(tmpdir),
+        "CLIENT_FAILOVER_RETRY_SECONDS": 0.05,
+        "CLIENT_FAILOVER_REPLAY_RATE": 1000})
+    client.send(get_failover_metrics("one"))
+    client.send(get_failover_metrics("two"))
+
+    wait_for_sends(channel, 3)
+    replayer = client.failover.replayer
+    if replayer is not None:
+        replayer.join(5)
+    replayed = [c[0][0].dimensions[0].value for c in
+            channel.send.call_args_list[1:]]
+    assert replayed == ["one", "two"]
+    assert os.path.getsize(client.failover._file_path()) == 0
+
+def test_failover_max_bytes(tmpdir):
+    size = len(json.dumps(get_failover_metrics("one").serialize())) + 1
+    failover = kadabra.client.FailoverBuffer(MagicMock(), str(tmpdir),
+            size + 10, 100, 60)
+    failover.mark_down()
+
+    assert failover.append(get_failover_metrics("one"))
+    assert not failover.append(get_failover_metrics("two"))
+    assert failover.dropped == 1
+
+def test_failover_short_writes(tmpdir):
+    failover = kadabra.client.FailoverBuffer(MagicMock(), str(tmpdir), 1024,
+            100, 60)
+    failover.mark_down()
+    real_write = os.write
+
+    with mock.patch('kadabra.client.os.write',
+            side_effect=lambda fd, data: real_write(fd, data[:5])):
+        assert failover.append(get_failover_metrics("one"))
+
+    with open(failover._file_path()) as f:
+        lines = [kadabra.Metrics.deserialize(json.loads(l)) for l in f]
+    assert [m.dimensions[0].value for m in lines] == ["one"]
+    assert failover.size == os.path.getsize(failover._file_path())
+
+def test_failover_disk_full(tmpdir):
+    failover = kadabra.client.FailoverBuffer(MagicMock(), str(tmpdir), 1024,
+            100, 60)
+    failover.mark_down()
+    failover.append(get_failover_metrics("one"))
+    size = failover.size
+    real_write = os.write
+    writes = []
+    def write(fd, data):
+        writes.append(data)
+        if len(writes) == 1:
+            return real_write(fd, data[:5])
+        raise OSError(28, "No space left on device")
+
+    with mock.patch('kadabra.client.os.write', side_effect=write):
+        assert not failover.append(get_failover_metrics("two"))
+
+    assert failover.dropped == 1
+    assert failover.size == size
+    assert os.path.getsize(failover._file_path()) == size
+
+def test_failover_skips_unreadable_lines(tmpdir):
+    orphan = tmpdir.join("kadabra-failover-999999999.log")
+    orphan.write("".join([json.dumps(get_failover_metrics("one").serialize()),
+        "\n{not json\n", json.dumps(get_failover_metrics("two").serialize()),
+        "\n"]))
+    channel = MagicMock()
+    failover = kadabra.client.FailoverBuffer(channel, str(tmpdir), 1024,
+            1000, 60)
+
+    failover.start()
+    wait_for_sends(channel, 2)
+    replayer = failover.replayer
+    if replayer is not None:
+        replayer.join(5)
+
+    assert [c[0][0].dimensions[0].value for c in
+            channel.send.call_args_list] == ["one", "two"]
+    assert failover.unreadable == 1
+    assert not failover.is_down()
+
+def test_failover_adopts_orphans(tmpdir):
+    metrics = get_failover_metrics("orphan")
+    orphan = tmpdir.join("kadabra-failover-999999999.log")
+    orphan.write(json.dumps(metrics.serialize()) + "\n")
+    channel = MagicMock()
+
+    failover = kadabra.client.FailoverBuffer(channel, str(tmpdir), 1024,
+            1000, 60)
+    failover.start()
+
+    wait_for_sends(channel, 1)
+    assert channel.send.call_args[0][0].dimensions[0].value == "orphan"
+    assert not orphan.check()
+
+def test_failover_reset(tmpdir):
+    failover = kadabra.client.FailoverBuffer(MagicMock(), str(tmpdir), 1024,
+            100, 60)
+    failover.mark_down()
+    failover.append(get_failover_metrics("one"))
+
+    failover.reset()
+
+    assert failover.fd is None
+    assert failover.size == 0
+    assert failover.replayer is None
+    assert not failover.is_down()
+
+def test_failover_reset_adopts_orphans(tmpdir):
+    metrics = get_failover_metrics("orphan")
+    orphan = tmpdir.join("kadabra-failover-999999999.log")
+    channel = MagicMock()
+    failover = kadabra.client.FailoverBuffer(channel, str(tmpdir), 1024,
+            1000, 60)
+    failover.start()
+    orphan.write(json.dumps(metrics.serialize()) + "\n")
+
+    failover.reset()
+
+    wait_for_sends(channel, 1)
+    assert channel.send.call_args[0][0].dimensions[0].value == "orphan"
+    assert not orphan.check()
@@ -0,0 +1,149 @@
+import kadabra
+import json
+import time
+import pytest
+
+logger = "testlogger"
+
+@pytest.fixture
+def agent_channel():
+    channel = kadabra.channels.DatagramChannel("127.0.0.1", 0, logger,
+            receive_timeout=1)
+    channel.listen()
+    yield channel
+    channel.close()
+
+def get_client(agent_channel, **kwargs):
+    return kadabra.channels.DatagramChannel("127.0.0.1",
+            agent_channel.listener.address[1], logger, **kwargs)
+
+def get_metrics(name="value"):
+    return kadabra.Metrics([kadabra.Dimension("name", name)], [], [])
+
+def wait_for(channel, count):
+    received = []
+    deadline = time.time() + 5
+    while len(received) < count and time.time() < deadline:
+        received.extend(channel.receive_batch(count - len(received)))
+        time.sleep(0.01)
+    return received
+
+def test_ctor():
+    channel = kadabra.channels.DatagramChannel("host", 1234, logger,
+            max_datagram_size=512)
+
+    assert channel.host == "host"
+    assert channel.port == 1234
+    assert channel.logger.name == logger
+    assert channel.max_datagram_size == 512
+    assert channel.sock is None
+    assert channel.listener is None
+
+def test_send_receive(agent_channel):
+    client_channel = get_client(agent_channel)
+
+    client_channel.send(get_metrics("one"))
+    client_channel.send(get_metrics("two"))
+
+    received = wait_for(agent_channel, 2)
+    assert [m.dimensions[0].value for m in received] == ["one", "two"]
+    assert agent_channel.in_progress(10) == received
+    assert client_channel.stats()["sent"] == 2
+    assert agent_channel.stats()["received"] == 2
+    client_channel.close()
+
+def test_packing(agent_channel):
+    client_channel = get_client(agent_channel, flush_interval=60)
+    frame_size = len(client_channel.HEADER.pack(0)) +\
+            len(json.dumps(get_metrics("0").serialize()))
+    client_channel.max_datagram_size = frame_size * 3
+
+    for i in range(5):
+        client_channel.send(get_metrics(str(i)))
+
+    # Three frames fit in the first datagram, the other two are pending.
+    assert client_channel.stats()["sent"] == 3
+    assert client_channel.pending_count == 2
+    client_channel.flush()
+    assert client_channel.stats()["sent"] == 5
+
+    received = wait_for(agent_channel, 5)
+    assert [m.dimensions[0].value for m in received] ==\
+            ["0", "1", "2", "3", "4"]
+    client_channel.close()
+
+def test_flush_interval(agent_channel):
+    client_channel = get_client(agent_channel, flush_interval=0.01)
+
+    client_channel.send(get_metrics("one"))
+
+    assert agent_channel.receive().dimensions[0].value == "one"
+    client_channel.close()
+
+def test_too_large(agent_channel):
+    client_channel = get_client(agent_channel, max_datagram_size=10)
+
+    client_channel.send(get_metrics("one"))
+
+    assert client_channel.stats()["too_large"] == 1
+    assert client_channel.stats()["sent"] == 0
+
+def test_send_failure_is_counted():
+    client_channel = kadabra.channels.DatagramChannel("127.0.0.1", 1, logger,
+            unix_socket_path="/nonexistent/kadabra.sock")
+
+    client_channel.send(get_metrics("one"))
+
+    assert client_channel.stats()["failed"] == 1
+
+def test_truncated(agent_channel):
+    client_channel = get_client(agent_channel)
+    client_channel._send(b"\x00\x00\x01\x00{", 1)
+    client_channel._send(b"\x00\x00\x00\x01x", 1)
+
+    deadline = time.time() + 5
+    while agent_channel.stats()["truncated"] < 2 and time.time() < deadline:
+        time.sleep(0.01)
+
+    assert agent_channel.stats()["truncated"] == 2
+    assert agent_channel.stats()["received"] == 0
+
+def test_unreadable_frames():
+    header = kadabra.channels.DatagramChannel.HEADER
+    good = json.dumps(get_metrics("one").serialize()).encode("utf-8")
+    datagram = b"".join(header.pack(len(f)) + f
+            for f in [b"[]", b'{"foo": 1}', good])
+
+    channel = kadabra.channels.DatagramChannel("127.0.0.1", 0, logger)
+    listener = kadabra.channels._DatagramListener(channel)
+    metrics, truncated = listener._parse(memoryview(datagram), False)
+    listener.sock.close()
+
+    assert [m.dimensions[0].value for m in metrics] == ["one"]
+    assert truncated == 2
+
+def test_unix_socket(tmpdir):
+    path = str(tmpdir.join("kadabra.sock"))
+    agent_channel = kadabra.channels.DatagramChannel(None, None, logger,
+            unix_socket_path=path)
+    agent_channel.listen()
+    client_channel = kadabra.channels.DatagramChannel(None, None, logger,
+            unix_socket_path=path)
+
+    client_channel.send(get_metrics("one"))
+
+    assert [m.dimensions[0].value for m in wait_for(agent_channel, 1)] ==\
+            ["one"]
+    agent_channel.close()
+    client_channel.close()
+
+def test_reset():
+    client_channel = kadabra.channels.DatagramChannel("127.0.0.1", 1, logger,
+            flush_interval=60)
+    client_channel.send(get_metrics("one"))
+
+    client_channel.reset()
+
+    assert client_channel.pending_count == 0
+    assert len(client_channel.pending) == 0
+    assert client_channel.flusher is None
@@ -0,0 +1,109 @@
+import kadabra
+import pytest
+
+from mock import MagicMock, mock
+
+def get_metrics(metrics_id):
+    return kadabra.Metrics([], [], [], serialized_at="now", id=metrics_id)
+
+def test_ctor():
+    dedup_filter = kadabra.agent.DedupFilter(60, 1000, 0.01)
+
+    assert dedup_filter.num_bits == 9586
+    assert dedup_filter.num_hashes == 7
+    assert len(dedup_filter.current) == 1199
+    assert dedup_filter.stats() == {"checked": 0, "duplicates": 0,
+            "duplicate_rate": 0.0}
+
+def test_contains():
+    dedup_filter = kadabra.agent.DedupFilter(60, 1000, 0.01)
+
+    assert not dedup_filter.contains("one")
+    dedup_filter.add("one")
+    assert dedup_filter.contains("one")
+    assert not dedup_filter.contains("two")
+
+    assert dedup_filter.stats() == {"checked": 3, "duplicates": 1,
+            "duplicate_rate": 1 / 3.0}
+
+def test_error_rate():
+    dedup_filter = kadabra.agent.DedupFilter(60, 1000, 0.01)
+    for i in range(1000):
+        dedup_filter.add("added-%d" % i)
+
+    false_positives = sum(dedup_filter.contains("other-%d" % i)
+            for i in range(10000))
+    assert false_positives < 200
+
+@mock.patch('kadabra.agent.time.time')
+def test_rotate_after_window(mock_time):
+    mock_time.return_value = 100
+    dedup_filter = kadabra.agent.DedupFilter(60, 1000, 0.01)
+    dedup_filter.add("one")
+
+    mock_time.return_value = 170
+    assert dedup_filter.contains("one")
+    dedup_filter.add("two")
+
+    mock_time.return_value = 240
+    assert not dedup_filter.contains("one")
+    assert dedup_filter.contains("two")
+
+def test_rotate_at_capacity():
+    dedup_filter = kadabra.agent.DedupFilter(60, 2, 0.01)
+    dedup_filter.add("one")
+    dedup_filter.add("two")
+    dedup_filter.add("three")
+    dedup_filter.add("four")
+    dedup_filter.add("five")
+
+    assert not dedup_filter.contains("one")
+    assert dedup_filter.contains("three")
+    assert dedup_filter.contains("five")
+
+def test_publish_drops_duplicates():
+    publisher = MagicMock()
+    dedup_filter = kadabra.agent.DedupFilter(60, 1000, 0.01)
+    dedup = kadabra.agent.DedupPublisher(publisher, dedup_filter, MagicMock())
+    one = get_metrics("one")
+    two = get_metrics("two")
+    no_id = get_metrics(None)
+
+    dedup.publish([one, no_id])
+    publisher.publish.assert_called_with([one, no_id])
+
+    publisher.publish.reset_mock()
+    dedup.publish([get_metrics("one"), two, no_id])
+    publisher.publish.assert_called_with([two, no_id])
+
+    publisher.publish.reset_mock()
+    dedup.publish([get_metrics("two")])
+    assert not publisher.publish.called
+
+    assert dedup.stats()["duplicates"] == 2
+
+def test_publish_failure_not_remembered():
+    publisher = MagicMock()
+    publisher.publish.side_effect = Exception("Backend is down")
+    dedup_filter = kadabra.agent.DedupFilter(60, 1000, 0.01)
+    dedup = kadabra.agent.DedupPublisher(publisher, dedup_filter, MagicMock())
+    metrics = get_metrics("one")
+
+    with pytest.raises(Exception):
+        dedup.publish([metrics])
+
+    publisher.publish.side_effect = None
+    dedup.publish([metrics])
+    publisher.publish.assert_called_with([metrics])
+
+def test_publish_rejected_not_remembered():
+    publisher = MagicMock()
+    dedup_filter = kadabra.agent.DedupFilter(60, 1000, 0.01)
+    dedup = kadabra.agent.DedupPublisher(publisher, dedup_filter, MagicMock())
+    one = get_metrics("one")
+    two = get_metrics("two")
+    publisher.publish.return_value = [two]
+
+    assert dedup.publish([one, two]) == [two]
+    assert dedup_filter.contains("one")
+    assert not dedup_filter.contains("two")
@@ -1,5 +1,6 @@
 import kadabra
 import influxdb
+import pytest
 import datetime
 
 from mock import MagicMock, mock
@@ -168,3 +169,46 @@ def test_publish(mock_influxdb):
 
     publisher.client.write_points.assert_called_with(expected_points)
 
+
+def get_counter_metrics(name):
+    counter = MagicMock()
+    counter.name = name
+    counter.value = 1.0
+    counter.timestamp = datetime.datetime.utcnow()
+    counter.metadata = {}
+
+    metrics = MagicMock()
+    metrics.timestamp_format = "%Y-%m-%dT%H:%M:%SZ"
+    metrics.dimensions = []
+    metrics.counters = [counter]
+    metrics.timers = []
+    return metrics
+
+def reject(measurement, code):
+    def write_points(points):
+        if measurement in [p["measurement"] for p in points]:
+            raise influxdb.exceptions.InfluxDBClientError("bad", code)
+    return write_points
+
+@mock.patch('influxdb.InfluxDBClient')
+def test_publish_isolates_rejected_points(mock_influxdb):
+    metrics = [get_counter_metrics("counter%d" % i) for i in range(8)]
+    mock_influxdb.return_value.write_points.side_effect =\
+            reject("counter5", 400)
+
+    publisher = kadabra.publishers.InfluxDBPublisher("host", 1234, "db", 3)
+    rejected = publisher.publish(metrics)
+
+    assert rejected == [metrics[5]]
+    assert publisher.client.write_points.call_count == 7
+
+@mock.patch('influxdb.InfluxDBClient')
+def test_publish_other_errors_raised(mock_influxdb):
+    metrics = [get_counter_metrics("counter%d" % i) for i in range(8)]
+    mock_influxdb.return_value.write_points.side_effect =\
+            reject("counter5", 404)
+
+    publisher = kadabra.publishers.InfluxDBPublisher("host", 1234, "db", 3)
+    with pytest.raises(influxdb.exceptions.InfluxDBClientError):
+        publisher.publish(metrics)
+    assert publisher.client.write_points.call_count == 1
@@ -0,0 +1,55 @@
+import kadabra
+import datetime
+import pytest
+
+from mock import MagicMock
+
+def get_metrics(age_seconds):
+    serialized_at = datetime.datetime.utcnow() -\
+            datetime.timedelta(seconds=age_seconds)
+    return kadabra.Metrics([], [], [],
+            serialized_at=serialized_at.strftime("%Y-%m-%dT%H:%M:%S.%fZ"))
+
+def test_ctor():
+    with pytest.raises(Exception):
+        kadabra.agent.MaxAge(60, "keep", MagicMock())
+
+def test_expire_drop():
+    channel = MagicMock()
+    fresh = get_metrics(10)
+    old = get_metrics(120)
+    no_timestamp = kadabra.Metrics([], [], [])
+    max_age = kadabra.agent.MaxAge(60, "drop", MagicMock())
+
+    assert max_age.expire(channel, [fresh, old, no_timestamp]) ==\
+            [fresh, no_timestamp]
+
+    channel.complete.assert_called_with([old])
+    assert not channel.dead_letter.called
+    assert max_age.stats() == {"expired": 1}
+
+def test_expire_divert():
+    channel = MagicMock()
+    old = get_metrics(120)
+    max_age = kadabra.agent.MaxAge(60, "divert", MagicMock())
+
+    assert max_age.expire(channel, [old]) == []
+
+    channel.dead_letter.assert_called_with([old])
+    assert not channel.complete.called
+
+def test_expire_divert_without_dead_letter():
+    channel = MagicMock(spec=["complete"])
+    old = get_metrics(120)
+    max_age = kadabra.agent.MaxAge(60, "divert", MagicMock())
+
+    assert max_age.expire(channel, [old]) == []
+
+    channel.complete.assert_called_with([old])
+
+def test_expire_nothing():
+    channel = MagicMock()
+    max_age = kadabra.agent.MaxAge(60, "drop", MagicMock())
+
+    assert max_age.expire(channel, []) == []
+    assert not channel.complete.called
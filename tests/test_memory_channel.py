@@ -0,0 +1,96 @@
+import kadabra
+import threading
+
+from mock import MagicMock
+
+logger = "testlogger"
+
+def get_unit(name):
+    return kadabra.channels.MemoryChannel(name, logger, receive_timeout=0.01)
+
+def get_metrics():
+    return kadabra.Metrics([kadabra.Dimension("name", "value")], [], [])
+
+def test_ctor():
+    channel = get_unit("test_ctor")
+
+    assert channel.name == "test_ctor"
+    assert channel.logger.name == logger
+    assert channel.queue is kadabra.channels.get_local_queue("test_ctor")
+    assert channel.queue is not kadabra.channels.get_local_queue("other")
+
+def test_send_receive():
+    client_channel = get_unit("test_send_receive")
+    agent_channel = get_unit("test_send_receive")
+    metrics = get_metrics()
+
+    client_channel.send(metrics)
+    received = agent_channel.receive()
+
+    assert received is not metrics
+    assert received.serialized_at is not None
+    assert received.dimensions[0].name == "name"
+    assert agent_channel.in_progress(10) == [received]
+    assert agent_channel.receive() is None
+
+def test_receive_waits_for_metrics():
+    channel = kadabra.channels.MemoryChannel("test_receive_waits", logger,
+            receive_timeout=5)
+    sender = threading.Timer(0.05, channel.send, [get_metrics()])
+    sender.start()
+
+    received = channel.receive()
+    sender.join()
+
+    assert received is not None
+
+def test_receive_batch():
+    channel = get_unit("test_receive_batch")
+    for i in range(3):
+        channel.send(get_metrics())
+
+    batch = channel.receive_batch(2)
+
+    assert len(batch) == 2
+    assert channel.in_progress(10) == batch
+    assert len(channel.receive_batch(2)) == 1
+    assert channel.receive_batch(2) == []
+
+def test_complete():
+    channel = get_unit("test_complete")
+    for i in range(3):
+        channel.send(get_metrics())
+    batch = channel.receive_batch(3)
+
+    channel.complete(batch[:2])
+
+    assert channel.in_progress(10) == batch[2:]
+
+def test_in_progress_limit():
+    channel = get_unit("test_in_progress_limit")
+    for i in range(3):
+        channel.send(get_metrics())
+    batch = channel.receive_batch(3)
+
+    assert channel.in_progress(2) == batch[:2]
+
+def test_agent_in_process():
+    config = {"CLIENT_CHANNEL_TYPE": "memory",
+              "CLIENT_CHANNEL_ARGS": {"name": "test_agent_in_process"},
+              "AGENT_CHANNEL_TYPE": "memory",
+              "AGENT_CHANNEL_ARGS": {"name": "test_agent_in_process",
+                  "receive_timeout": 0.01}}
+    client = kadabra.Kadabra(configuration=config)
+    agent = kadabra.Agent(configuration=config)
+    publisher = MagicMock()
+    receiver_thread = agent.receiver.threads[0]
+    receiver_thread.publisher = publisher
+
+    collector = client.metrics()
+    collector.add_count("count", 1.0)
+    client.send(collector.close())
+    receiver_thread._run_once()
+
+    published = publisher.publish.call_args[0][0]
+    assert published[0].counters[0].name == "count"
+    assert client.channel.in_progress(10) == []
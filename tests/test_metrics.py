@@ -181,6 +181,13 @@ def test_metrics_serialize():
     metrics = kadabra.Metrics(dimensions, counters, timers, timestamp_format,
             "test")
     assert metrics.serialize()["serialized_at"] == "test"
+    assert "id" not in metrics.serialize()
+
+def test_metrics_id_round_trip():
+    metrics = kadabra.Metrics([], [], [], serialized_at="now", id="abc")
+    serialized = metrics.serialize()
+    assert serialized["id"] == "abc"
+    assert kadabra.Metrics.deserialize(serialized).id == "abc"
 
 # Note: multiple mock patches apply to the function args in reverse order.
 @mock.patch("kadabra.Dimension.deserialize")
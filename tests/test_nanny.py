@@ -1,5 +1,5 @@
 import kadabra
-import datetime
+import datetime, json
 
 from mock import MagicMock, mock, call
 
@@ -53,8 +53,10 @@ def test_start(mock_timer, mock_nanny_thread):
     nanny.start()
 
     mock_nanny_thread.assert_has_calls(
-            [call(channel, publisher, nanny.queue, logger) for x in
-                nanny_threads])
+            [call(channel, publisher, nanny.queue, logger,
+                circuit_breaker=None, rate_limiter=None, backoff=None,
+                in_flight=None, lease=None, retry_queue=False)
+                for x in nanny_threads])
     for i in range(len(nanny_threads)):
         expected_name = "KadabraNannyThread-%s" % str(i)
         assert nanny.threads[i].name == expected_name
@@ -68,6 +70,7 @@ def test_run_nanny(mock_timer, mock_get_datetime_from_timestamp_string):
     timestamp_format = "%Y-%m-%dT%H:%M:%SZ"
     metrics_one.serialized_at = STRPTIME.strftime(timestamp_format)
     metrics_one.timestamp_format = timestamp_format
+    metrics_one.in_progress_seconds = None
     metrics = [metrics_one]
 
     channel = MagicMock()
@@ -85,11 +88,11 @@ def test_run_nanny(mock_timer, mock_get_datetime_from_timestamp_string):
     nanny = kadabra.agent.Nanny(channel, publisher, logger, frequency_seconds,
             threshold_seconds, query_limit, num_threads)
     nanny.queue = MagicMock()
-    nanny.queue.put = MagicMock()
+    nanny.queue.put_nowait = MagicMock()
     nanny._run_nanny()
 
     channel.in_progress.assert_called_with(query_limit)
-    nanny.queue.put.assert_called_with(metrics_one)
+    nanny.queue.put_nowait.assert_called_with(metrics_one)
     mock_timer.assert_called_with(frequency_seconds, nanny._run_nanny)
     assert timer.name == "KadabraNanny"
     timer.start.assert_called_with()
@@ -115,11 +118,11 @@ def test_run_nanny_missing_serialized_at(mock_timer):
     nanny = kadabra.agent.Nanny(channel, publisher, logger, frequency_seconds,
             threshold_seconds, query_limit, num_threads)
     nanny.queue = MagicMock()
-    nanny.queue.put = MagicMock()
+    nanny.queue.put_nowait = MagicMock()
     nanny._run_nanny()
 
     channel.in_progress.assert_called_with(query_limit)
-    nanny.queue.put.assert_called_with(metrics_one)
+    nanny.queue.put_nowait.assert_called_with(metrics_one)
     mock_timer.assert_called_with(frequency_seconds, nanny._run_nanny)
     assert timer.name == "KadabraNanny"
     timer.start.assert_called_with()
@@ -143,11 +146,11 @@ def test_run_nanny_no_metrics(mock_timer):
     nanny = kadabra.agent.Nanny(channel, publisher, logger, frequency_seconds,
             threshold_seconds, query_limit, num_threads)
     nanny.queue = MagicMock()
-    nanny.queue.put = MagicMock()
+    nanny.queue.put_nowait = MagicMock()
     nanny._run_nanny()
 
     channel.in_progress.assert_called_with(query_limit)
-    nanny.queue.put.assert_has_calls([])
+    nanny.queue.put_nowait.assert_has_calls([])
     mock_timer.assert_called_with(frequency_seconds, nanny._run_nanny)
     assert timer.name == "KadabraNanny"
     timer.start.assert_called_with()
@@ -170,12 +173,12 @@ def test_run_nanny_exception(mock_timer):
     nanny = kadabra.agent.Nanny(channel, publisher, logger, frequency_seconds,
             threshold_seconds, query_limit, num_threads)
     nanny.queue = MagicMock()
-    nanny.queue.put = MagicMock()
+    nanny.queue.put_nowait = MagicMock()
     nanny._run_nanny()
 
     channel.in_progress.assert_called_with(query_limit)
 
-    nanny.queue.put.assert_has_calls([])
+    nanny.queue.put_nowait.assert_has_calls([])
     mock_timer.assert_called_with(frequency_seconds, nanny._run_nanny)
     assert timer.name == "KadabraNanny"
     timer.start.assert_called_with()
@@ -232,3 +235,169 @@ def test_stop_timer_none():
     nanny.timer.cancel.assert_called_with()
     for thread in threads:
         thread.stop.assert_called_with()
+
+def get_metrics(name, serialized_at):
+    return kadabra.Metrics([kadabra.Dimension("name", name)], [], [],
+            serialized_at=serialized_at.strftime("%Y-%m-%dT%H:%M:%S.%fZ"))
+
+@mock.patch('kadabra.agent.Timer')
+def test_run_nanny_freshest_first(mock_timer):
+    old = get_metrics("old", NOW - datetime.timedelta(seconds=300))
+    new = get_metrics("new", NOW - datetime.timedelta(seconds=100))
+    channel = MagicMock()
+    channel.in_progress.return_value = [old, new]
+
+    nanny = kadabra.agent.Nanny(channel, MagicMock(), MagicMock(), 30, 60,
+            100, 1)
+    nanny._run_nanny()
+
+    assert nanny.queue.get_nowait() is new
+    assert nanny.queue.get_nowait() is old
+
+@mock.patch('kadabra.agent.Timer')
+def test_run_nanny_backoff(mock_timer):
+    failed = get_metrics("failed", NOW - datetime.timedelta(seconds=300))
+    other = get_metrics("other", NOW - datetime.timedelta(seconds=300))
+    channel = MagicMock()
+    channel.in_progress.return_value = [failed, other]
+    backoff = kadabra.agent.RetryBackoff(30, 600)
+    backoff.record_failure([failed])
+
+    nanny = kadabra.agent.Nanny(channel, MagicMock(), MagicMock(), 30, 60,
+            100, 1, backoff=backoff)
+    nanny._run_nanny()
+
+    assert nanny.queue.get_nowait() is other
+    assert nanny.queue.empty()
+
+@mock.patch('kadabra.agent.Timer')
+def test_run_nanny_deduplicate(mock_timer):
+    metrics = get_metrics("one", NOW - datetime.timedelta(seconds=300))
+    channel = MagicMock()
+    channel.in_progress.return_value = [metrics]
+
+    nanny = kadabra.agent.Nanny(channel, MagicMock(), MagicMock(), 30, 60,
+            100, 1, deduplicate=True)
+    nanny._run_nanny()
+    nanny._run_nanny()
+
+    assert nanny.queue.get_nowait() is metrics
+    assert nanny.queue.empty()
+    assert len(nanny.in_flight) == 1
+
+    nanny.in_flight.discard(kadabra.agent._metrics_key(metrics))
+    nanny._run_nanny()
+    assert nanny.queue.get_nowait() is metrics
+
+@mock.patch('kadabra.agent.Timer')
+def test_run_nanny_queue_full(mock_timer):
+    old = get_metrics("old", NOW - datetime.timedelta(seconds=300))
+    new = get_metrics("new", NOW - datetime.timedelta(seconds=100))
+    channel = MagicMock()
+    channel.in_progress.return_value = [old, new]
+
+    nanny = kadabra.agent.Nanny(channel, MagicMock(), MagicMock(), 30, 60,
+            100, 1, max_queue_size=1, deduplicate=True)
+    nanny._run_nanny()
+
+    assert nanny.queue.get_nowait() is new
+    assert nanny.queue.empty()
+    assert len(nanny.in_flight) == 1
+
+@mock.patch('kadabra.agent.random.uniform', side_effect=lambda a, b: b)
+@mock.patch('kadabra.agent.time.time', return_value=1000)
+def test_retry_backoff(mock_time, mock_uniform):
+    metrics = get_metrics("one", NOW)
+    backoff = kadabra.agent.RetryBackoff(30, 100)
+
+    assert backoff.ready(metrics)
+    backoff.record_failure([metrics])
+    assert not backoff.ready(metrics)
+    assert list(backoff.attempts.values()) == [(1, 1030)]
+
+    backoff.record_failure([metrics])
+    backoff.record_failure([metrics])
+    backoff.record_failure([metrics])
+    assert list(backoff.attempts.values()) == [(4, 1100)]
+
+    # A fresh instance of the same metrics (as returned by the channel) is
+    # recognized.
+    copy = kadabra.Metrics.deserialize(metrics.serialize())
+    mock_time.return_value = 1100
+    assert backoff.ready(copy)
+    backoff.record_success([copy])
+    assert len(backoff.attempts) == 0
+
+def test_retry_backoff_max_entries():
+    backoff = kadabra.agent.RetryBackoff(30, 100, max_entries=2)
+
+    backoff.record_failure([get_metrics(str(i), NOW) for i in range(3)])
+
+    assert len(backoff.attempts) == 2
+
+def test_retry_backoff_exhausted():
+    one = get_metrics("one", NOW)
+    two = get_metrics("two", NOW)
+    backoff = kadabra.agent.RetryBackoff(30, 100, max_attempts=2)
+
+    backoff.record_failure([one, two])
+    assert backoff.exhausted([one, two]) == []
+    backoff.record_failure([one])
+    assert backoff.exhausted([one, two]) == [one]
+
+    assert kadabra.agent.RetryBackoff(30, 100).exhausted([one]) == []
+
+@mock.patch('kadabra.agent.Timer')
+def test_run_nanny_lease_held_elsewhere(mock_timer):
+    channel = MagicMock()
+    lease = MagicMock()
+    lease.acquire.return_value = False
+
+    nanny = kadabra.agent.Nanny(channel, MagicMock(), MagicMock(), 30, 60,
+            100, 1, lease=lease)
+    nanny._run_nanny()
+
+    assert not channel.in_progress.called
+    assert nanny.queue.empty()
+
+    nanny.stop()
+    lease.release.assert_called_with()
+
+@mock.patch('kadabra.agent.Timer')
+def test_run_nanny_breaker_not_checked_without_lease(mock_timer):
+    lease = MagicMock()
+    lease.acquire.return_value = False
+    breaker = MagicMock()
+
+    nanny = kadabra.agent.Nanny(MagicMock(), MagicMock(), MagicMock(), 30, 60,
+            100, 1, circuit_breaker=breaker, lease=lease)
+    nanny._run_nanny()
+
+    assert not breaker.is_open.called
+
+@mock.patch('kadabra.agent.Timer')
+def test_run_nanny_skewed_clients(mock_timer):
+    # One client's clock is ten minutes ahead, so its stuck metrics look
+    # fresh, and another's is ten minutes behind, so its fresh metrics look
+    # stuck. The Redis server's clock says which have really been in progress
+    # for longer than the threshold.
+    ahead_stuck = get_metrics("ahead", NOW + datetime.timedelta(minutes=10))
+    behind_fresh = get_metrics("behind", NOW - datetime.timedelta(minutes=10))
+    now_ms = 1500000000000
+    client = MagicMock()
+    client.register_script.return_value = MagicMock(return_value=[now_ms,
+        [json.dumps(ahead_stuck.serialize()),
+            json.dumps(behind_fresh.serialize())],
+        [now_ms - 120000, now_ms - 5000]])
+    channel = kadabra.channels.RedisChannel("localhost", 6379, 0,
+            "kadabra.channel", "queue", "inprogress", client=client,
+            server_timestamps=True)
+
+    nanny = kadabra.agent.Nanny(channel, MagicMock(), MagicMock(), 30, 60,
+            100, 1)
+    nanny._run_nanny()
+
+    republished = nanny.queue.get_nowait()
+    assert republished.dimensions[0].value == "ahead"
+    assert republished.in_progress_seconds == 120
+    assert nanny.queue.empty()
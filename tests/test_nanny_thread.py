@@ -132,3 +132,122 @@ def test_run():
 
     assert nanny_thread._check_stopped.call_count == 2
     assert nanny_thread._run_once.call_count == 1
+
+def test_run_once_rate_limit_and_backoff():
+    channel = MagicMock()
+    publisher = MagicMock()
+    publisher.publish.side_effect = Exception("Backend is down")
+    queue = MagicMock()
+    metrics = queue.get.return_value
+    rate_limiter = MagicMock()
+    backoff = MagicMock()
+
+    nanny_thread = kadabra.agent.NannyThread(channel, publisher, queue,
+            MagicMock(), rate_limiter=rate_limiter, backoff=backoff)
+    nanny_thread._run_once()
+
+    rate_limiter.acquire.assert_called_with()
+    backoff.record_failure.assert_called_with([metrics])
+    assert not channel.complete.called
+
+    publisher.publish.side_effect = None
+    nanny_thread._run_once()
+
+    channel.complete.assert_called_with([metrics])
+    backoff.record_success.assert_called_with([metrics])
+
+def test_run_once_in_flight():
+    channel = MagicMock()
+    publisher = MagicMock()
+    publisher.publish.side_effect = Exception("Backend is down")
+    metrics = kadabra.Metrics([], [], [],
+            serialized_at="2016-01-01T00:00:00.000000Z")
+    key = kadabra.agent._metrics_key(metrics)
+    queue = MagicMock()
+    queue.get.return_value = metrics
+    in_flight = kadabra.agent.InFlight()
+    in_flight.add(key)
+
+    nanny_thread = kadabra.agent.NannyThread(channel, publisher, queue,
+            MagicMock(), in_flight=in_flight)
+    nanny_thread._run_once()
+
+    assert len(in_flight) == 0
+    assert in_flight.add(key)
+
+def test_run_once_lease_lost():
+    channel = MagicMock()
+    publisher = MagicMock()
+    queue = MagicMock()
+    lease = MagicMock()
+    lease.check.return_value = False
+
+    nanny_thread = kadabra.agent.NannyThread(channel, publisher, queue,
+            MagicMock(), lease=lease)
+    nanny_thread._run_once()
+
+    assert not publisher.publish.called
+    assert not channel.complete.called
+
+def test_run_once_dead_letter():
+    channel = MagicMock()
+    publisher = MagicMock()
+    publisher.publish.side_effect = Exception("Bad metrics")
+    metrics = kadabra.Metrics([], [], [], id="bad")
+    queue = MagicMock()
+    queue.get.return_value = metrics
+    backoff = kadabra.agent.RetryBackoff(0, 0, max_attempts=2)
+
+    nanny_thread = kadabra.agent.NannyThread(channel, publisher, queue,
+            MagicMock(), backoff=backoff)
+    nanny_thread._run_once()
+    assert not channel.dead_letter.called
+
+    nanny_thread._run_once()
+    channel.dead_letter.assert_called_with([metrics])
+
+def test_run_once_no_dead_letter_while_breaker_open():
+    channel = MagicMock()
+    publisher = MagicMock()
+    publisher.publish.side_effect = Exception("Backend is down")
+    queue = MagicMock()
+    queue.get.return_value = kadabra.Metrics([], [], [], id="one")
+    backoff = kadabra.agent.RetryBackoff(0, 0, max_attempts=1)
+    breaker = kadabra.agent.CircuitBreaker(MagicMock(), 1, 10, 60, 5)
+
+    nanny_thread = kadabra.agent.NannyThread(channel, publisher, queue,
+            MagicMock(), circuit_breaker=breaker, backoff=backoff)
+    nanny_thread._run_once()
+
+    assert not channel.dead_letter.called
+
+def test_run_once_rejected():
+    channel = MagicMock()
+    publisher = MagicMock()
+    metrics = kadabra.Metrics([], [], [], id="bad")
+    publisher.publish.return_value = [metrics]
+    queue = MagicMock()
+    queue.get.return_value = metrics
+    backoff = kadabra.agent.RetryBackoff(0, 0, max_attempts=1)
+
+    nanny_thread = kadabra.agent.NannyThread(channel, publisher, queue,
+            MagicMock(), backoff=backoff)
+    nanny_thread._run_once()
+
+    assert not channel.complete.called
+    channel.dead_letter.assert_called_with([metrics])
+
+def test_run_once_retry_queue():
+    channel = MagicMock()
+    publisher = MagicMock()
+    publisher.publish.side_effect = Exception("Backend is down")
+    metrics = kadabra.Metrics([], [], [], id="one")
+    queue = MagicMock()
+    queue.get.return_value = metrics
+    backoff = kadabra.agent.RetryBackoff(10, 10)
+
+    nanny_thread = kadabra.agent.NannyThread(channel, publisher, queue,
+            MagicMock(), backoff=backoff, retry_queue=True)
+    nanny_thread._run_once()
+
+    assert channel.retry.call_args[0][0] == [metrics]
@@ -0,0 +1,136 @@
+import kadabra
+import pytest
+
+from mock import MagicMock, mock
+
+logger = "testlogger"
+lanes = [{"name": "high", "weight": 3, "queue_key": "queue_high",
+            "inprogress_key": "inprogress_high"},
+         {"name": "default", "weight": 1, "queue_key": "queue",
+            "inprogress_key": "inprogress"}]
+
+def get_unit(lane_dimension=None):
+    channel = kadabra.channels.PriorityRedisChannel(lanes, logger,
+            lane_dimension=lane_dimension, receive_timeout=10)
+    channel.shards = [MagicMock(), MagicMock()]
+    return channel
+
+def get_metrics(**dimensions):
+    return kadabra.Metrics([kadabra.Dimension(k, v)
+        for k, v in dimensions.items()], [], [])
+
+def test_ctor():
+    channel = kadabra.channels.PriorityRedisChannel(lanes, logger)
+
+    assert channel.names == ["high", "default"]
+    assert channel.weights == [3, 1]
+    assert [s.queue_key for s in channel.shards] == ["queue_high", "queue"]
+    assert [s.inprogress_key for s in channel.shards] ==\
+            ["inprogress_high", "inprogress"]
+    assert lanes[0]["name"] == "high"
+
+def test_ctor_unrecognized_default_lane():
+    with pytest.raises(Exception):
+        kadabra.channels.PriorityRedisChannel(lanes, logger,
+                default_lane="low")
+
+def test_send_priority():
+    channel = get_unit()
+    metrics = get_metrics()
+
+    channel.send(metrics, priority="high")
+    channel.shards[0].send.assert_called_with(metrics)
+
+    channel.send(metrics)
+    channel.shards[1].send.assert_called_with(metrics)
+
+    with pytest.raises(Exception):
+        channel.send(metrics, priority="low")
+
+def test_has_lane():
+    channel = get_unit()
+
+    assert channel.has_lane("high")
+    assert not channel.has_lane("low")
+
+def test_send_lane_dimension():
+    channel = get_unit(lane_dimension="lane")
+
+    high = get_metrics(lane="high")
+    channel.send(high)
+    channel.shards[0].send.assert_called_with(high)
+
+    unknown = get_metrics(lane="low")
+    channel.send(unknown)
+    channel.shards[1].send.assert_called_with(unknown)
+
+    channel.send(high, priority="default")
+    channel.shards[1].send.assert_called_with(high)
+
+def test_receive_weighted():
+    channel = get_unit()
+    high = get_metrics()
+    low = get_metrics()
+    channel.shards[0].receive_batch.return_value = [high]
+    channel.shards[1].receive_batch.return_value = [low]
+
+    received = [channel.receive() for i in range(8)]
+
+    assert received.count(high) == 6
+    assert received.count(low) == 2
+    assert received[:4].count(low) == 1
+
+def test_receive_empty_lane():
+    channel = get_unit()
+    channel.shards[0].receive_batch.return_value = []
+    low = get_metrics()
+    channel.shards[1].receive_batch.return_value = [low]
+
+    assert [channel.receive() for i in range(3)] == [low] * 3
+
+def test_receive_blocks_on_heaviest_lane():
+    channel = get_unit()
+    for shard in channel.shards:
+        shard.receive_batch.return_value = []
+    channel.shards[0].receive.return_value = None
+
+    assert channel.receive() is None
+    channel.shards[0].receive.assert_called_with(timeout=5)
+    assert not channel.shards[1].receive.called
+
+def test_receive_batch():
+    channel = get_unit()
+    channel.shards[0].receive_batch.side_effect =\
+            lambda size: [get_metrics(lane="high") for i in range(size)]
+    channel.shards[1].receive_batch.side_effect =\
+            lambda size: [get_metrics(lane="low") for i in range(size)]
+
+    batch = channel.receive_batch(10)
+
+    lanes = [m.dimensions[0].value for m in batch]
+    assert lanes.count("high") == 8
+    assert lanes.count("low") == 2
+
+def test_receive_batch_redistributes():
+    channel = get_unit()
+    high = [get_metrics() for i in range(2)]
+    low = [get_metrics() for i in range(8)]
+    channel.shards[0].receive_batch.side_effect = [high, []]
+    channel.shards[1].receive_batch.side_effect = [low[:2], low[2:]]
+
+    batch = channel.receive_batch(10)
+
+    assert batch == high + low
+    channel.shards[1].receive_batch.assert_called_with(6)
+
+def test_complete():
+    channel = get_unit()
+    channel.shards[0].receive_batch.return_value = []
+    metrics = MagicMock()
+    channel.shards[1].receive_batch.return_value = [metrics]
+
+    channel.receive()
+    channel.complete([metrics])
+
+    channel.shards[0].complete.assert_called_with([])
+    channel.shards[1].complete.assert_called_with([metrics])
@@ -21,7 +21,9 @@ def test_ctor(mock_receiver_thread):
     assert receiver.num_threads == num_threads
 
     mock_receiver_thread.assert_has_calls(
-            [call(channel, publisher, logger) for x in receiver_threads])
+            [call(channel, publisher, logger, circuit_breaker=None,
+                backoff=None, retry_queue=False, max_age=None, recovery=None)
+                for x in receiver_threads])
     for i in range(len(receiver_threads)):
         expected_name = "KadabraReceiver-%s" % str(i)
         assert receiver.threads[i].name == expected_name
@@ -48,6 +48,78 @@ def test_run_once_metrics():
     publisher.publish.assert_called_with([metrics])
     channel.complete.assert_called_with([metrics])
 
+def test_run_once_rejected():
+    channel = MagicMock()
+    publisher = MagicMock()
+    logger = MagicMock()
+
+    metrics = channel.receive.return_value
+    publisher.publish.return_value = [metrics]
+
+    receiver_thread = kadabra.agent.ReceiverThread(channel, publisher, logger)
+    receiver_thread._run_once()
+
+    publisher.publish.assert_called_with([metrics])
+    assert not channel.complete.called
+    assert logger.warn.call_count == 1
+
+def test_run_once_retry_queue():
+    channel = MagicMock()
+    publisher = MagicMock()
+    publisher.publish.side_effect = Exception("Backend is down")
+    metrics = kadabra.Metrics([], [], [], id="one")
+    channel.receive.return_value = metrics
+    backoff = kadabra.agent.RetryBackoff(10, 10)
+
+    receiver_thread = kadabra.agent.ReceiverThread(channel, publisher,
+            MagicMock(), backoff=backoff, retry_queue=True)
+    receiver_thread._run_once()
+
+    assert not channel.complete.called
+    delay = channel.retry.call_args[0][1][0]
+    channel.retry.assert_called_with([metrics], [delay])
+    assert 5 <= delay <= 10
+
+    publisher.publish.side_effect = None
+    receiver_thread._run_once()
+
+    channel.complete.assert_called_with([metrics])
+    assert backoff.ready(metrics)
+
+def test_run_once_recovering():
+    channel = MagicMock()
+    publisher = MagicMock()
+    recovery = MagicMock()
+    recovery.active.return_value = True
+    metrics = MagicMock()
+    channel.receive_newest.return_value = [metrics]
+
+    receiver_thread = kadabra.agent.ReceiverThread(channel, publisher,
+            MagicMock(), recovery=recovery)
+    receiver_thread._run_once()
+
+    channel.receive_newest.assert_called_with(1)
+    assert not channel.receive.called
+    channel.complete.assert_called_with([metrics])
+
+    channel.receive_newest.return_value = []
+    receiver_thread._run_once()
+
+    channel.receive.assert_called_with()
+
+def test_run_once_max_age():
+    channel = MagicMock()
+    publisher = MagicMock()
+    max_age = MagicMock()
+    max_age.expire.return_value = []
+
+    receiver_thread = kadabra.agent.ReceiverThread(channel, publisher,
+            MagicMock(), max_age=max_age)
+    receiver_thread._run_once()
+
+    max_age.expire.assert_called_with(channel, [channel.receive.return_value])
+    assert not publisher.publish.called
+
 def test_run_once_exception():
     channel = MagicMock()
     publisher = MagicMock()
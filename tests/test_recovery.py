@@ -0,0 +1,114 @@
+import kadabra
+
+from mock import MagicMock, mock
+
+def get_backlog(oldest_age_seconds):
+    return {"length": 10, "oldest_age_seconds": oldest_age_seconds,
+            "newest_age_seconds": 1.0}
+
+@mock.patch('kadabra.agent.time.time')
+def test_active(mock_time):
+    mock_time.return_value = 100
+    channel = MagicMock()
+    channel.backlog_stats.return_value = get_backlog(3600.0)
+    recovery = kadabra.agent.Recovery(channel, MagicMock(), 600, 10)
+
+    assert recovery.active()
+    assert recovery.stats() == dict(get_backlog(3600.0), recovering=True)
+
+    channel.backlog_stats.return_value = get_backlog(5.0)
+    mock_time.return_value = 105
+    assert recovery.active()
+    assert channel.backlog_stats.call_count == 1
+
+    mock_time.return_value = 111
+    assert not recovery.active()
+    assert channel.backlog_stats.call_count == 2
+
+@mock.patch('kadabra.agent.time.time', return_value=100)
+def test_active_empty_queue(mock_time):
+    channel = MagicMock()
+    channel.backlog_stats.return_value = get_backlog(None)
+    recovery = kadabra.agent.Recovery(channel, MagicMock(), 600, 10)
+
+    assert not recovery.active()
+
+def test_active_exception():
+    channel = MagicMock()
+    channel.backlog_stats.side_effect = Exception("Redis is down")
+    logger = MagicMock()
+    recovery = kadabra.agent.Recovery(channel, logger, 600, 10)
+    recovery.recovering = True
+
+    assert recovery.active()
+    assert logger.warn.call_count == 1
+    assert recovery.stats() == {"recovering": True}
+
+def get_backfiller(recovering, **kwargs):
+    recovery = MagicMock()
+    recovery.active.return_value = recovering
+    return kadabra.agent.Backfiller(MagicMock(), MagicMock(), MagicMock(),
+            recovery, kadabra.utils.TokenBucket(10), 4, **kwargs)
+
+@mock.patch('kadabra.agent.time.sleep')
+def test_run_once_not_recovering(mock_sleep):
+    backfiller = get_backfiller(False)
+    backfiller._run_once()
+
+    assert not backfiller.channel.receive_batch.called
+    mock_sleep.assert_called_with(1)
+
+def test_run_once():
+    backfiller = get_backfiller(True)
+    metrics = [MagicMock(), MagicMock()]
+    backfiller.channel.receive_batch.return_value = metrics
+
+    backfiller._run_once()
+
+    backfiller.channel.receive_batch.assert_called_with(4)
+    backfiller.publisher.publish.assert_called_with(metrics)
+    backfiller.channel.complete.assert_called_with(metrics)
+
+def test_run_once_retries_failures():
+    backoff = MagicMock()
+    backoff.record_failure.return_value = [30]
+    backoff.exhausted.return_value = []
+    backfiller = get_backfiller(True, backoff=backoff, retry_queue=True)
+    good, bad = MagicMock(), MagicMock()
+    backfiller.channel.receive_batch.return_value = [good, bad]
+    backfiller.publisher.publish.return_value = [bad]
+
+    backfiller._run_once()
+
+    backfiller.channel.complete.assert_called_with([good])
+    backoff.record_success.assert_called_with([good])
+    backoff.record_failure.assert_called_with([bad])
+    backfiller.channel.retry.assert_called_with([bad], [30])
+
+@mock.patch('kadabra.agent.time.sleep')
+def test_run_once_rate_limited(mock_sleep):
+    backfiller = get_backfiller(True)
+    backfiller.rate_limiter.take(10)
+
+    backfiller._run_once()
+
+    assert not backfiller.channel.receive_batch.called
+    mock_sleep.assert_called_with(0.1)
+
+def test_run_once_max_age():
+    max_age = MagicMock()
+    max_age.expire.return_value = []
+    backfiller = get_backfiller(True, max_age=max_age)
+    metrics = [MagicMock()]
+    backfiller.channel.receive_batch.return_value = metrics
+
+    backfiller._run_once()
+
+    max_age.expire.assert_called_with(backfiller.channel, metrics)
+    assert not backfiller.publisher.publish.called
+
+def test_stop():
+    backfiller = get_backfiller(True)
+    backfiller.stop()
+
+    assert backfiller._check_stopped()
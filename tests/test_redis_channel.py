@@ -1,6 +1,6 @@
 import redis
 import kadabra
-import json
+import json, hashlib, datetime
 
 from mock import MagicMock, mock, call
 
@@ -15,13 +15,17 @@ def get_unit():
     return kadabra.channels.RedisChannel(host, port, db, logger, queue_key,
             inprogress_key)
 
+@mock.patch('kadabra.channels.get_connection_pool')
 @mock.patch('redis.StrictRedis')
-def test_ctor(mock_redis):
+def test_ctor(mock_redis, mock_get_connection_pool):
     mock_redis.return_value = "test"
+    mock_get_connection_pool.return_value = "pool"
 
     channel = get_unit()
 
-    mock_redis.assert_called_with(host=host, port=port, db=db)
+    mock_get_connection_pool.assert_called_with(host, port, db, None, None,
+            20, None, None, False, 0)
+    mock_redis.assert_called_with(connection_pool="pool")
 
     assert channel.client == "test"
     assert channel.logger.name == logger
@@ -44,7 +48,7 @@ def test_send():
 
 @mock.patch('kadabra.Metrics.deserialize')
 def test_receive_metrics(mock_deserialize):
-    deserialized = "test"
+    deserialized = MagicMock()
     mock_deserialize.return_value = deserialized
     raw_metrics = {"name": "value"}
     encoded = json.dumps(raw_metrics)
@@ -58,6 +62,7 @@ def test_receive_metrics(mock_deserialize):
             timeout=10)
     mock_deserialize.assert_called_with(raw_metrics)
     assert metrics == deserialized
+    assert metrics.payload == encoded
 
 def test_receive_nometrics():
     raw_metrics = None
@@ -139,7 +144,7 @@ def test_in_progress(mock_deserialize):
     raw = [json.dumps({"nameOne": "valueOne"}),
            json.dumps({"nameTwo": "valueTwo"}),
            json.dumps({"nameThree": "valueThree"})]
-    deserialized = ['one', 'two', 'three']
+    deserialized = [MagicMock(), MagicMock(), MagicMock()]
     mock_deserialize.side_effect = deserialized
 
     channel = get_unit()
@@ -153,3 +158,448 @@ def test_in_progress(mock_deserialize):
     for r in raw:
         mock_deserialize.assert_any_call(json.loads(r))
     assert in_progress == deserialized
+    assert [m.payload for m in in_progress] == raw
+
+def get_compressed_unit(compression_threshold, compression_dictionary=None):
+    return kadabra.channels.RedisChannel(host, port, db, logger, queue_key,
+            inprogress_key, compression_threshold=compression_threshold,
+            compression_dictionary=compression_dictionary)
+
+def test_send_compressed():
+    serialized = {"name": "value" * 100}
+
+    channel = get_compressed_unit(100)
+    metrics = kadabra.Metrics([], [], [])
+
+    metrics.serialize = MagicMock(return_value=serialized)
+    channel.client.lpush = MagicMock()
+
+    channel.send(metrics)
+
+    pushed = channel.client.lpush.call_args[0][1]
+    assert pushed[:1] == kadabra.channels.COMPRESSED_MARKER
+    assert len(pushed) < len(json.dumps(serialized))
+    assert channel._decode(pushed) == serialized
+
+def test_send_below_compression_threshold():
+    serialized = {"name": "value"}
+
+    channel = get_compressed_unit(100)
+    metrics = kadabra.Metrics([], [], [])
+
+    metrics.serialize = MagicMock(return_value=serialized)
+    channel.client.lpush = MagicMock()
+
+    channel.send(metrics)
+
+    channel.client.lpush.assert_called_with(queue_key, json.dumps(serialized))
+
+def test_compression_dictionary_roundtrip():
+    serialized = {"name": "value" * 100}
+
+    channel = get_compressed_unit(100,
+            kadabra.channels.DEFAULT_COMPRESSION_DICTIONARY)
+    encoded = channel._encode(serialized)
+
+    assert encoded[:1] == kadabra.channels.COMPRESSED_MARKER
+    assert channel._decode(encoded) == serialized
+
+@mock.patch('kadabra.Metrics.deserialize')
+def test_receive_mixed_compression(mock_deserialize):
+    raw_metrics = {"name": "value" * 100}
+    compressed = get_compressed_unit(1)._encode(raw_metrics)
+
+    channel = get_unit()
+    channel.client.brpoplpush = MagicMock(return_value=compressed)
+
+    channel.receive()
+
+    mock_deserialize.assert_called_with(raw_metrics)
+
+def test_complete_compressed():
+    serialized = {"name": "value" * 100}
+
+    channel = get_compressed_unit(100)
+    metrics = kadabra.Metrics([], [], [])
+
+    metrics.serialize = MagicMock(return_value=serialized)
+
+    pipeline = MagicMock()
+    channel.client.pipeline = MagicMock(return_value=pipeline)
+
+    channel.complete([metrics])
+
+    pipeline.lrem.assert_has_calls([
+        call(inprogress_key, 1, channel._encode(serialized)),
+        call(inprogress_key, 1, json.dumps(serialized))])
+
+def test_complete_received_payload():
+    sent = kadabra.Metrics([kadabra.Dimension("name", "value" * 100)], [], [],
+            serialized_at="now")
+    compressed = get_compressed_unit(1)._encode(sent.serialize())
+
+    channel = get_unit()
+    channel.client.brpoplpush = MagicMock(return_value=compressed)
+    pipeline = MagicMock()
+    channel.client.pipeline = MagicMock(return_value=pipeline)
+
+    channel.complete([channel.receive()])
+
+    pipeline.lrem.assert_called_once_with(inprogress_key, 1, compressed)
+
+def test_send_dictionary_encoded():
+    serialized = {"dimensions": [{"name": "service", "value": "api"}],
+            "counters": [], "timers": []}
+
+    channel = kadabra.channels.RedisChannel(host, port, db, logger, queue_key,
+            inprogress_key, dictionary_encoding=True)
+    channel.dictionary.ids = {"service": 0, "api": 1}
+    channel.dictionary.strings = {0: "service", 1: "api"}
+    metrics = kadabra.Metrics([], [], [])
+
+    metrics.serialize = MagicMock(return_value=serialized)
+    channel.client.lpush = MagicMock()
+
+    channel.send(metrics)
+
+    pushed = channel.client.lpush.call_args[0][1]
+    assert pushed == kadabra.channels.DICTIONARY_MARKER + json.dumps(
+            {"dimensions": [{"name": 0, "value": 1}], "counters": [],
+                "timers": []})
+    assert channel._decode(pushed.encode("utf-8")) == serialized
+
+def test_complete_dictionary_encoded_payload():
+    encoded = kadabra.channels.DICTIONARY_MARKER + json.dumps(
+            {"dimensions": [{"name": 0, "value": 1}], "counters": [],
+                "timers": [], "timestamp_format": "%Y-%m-%dT%H:%M:%S.%fZ",
+                "serialized_at": "now"})
+
+    channel = get_unit()
+    channel.dictionary.strings = {0: "service", 1: "api"}
+    channel.client.brpoplpush = MagicMock(return_value=encoded)
+    pipeline = MagicMock()
+    channel.client.pipeline = MagicMock(return_value=pipeline)
+
+    metrics = channel.receive()
+    channel.complete([metrics])
+
+    assert metrics.dimensions[0].value == "api"
+    pipeline.lrem.assert_called_once_with(inprogress_key, 1, encoded)
+
+def test_connection_pool_shared():
+    pool = kadabra.channels.get_connection_pool(host, port, db)
+
+    assert isinstance(pool, redis.ConnectionPool)
+    assert kadabra.channels.get_connection_pool(host, port, db) is pool
+    assert kadabra.channels.get_connection_pool(host, port, db + 1) is\
+            not pool
+
+def test_connection_pool_bounded():
+    pool = kadabra.channels.get_connection_pool(host, port, db,
+            max_connections=5, pool_timeout=3, socket_timeout=15,
+            socket_keepalive=True)
+
+    assert isinstance(pool, redis.BlockingConnectionPool)
+    assert pool.max_connections == 5
+    assert pool.timeout == 3
+    assert pool.connection_kwargs["socket_timeout"] == 15
+    assert pool.connection_kwargs["socket_keepalive"] == True
+
+def test_connection_pool_unix_socket():
+    path = "/tmp/redis.sock"
+
+    pool = kadabra.channels.get_connection_pool(host, port, db,
+            unix_socket_path=path)
+
+    assert pool.connection_class == redis.UnixDomainSocketConnection
+    assert pool.connection_kwargs["path"] == path
+    assert "host" not in pool.connection_kwargs
+
+def test_reset_in_same_process():
+    channel = get_unit()
+    channel.client.connection_pool.reset = MagicMock()
+
+    channel.reset()
+
+    assert channel.client.connection_pool.reset.call_count == 0
+
+def test_reset_after_fork():
+    channel = get_unit()
+    channel.client = MagicMock()
+    channel.client.connection_pool.pid = -1
+
+    channel.reset()
+
+    channel.client.connection_pool.reset.assert_called_with()
+
+def test_prewarm():
+    channel = get_unit()
+    channel.client.ping = MagicMock()
+
+    channel.prewarm()
+
+    channel.client.ping.assert_called_with()
+
+def test_prewarm_failure():
+    channel = get_unit()
+    channel.client.ping = MagicMock(side_effect=redis.ConnectionError())
+
+    channel.prewarm()
+
+def get_agent_unit():
+    channel = kadabra.channels.RedisChannel(host, port, db, logger, queue_key,
+            inprogress_key, client=MagicMock(), agent_inprogress_keys=True)
+    scripts = {}
+    def register_script(script):
+        scripts[script] = MagicMock(return_value=0)
+        return scripts[script]
+    channel.client.register_script.side_effect = register_script
+    return channel, scripts
+
+def test_register_shared_inprogress_key():
+    channel = get_unit()
+    channel.client = MagicMock()
+
+    channel.register("agent")
+
+    assert channel.inprogress_key == inprogress_key
+    assert channel.agent_id is None
+    assert not channel.client.register_script.called
+    assert channel.lease("agent", 30).key == inprogress_key + ":lease"
+
+def test_register():
+    channel, scripts = get_agent_unit()
+
+    channel.register("agent")
+
+    assert channel.agent_id == "agent"
+    assert channel.inprogress_key == inprogress_key + ":agent"
+    assert channel.lease("agent", 30) is None
+    scripts[channel.HEARTBEAT_SCRIPT].assert_called_with(
+            keys=[queue_key + ":agents"], args=["agent"])
+
+def test_register_receive_and_complete():
+    channel, scripts = get_agent_unit()
+    channel.register("agent")
+    metrics = kadabra.Metrics([], [], [], serialized_at="now", id="one")
+    raw = json.dumps(metrics.serialize())
+    channel.client.brpoplpush.return_value = raw
+
+    channel.receive()
+    channel.complete([metrics])
+
+    channel.client.brpoplpush.assert_called_with(queue_key,
+            inprogress_key + ":agent", timeout=10)
+    channel.client.pipeline.return_value.lrem.assert_called_with(
+            inprogress_key + ":agent", 1, raw)
+
+def test_register_in_progress_reclaims():
+    channel, scripts = get_agent_unit()
+    channel.register("agent")
+    channel.client.lrange.return_value = []
+    channel.client.time.return_value = (1000, 500)
+    channel.client.zrangebyscore.return_value = [b"dead", "gone"]
+    channel.in_progress(10)
+
+    channel.client.zrangebyscore.assert_called_with(queue_key + ":agents",
+            "-inf", 940)
+    scripts[channel.RECLAIM_SCRIPT].assert_called_with(
+            keys=[queue_key + ":agents", queue_key, inprogress_key + ":dead",
+                inprogress_key + ":gone"],
+            args=[940, 10, "dead", "gone"])
+    channel.client.lrange.assert_called_with(inprogress_key + ":agent", 0,
+            9)
+
+def test_register_in_progress_no_dead_agents():
+    channel, scripts = get_agent_unit()
+    channel.register("agent")
+    channel.client.lrange.return_value = []
+    channel.client.time.return_value = (1000, 500)
+    channel.client.zrangebyscore.return_value = []
+    channel.in_progress(10)
+
+    assert channel.RECLAIM_SCRIPT not in scripts
+
+def test_heartbeat_unregistered():
+    channel, scripts = get_agent_unit()
+
+    channel.heartbeat()
+
+    assert not channel.client.register_script.called
+
+def get_stamped_unit():
+    channel = kadabra.channels.RedisChannel(host, port, db, logger, queue_key,
+            inprogress_key, client=MagicMock(), server_timestamps=True)
+    scripts = {}
+    def register_script(script):
+        scripts[script] = MagicMock()
+        return scripts[script]
+    channel.client.register_script.side_effect = register_script
+    return channel, scripts
+
+def test_receive_server_timestamps():
+    channel, scripts = get_stamped_unit()
+    metrics = kadabra.Metrics([], [], [], serialized_at="now", id="one")
+    raw = json.dumps(metrics.serialize()).encode("utf-8")
+    channel.client.brpoplpush.return_value = raw
+    channel._timestamp_scripts()
+    scripts[channel.RECEIVE_SCRIPT].return_value = [raw]
+
+    assert channel.receive().id == "one"
+    scripts[channel.RECEIVE_SCRIPT].assert_called_with(
+            keys=[queue_key, inprogress_key, inprogress_key + ":received"],
+            args=[1])
+    assert not channel.client.brpoplpush.called
+
+    scripts[channel.RECEIVE_SCRIPT].return_value = []
+    assert channel.receive().id == "one"
+    channel.client.brpoplpush.assert_called_with(queue_key, inprogress_key,
+            timeout=10)
+    scripts[channel.STAMP_SCRIPT].assert_called_with(
+            keys=[inprogress_key + ":received"],
+            args=[hashlib.sha1(raw).hexdigest()])
+
+def test_receive_batch_server_timestamps():
+    channel, scripts = get_stamped_unit()
+    raws = [json.dumps(kadabra.Metrics([], [], [], serialized_at="now",
+        id=str(i)).serialize()) for i in range(2)]
+    channel._timestamp_scripts()
+    scripts[channel.RECEIVE_SCRIPT].return_value = raws
+
+    batch = channel.receive_batch(5)
+
+    assert [m.id for m in batch] == ["0", "1"]
+    scripts[channel.RECEIVE_SCRIPT].assert_called_with(
+            keys=[queue_key, inprogress_key, inprogress_key + ":received"],
+            args=[5])
+
+def test_complete_server_timestamps():
+    channel, scripts = get_stamped_unit()
+    metrics = kadabra.Metrics([], [], [], serialized_at="now", id="one")
+    raw = json.dumps(metrics.serialize())
+
+    channel.complete([metrics])
+
+    pipeline = channel.client.pipeline.return_value
+    pipeline.lrem.assert_called_with(inprogress_key, 1, raw)
+    pipeline.hdel.assert_called_with(inprogress_key + ":received",
+            hashlib.sha1(raw.encode("utf-8")).hexdigest())
+
+def test_in_progress_server_timestamps():
+    channel, scripts = get_stamped_unit()
+    raws = [json.dumps(kadabra.Metrics([], [], [], serialized_at="now",
+        id=str(i)).serialize()) for i in range(2)]
+    channel._timestamp_scripts()
+    scripts[channel.IN_PROGRESS_SCRIPT].return_value = [100000, raws,
+            [70000, -1]]
+
+    in_progress = channel.in_progress(10)
+
+    scripts[channel.IN_PROGRESS_SCRIPT].assert_called_with(
+            keys=[inprogress_key, inprogress_key + ":received"], args=[10])
+    assert in_progress[0].in_progress_seconds == 30
+    assert in_progress[1].in_progress_seconds is None
+
+def test_dead_letter():
+    channel, scripts = get_stamped_unit()
+    metrics = kadabra.Metrics([], [], [], serialized_at="now", id="one")
+
+    assert channel.dead_letter([]) == 0
+    assert not channel.client.register_script.called
+    channel.dead_letter([metrics])
+
+    scripts[channel.DEAD_LETTER_SCRIPT].assert_called_with(
+            keys=[inprogress_key, queue_key + ":dead",
+                inprogress_key + ":received"],
+            args=[json.dumps(metrics.serialize())])
+
+def test_receive_newest():
+    channel, scripts = get_stamped_unit()
+    metrics = kadabra.Metrics([], [], [], serialized_at="now", id="one")
+    channel.client.register_script.side_effect = None
+    script = channel.client.register_script.return_value
+    script.return_value = [json.dumps(metrics.serialize())]
+
+    received = channel.receive_newest(5)
+
+    script.assert_called_with(keys=[queue_key, inprogress_key,
+        inprogress_key + ":received"], args=[5, 1])
+    assert [m.id for m in received] == ["one"]
+
+def test_backlog_stats():
+    channel = get_unit()
+    channel.client = MagicMock()
+    old = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+    oldest = kadabra.Metrics([], [], [],
+            serialized_at=old.strftime("%Y-%m-%dT%H:%M:%S.%fZ"))
+    newest = kadabra.Metrics([], [], [],
+            serialized_at=datetime.datetime.utcnow().strftime(
+                "%Y-%m-%dT%H:%M:%S.%fZ"))
+    pipeline = channel.client.pipeline.return_value
+    pipeline.execute.return_value = [2, json.dumps(oldest.serialize()),
+            json.dumps(newest.serialize())]
+
+    stats = channel.backlog_stats()
+
+    pipeline.lindex.assert_has_calls([call(queue_key, -1),
+        call(queue_key, 0)])
+    assert stats["length"] == 2
+    assert 3599 < stats["oldest_age_seconds"] < 3601
+    assert stats["newest_age_seconds"] < 1
+
+    pipeline.execute.return_value = [0, None, None]
+    assert channel.backlog_stats() == {"length": 0,
+            "oldest_age_seconds": None, "newest_age_seconds": None}
+
+@mock.patch('kadabra.channels.time.time')
+def test_retry(mock_time):
+    mock_time.return_value = 1000.25
+    channel, scripts = get_stamped_unit()
+    one = kadabra.Metrics([], [], [], serialized_at="now", id="one")
+    two = kadabra.Metrics([], [], [], serialized_at="now", id="two")
+
+    assert channel.retry([], []) == 0
+    assert not channel.client.register_script.called
+    channel.retry([one, two], [1.5, 30])
+
+    scripts[channel.RETRY_SCRIPT].assert_called_with(
+            keys=[inprogress_key, queue_key + ":retry",
+                inprogress_key + ":received"],
+            args=[1000250, 1500, json.dumps(one.serialize()),
+                30000, json.dumps(two.serialize())])
+
+@mock.patch('kadabra.channels.time.time')
+def test_requeue_due(mock_time):
+    mock_time.return_value = 1000.25
+    channel, scripts = get_stamped_unit()
+    channel._retry_scripts()
+    scripts[channel.REQUEUE_DUE_SCRIPT].return_value = 3
+
+    assert channel.requeue_due(100) == 3
+    scripts[channel.REQUEUE_DUE_SCRIPT].assert_called_with(
+            keys=[queue_key + ":retry", queue_key], args=[1000250, 100])
+
+def test_dead_letters():
+    channel = get_unit()
+    channel.client = MagicMock()
+    raw = json.dumps(kadabra.Metrics([], [], [], serialized_at="now",
+        id="one").serialize())
+    channel.client.lrange.return_value = [raw]
+
+    dead = channel.dead_letters(10)
+
+    channel.client.lrange.assert_called_with(queue_key + ":dead", 0, 9)
+    assert [m.id for m in dead] == ["one"]
+
+def test_requeue_dead_letters():
+    channel = get_unit()
+    channel.client = MagicMock()
+    pipeline = channel.client.pipeline.return_value
+    pipeline.execute.side_effect = [["raw"] * 1000, ["raw"] * 3 + [None] * 997]
+
+    assert channel.requeue_dead_letters() == 1003
+    pipeline.rpoplpush.assert_called_with(queue_key + ":dead", queue_key)
+
+    pipeline.execute.side_effect = [["raw"] * 5]
+    assert channel.requeue_dead_letters(5) == 5
+    assert pipeline.execute.call_count == 3
@@ -0,0 +1,52 @@
+import kadabra
+
+from mock import MagicMock, mock
+from redis.crc import key_slot
+
+logger = "testlogger"
+startup_nodes = [{"host": "one", "port": 7000}]
+
+@mock.patch('kadabra.channels._create_cluster_client')
+def get_unit(mock_create_cluster_client, channel_args=None):
+    mock_create_cluster_client.return_value = MagicMock()
+    return kadabra.channels.RedisClusterChannel(startup_nodes, logger,
+            key_pairs=4, channel_args=channel_args)
+
+@mock.patch('kadabra.channels._create_cluster_client')
+def test_ctor(mock_create_cluster_client):
+    cluster = MagicMock()
+    mock_create_cluster_client.return_value = cluster
+
+    channel = kadabra.channels.RedisClusterChannel(startup_nodes, logger,
+            key_pairs=4)
+
+    mock_create_cluster_client.assert_called_with(startup_nodes)
+    assert channel.cluster == cluster
+    assert len(channel.shards) == 4
+    for i, shard in enumerate(channel.shards):
+        assert shard.client == cluster
+        assert shard.dictionary.client == cluster
+        assert shard.queue_key == "{kadabra:%d}kadabra_queue" % i
+        assert shard.inprogress_key == "{kadabra:%d}kadabra_inprogress" % i
+
+def test_key_pairs_share_slot():
+    channel = get_unit()
+
+    for shard in channel.shards:
+        assert key_slot(shard.queue_key.encode("utf-8")) ==\
+                key_slot(shard.inprogress_key.encode("utf-8"))
+        assert key_slot(shard.dictionary.key.encode("utf-8")) ==\
+                key_slot(shard.dictionary.ids_key.encode("utf-8"))
+
+def test_key_pairs_spread_across_slots():
+    channel = get_unit()
+
+    slots = set(key_slot(shard.queue_key.encode("utf-8"))
+            for shard in channel.shards)
+    assert len(slots) == len(channel.shards)
+
+def test_channel_args():
+    channel = get_unit(channel_args={"compression_threshold": 100})
+
+    for shard in channel.shards:
+        assert shard.compression_threshold == 100
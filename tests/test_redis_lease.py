@@ -0,0 +1,106 @@
+import kadabra
+
+from mock import MagicMock, mock
+
+key = "kadabra_inprogress:lease"
+owner = "host:1:abc"
+
+def get_unit(acquire=1, renew=1):
+    client = MagicMock()
+    scripts = [MagicMock(return_value=acquire), MagicMock(return_value=renew),
+            MagicMock(return_value=1)]
+    client.register_script.side_effect = scripts
+    return kadabra.channels.RedisLease(client, key, owner, 10), scripts
+
+def test_ctor():
+    client = MagicMock()
+
+    lease = kadabra.channels.RedisLease(client, key, owner, 10)
+
+    assert lease.client == client
+    assert lease.key == key
+    assert lease.token_key == key + ":token"
+    assert lease.owner == owner
+    assert lease.ttl_seconds == 10
+    assert not lease.held()
+
+@mock.patch('kadabra.channels.time.time', return_value=100)
+def test_acquire(mock_time):
+    lease, scripts = get_unit(acquire=7)
+
+    assert lease.acquire()
+
+    scripts[0].assert_called_with(keys=[key, key + ":token"],
+            args=[owner, 10000])
+    assert lease.token == 7
+    assert lease.expires_at == 109
+    assert lease.held()
+
+    mock_time.return_value = 109
+    assert not lease.held()
+
+def test_acquire_taken():
+    lease, scripts = get_unit(acquire=0)
+
+    assert not lease.acquire()
+    assert lease.token is None
+    assert not lease.held()
+
+@mock.patch('kadabra.channels.time.time', return_value=100)
+def test_renew(mock_time):
+    lease, scripts = get_unit(acquire=7)
+    lease.acquire()
+
+    mock_time.return_value = 105
+    assert lease.acquire()
+
+    scripts[1].assert_called_with(keys=[key], args=[owner + ":7", 10000])
+    assert scripts[0].call_count == 1
+    assert lease.expires_at == 114
+
+def test_renew_lost():
+    lease, scripts = get_unit(acquire=7, renew=0)
+    lease.acquire()
+    scripts[0].return_value = 0
+
+    assert not lease.acquire()
+    assert lease.token is None
+    assert scripts[0].call_count == 2
+
+@mock.patch('kadabra.channels.time.time', return_value=100)
+def test_check(mock_time):
+    lease, scripts = get_unit(acquire=7)
+    assert not lease.check()
+    assert not lease.client.get.called
+
+    lease.acquire()
+    lease.client.get.return_value = (owner + ":7").encode("utf-8")
+    assert lease.check()
+    lease.client.get.assert_called_with(key)
+
+    lease.client.get.return_value = "other:8"
+    assert not lease.check()
+    assert lease.token is None
+    assert not lease.held()
+
+def test_release():
+    lease, scripts = get_unit(acquire=7)
+    lease.release()
+    assert not scripts[2].called
+
+    lease.acquire()
+    lease.release()
+
+    scripts[2].assert_called_with(keys=[key], args=[owner + ":7"])
+    assert not lease.held()
+
+def test_redis_channel_lease():
+    channel = kadabra.channels.RedisChannel("localhost", 6379, 0,
+            "kadabra.channel", "kadabra_queue", "kadabra_inprogress",
+            client=MagicMock())
+
+    lease = channel.lease(owner, 30)
+
+    assert lease.client == channel.client
+    assert lease.key == "kadabra_inprogress:lease"
+    assert lease.ttl_seconds == 30
@@ -0,0 +1,57 @@
+import kadabra
+
+from mock import MagicMock, mock
+
+def test_ctor():
+    channel = MagicMock()
+    logger = MagicMock()
+
+    requeuer = kadabra.agent.RetryRequeuer(channel, logger, 1.0, 100)
+
+    assert requeuer.channel == channel
+    assert requeuer.logger == logger
+    assert requeuer.frequency_seconds == 1.0
+    assert requeuer.max_batch_size == 100
+    assert requeuer.timer is None
+
+@mock.patch('kadabra.agent.Timer')
+def test_start(mock_timer):
+    requeuer = kadabra.agent.RetryRequeuer(MagicMock(), MagicMock(), 1.0, 100)
+    requeuer.start()
+
+    mock_timer.assert_called_with(1.0, requeuer._run_requeuer)
+    assert requeuer.timer == mock_timer.return_value
+    assert requeuer.timer.name == "KadabraRetryRequeuer"
+    requeuer.timer.start.assert_called_with()
+
+@mock.patch('kadabra.agent.Timer')
+def test_stop(mock_timer):
+    requeuer = kadabra.agent.RetryRequeuer(MagicMock(), MagicMock(), 1.0, 100)
+    requeuer.start()
+    requeuer.stop()
+
+    requeuer.timer.cancel.assert_called_with()
+
+@mock.patch('kadabra.agent.Timer')
+def test_run_moves_until_none_due(mock_timer):
+    channel = MagicMock()
+    channel.requeue_due.side_effect = [100, 100, 7]
+
+    requeuer = kadabra.agent.RetryRequeuer(channel, MagicMock(), 1.0, 100)
+    requeuer._run_requeuer()
+
+    assert channel.requeue_due.call_count == 3
+    channel.requeue_due.assert_called_with(100)
+    mock_timer.return_value.start.assert_called_with()
+
+@mock.patch('kadabra.agent.Timer')
+def test_run_exception(mock_timer):
+    channel = MagicMock()
+    channel.requeue_due.side_effect = Exception("Redis is down")
+    logger = MagicMock()
+
+    requeuer = kadabra.agent.RetryRequeuer(channel, logger, 1.0, 100)
+    requeuer._run_requeuer()
+
+    assert logger.warn.call_count == 1
+    mock_timer.return_value.start.assert_called_with()
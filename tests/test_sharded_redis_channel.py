@@ -0,0 +1,198 @@
+import kadabra
+import pytest
+
+from mock import MagicMock, mock, call
+
+logger = "testlogger"
+shards = [{"host": "one", "port": 1234}, {"host": "two", "port": 5678}]
+
+def get_unit(sharding="round_robin"):
+    channel = kadabra.channels.ShardedRedisChannel(shards, logger, sharding,
+            receive_timeout=10)
+    channel.shards = [MagicMock(), MagicMock()]
+    return channel
+
+@mock.patch('kadabra.channels.RedisChannel')
+def test_ctor(mock_redis_channel):
+    mock_redis_channel.DEFAULT_ARGS =\
+            kadabra.channels.RedisChannel.DEFAULT_ARGS
+    mock_redis_channel.side_effect = ["one", "two"]
+
+    channel = kadabra.channels.ShardedRedisChannel(shards, logger)
+
+    for shard in shards:
+        expected_args = kadabra.channels.RedisChannel.DEFAULT_ARGS.copy()
+        expected_args["logger"] = logger
+        expected_args.update(shard)
+        mock_redis_channel.assert_any_call(**expected_args)
+    assert channel.shards == ["one", "two"]
+    assert channel.logger.name == logger
+    assert channel.sharding == "round_robin"
+
+def test_ctor_unrecognized_sharding():
+    with pytest.raises(Exception):
+        kadabra.channels.ShardedRedisChannel(shards, logger, "ehjgrhjehe")
+
+def test_send_round_robin():
+    channel = get_unit()
+    metrics = [MagicMock() for i in range(4)]
+
+    for m in metrics:
+        channel.send(m)
+
+    channel.shards[0].send.assert_has_calls([call(metrics[0]),
+        call(metrics[2])])
+    channel.shards[1].send.assert_has_calls([call(metrics[1]),
+        call(metrics[3])])
+
+def test_send_dimensions():
+    channel = get_unit("dimensions")
+    dimensions = [kadabra.Dimension("name", "value")]
+    metrics = [kadabra.Metrics(dimensions, [], []) for i in range(4)]
+
+    for m in metrics:
+        channel.send(m)
+
+    sends = [len(shard.send.call_args_list) for shard in channel.shards]
+    assert sorted(sends) == [0, 4]
+
+def test_receive_nonblocking():
+    channel = get_unit()
+    metrics = kadabra.Metrics([], [], [])
+    channel.shards[0].receive_batch = MagicMock(return_value=[])
+    channel.shards[1].receive_batch = MagicMock(return_value=[metrics])
+
+    assert channel.receive() == metrics
+    channel.shards[0].receive_batch.assert_called_with(1)
+    assert channel.shards[0].receive.call_count == 0
+    assert channel.shards[1].receive.call_count == 0
+    assert channel.origins[metrics] == 1
+
+def test_receive_blocking():
+    channel = get_unit()
+    metrics = kadabra.Metrics([], [], [])
+    for shard in channel.shards:
+        shard.receive_batch = MagicMock(return_value=[])
+    channel.shards[0].receive = MagicMock(return_value=metrics)
+
+    assert channel.receive() == metrics
+    channel.shards[0].receive.assert_called_with(timeout=5)
+    assert channel.origins[metrics] == 0
+
+def test_receive_batch():
+    channel = get_unit()
+    batch_one = [kadabra.Metrics([], [], [])]
+    batch_two = [kadabra.Metrics([], [], []), kadabra.Metrics([], [], [])]
+    channel.shards[0].receive_batch = MagicMock(return_value=batch_one)
+    channel.shards[1].receive_batch = MagicMock(return_value=batch_two)
+
+    batch = channel.receive_batch(5)
+
+    channel.shards[0].receive_batch.assert_called_with(3)
+    channel.shards[1].receive_batch.assert_called_with(2)
+    assert batch == batch_one + batch_two
+
+def test_complete():
+    channel = get_unit()
+    known = kadabra.Metrics([], [], [])
+    unknown = kadabra.Metrics([], [], [])
+    channel.origins[known] = 1
+
+    channel.complete([known, unknown])
+
+    channel.shards[0].complete.assert_called_with([unknown])
+    channel.shards[1].complete.assert_called_with([known, unknown])
+
+def test_in_progress():
+    channel = get_unit()
+    in_progress_one = [kadabra.Metrics([], [], [])]
+    in_progress_two = [kadabra.Metrics([], [], [])]
+    channel.shards[0].in_progress = MagicMock(return_value=in_progress_one)
+    channel.shards[1].in_progress = MagicMock(return_value=in_progress_two)
+
+    in_progress = channel.in_progress(10)
+
+    channel.shards[0].in_progress.assert_called_with(5)
+    channel.shards[1].in_progress.assert_called_with(5)
+    assert in_progress == in_progress_one + in_progress_two
+    assert channel.origins[in_progress_one[0]] == 0
+    assert channel.origins[in_progress_two[0]] == 1
+
+def test_register_and_heartbeat():
+    channel = get_unit()
+
+    channel.register("agent")
+    channel.heartbeat()
+
+    for shard in channel.shards:
+        shard.register.assert_called_with("agent")
+        shard.heartbeat.assert_called_with()
+    assert channel.lease("agent", 30) ==\
+            channel.shards[0].lease.return_value
+
+def test_dead_letter():
+    channel = get_unit()
+    channel.shards[0].receive_batch.return_value = [MagicMock()]
+    channel.shards[1].receive_batch.return_value = []
+    received = channel.receive_batch(2)
+    unknown = MagicMock()
+    for shard in channel.shards:
+        shard.dead_letter.return_value = 1
+
+    assert channel.dead_letter(received + [unknown]) == 2
+
+    channel.shards[0].dead_letter.assert_called_with(received + [unknown])
+    channel.shards[1].dead_letter.assert_called_with([unknown])
+
+def test_receive_newest():
+    channel = get_unit()
+    one = MagicMock()
+    channel.shards[0].receive_newest.return_value = [one]
+    channel.shards[1].receive_newest.return_value = []
+
+    assert channel.receive_newest(4) == [one]
+    channel.shards[0].receive_newest.assert_called_with(2)
+    channel.shards[1].receive_newest.assert_called_with(2)
+    assert channel.origins[one] == 0
+
+def test_backlog_stats():
+    channel = get_unit()
+    channel.shards[0].backlog_stats.return_value = {"length": 3,
+            "oldest_age_seconds": 100.0, "newest_age_seconds": 5.0}
+    channel.shards[1].backlog_stats.return_value = {"length": 0,
+            "oldest_age_seconds": None, "newest_age_seconds": None}
+
+    assert channel.backlog_stats() == {"length": 3,
+            "oldest_age_seconds": 100.0, "newest_age_seconds": 5.0}
+
+def test_retry():
+    channel = get_unit()
+    channel.shards[0].receive_batch.return_value = [MagicMock()]
+    channel.shards[1].receive_batch.return_value = []
+    received = channel.receive_batch(2)
+    unknown = MagicMock()
+    for shard in channel.shards:
+        shard.retry.return_value = 1
+
+    assert channel.retry(received + [unknown], [10, 20]) == 2
+
+    channel.shards[0].retry.assert_called_with(received + [unknown], [10, 20])
+    channel.shards[1].retry.assert_called_with([unknown], [20])
+
+def test_requeue_due():
+    channel = get_unit()
+    channel.shards[0].requeue_due.return_value = 3
+    channel.shards[1].requeue_due.return_value = 2
+
+    assert channel.requeue_due(10) == 5
+    channel.shards[0].requeue_due.assert_called_with(5)
+    channel.shards[1].requeue_due.assert_called_with(5)
+
+def test_requeue_dead_letters():
+    channel = get_unit()
+    channel.shards[0].requeue_dead_letters.return_value = 3
+    channel.shards[1].requeue_dead_letters.return_value = 2
+
+    assert channel.requeue_dead_letters(4) == 5
+    channel.shards[0].requeue_dead_letters.assert_called_with(4)
+    channel.shards[1].requeue_dead_letters.assert_called_with(1)
@@ -0,0 +1,107 @@
+import kadabra
+import os
+import uuid
+import pytest
+
+logger = "testlogger"
+
+@pytest.fixture
+def name(tmpdir):
+    name = "kadabra_test_%s" % uuid.uuid4().hex[:8]
+    yield name
+    from multiprocessing import shared_memory
+    try:
+        memory = shared_memory.SharedMemory(name=name)
+        memory.close()
+        memory.unlink()
+    except FileNotFoundError:
+        pass
+
+def get_unit(name, tmpdir, **kwargs):
+    args = {"receive_timeout": 0.01, "poll_interval": 0.01,
+            "lock_path": str(tmpdir.join("lock")), "capacity": 1024}
+    args.update(kwargs)
+    return kadabra.channels.SharedMemoryChannel(name, logger, **args)
+
+def get_metrics(name="value"):
+    return kadabra.Metrics([kadabra.Dimension("name", name)], [], [])
+
+def test_ctor(name, tmpdir):
+    channel = get_unit(name, tmpdir)
+
+    assert channel.name == name
+    assert channel.logger.name == logger
+    assert channel.capacity >= 1024
+    assert channel.stats() == {"capacity": channel.capacity, "used": 0,
+            "written": 0, "dropped": 0}
+
+def test_send_receive(name, tmpdir):
+    client_channel = get_unit(name, tmpdir)
+    agent_channel = get_unit(name, tmpdir)
+
+    client_channel.send(get_metrics("one"))
+    client_channel.send(get_metrics("two"))
+
+    first = agent_channel.receive()
+    second = agent_channel.receive()
+
+    assert first.dimensions[0].value == "one"
+    assert second.dimensions[0].value == "two"
+    assert agent_channel.receive() is None
+    assert agent_channel.in_progress(10) == [first, second]
+
+    agent_channel.complete([first, second])
+    assert agent_channel.in_progress(10) == []
+    assert agent_channel.stats()["written"] == 2
+    assert agent_channel.stats()["used"] == 0
+
+def test_receive_batch(name, tmpdir):
+    channel = get_unit(name, tmpdir)
+    for i in range(3):
+        channel.send(get_metrics(str(i)))
+
+    assert [m.dimensions[0].value for m in channel.receive_batch(2)] ==\
+            ["0", "1"]
+    assert [m.dimensions[0].value for m in channel.receive_batch(2)] == ["2"]
+    assert channel.receive_batch(2) == []
+
+def test_overflow_drops(name, tmpdir):
+    channel = get_unit(name, tmpdir, capacity=256)
+    for i in range(10):
+        channel.send(get_metrics(str(i)))
+
+    stats = channel.stats()
+    received = channel.receive_batch(10)
+    assert stats["dropped"] > 0
+    assert stats["written"] + stats["dropped"] == 10
+    assert len(received) == stats["written"]
+
+def test_wrap_around(name, tmpdir):
+    channel = get_unit(name, tmpdir, capacity=256)
+    for i in range(20):
+        channel.send(get_metrics("metrics %d" % i))
+        received = channel.receive_batch(1)
+        assert received[0].dimensions[0].value == "metrics %d" % i
+    assert channel.stats()["dropped"] == 0
+
+def test_send_from_child_processes(name, tmpdir):
+    agent_channel = get_unit(name, tmpdir, capacity=64 * 1024)
+    client_channel = get_unit(name, tmpdir, capacity=64 * 1024)
+
+    children = []
+    for child in range(3):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                client_channel.reset()
+                for i in range(20):
+                    client_channel.send(get_metrics("%d-%d" % (child, i)))
+            finally:
+                os._exit(0)
+        children.append(pid)
+    for pid in children:
+        os.waitpid(pid, 0)
+
+    received = agent_channel.receive_batch(100)
+    assert sorted(m.dimensions[0].value for m in received) ==\
+            sorted("%d-%d" % (c, i) for c in range(3) for i in range(20))
@@ -0,0 +1,164 @@
+import kadabra
+import socket
+import struct
+import pytest
+
+from mock import MagicMock, mock
+
+logger = "testlogger"
+
+@pytest.fixture
+def agent_channel():
+    channel = kadabra.channels.SocketChannel("127.0.0.1", 0, logger,
+            receive_timeout=1)
+    channel.listen()
+    yield channel
+    channel.close()
+
+def get_client(agent_channel, **kwargs):
+    return kadabra.channels.SocketChannel("127.0.0.1",
+            agent_channel.listener.address[1], logger, **kwargs)
+
+def get_metrics(name="value"):
+    return kadabra.Metrics([kadabra.Dimension("name", name)], [], [])
+
+def test_ctor():
+    channel = kadabra.channels.SocketChannel("host", 1234, logger,
+            batch_size=10, acks=True)
+
+    assert channel.host == "host"
+    assert channel.port == 1234
+    assert channel.logger.name == logger
+    assert channel.batch_size == 10
+    assert channel.acks is True
+    assert channel.sock is None
+    assert channel.listener is None
+
+def test_send_receive(agent_channel):
+    client_channel = get_client(agent_channel)
+
+    client_channel.send(get_metrics("one"))
+    client_channel.send(get_metrics("two"))
+
+    first = agent_channel.receive()
+    second = agent_channel.receive()
+
+    assert first.dimensions[0].value == "one"
+    assert first.serialized_at is not None
+    assert second.dimensions[0].value == "two"
+    assert agent_channel.in_progress(10) == [first, second]
+
+    agent_channel.complete([first, second])
+    assert agent_channel.in_progress(10) == []
+    client_channel.close()
+
+def test_acks(agent_channel):
+    client_channel = get_client(agent_channel, acks=True)
+
+    client_channel.send(get_metrics("one"))
+
+    # With acks the agent has the metrics by the time send returns.
+    assert [m.dimensions[0].value for m in
+            agent_channel.queue.get(10)] == ["one"]
+    client_channel.close()
+
+def test_batched_writes(agent_channel):
+    client_channel = get_client(agent_channel, batch_size=3, acks=True,
+            flush_interval=60)
+
+    client_channel.send(get_metrics("0"))
+    client_channel.send(get_metrics("1"))
+    assert len(client_channel.buffer) == 2
+    assert client_channel.sock is None
+
+    client_channel.send(get_metrics("2"))
+    assert len(client_channel.buffer) == 0
+    assert [m.dimensions[0].value for m in
+            agent_channel.receive_batch(10)] == ["0", "1", "2"]
+    client_channel.close()
+
+def test_flush_interval(agent_channel):
+    client_channel = get_client(agent_channel, batch_size=100,
+            flush_interval=0.01)
+
+    client_channel.send(get_metrics("one"))
+
+    assert agent_channel.receive().dimensions[0].value == "one"
+    client_channel.close()
+
+def test_send_failure_keeps_buffer():
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    port = server.getsockname()[1]
+    server.close()
+    client_channel = kadabra.channels.SocketChannel("127.0.0.1", port,
+            logger, max_buffer_size=2, socket_timeout=1)
+
+    for i in range(3):
+        with pytest.raises(socket.error):
+            client_channel.send(get_metrics(str(i)))
+
+    assert len(client_channel.buffer) == 2
+    assert client_channel.dropped == 1
+
+def test_reconnect(agent_channel):
+    client_channel = get_client(agent_channel, acks=True)
+    client_channel.send(get_metrics("one"))
+    client_channel.sock.close()
+
+    client_channel.send(get_metrics("two"))
+
+    assert [m.dimensions[0].value for m in
+            agent_channel.receive_batch(10)] == ["one", "two"]
+    client_channel.close()
+
+def test_many_connections(agent_channel):
+    clients = [get_client(agent_channel, acks=True) for _ in range(50)]
+    for i, client_channel in enumerate(clients):
+        client_channel.send(get_metrics(str(i)))
+
+    received = agent_channel.receive_batch(100)
+    assert sorted(int(m.dimensions[0].value) for m in received) ==\
+            list(range(50))
+    for client_channel in clients:
+        client_channel.close()
+
+def test_malformed_frame_drops_connection(agent_channel):
+    data = b'{"foo": 1}'
+    bad_client = socket.create_connection(agent_channel.listener.address)
+    bad_client.sendall(kadabra.channels.SocketChannel.NO_ACKS +
+            struct.pack(">I", len(data)) + data)
+    assert bad_client.recv(1) == b""
+    bad_client.close()
+
+    client_channel = get_client(agent_channel, acks=True)
+    client_channel.send(get_metrics("one"))
+
+    assert [m.dimensions[0].value for m in
+            agent_channel.receive_batch(10)] == ["one"]
+    assert agent_channel.stats()["dropped_connections"] == 1
+    client_channel.close()
+
+@mock.patch('kadabra.channels.time.sleep')
+def test_accept_error(mock_sleep):
+    channel = kadabra.channels.SocketChannel("127.0.0.1", 0, logger)
+    listener = kadabra.channels._SocketListener(channel)
+    listener.server.close()
+    listener.server = MagicMock()
+    listener.server.accept.side_effect = OSError(24, "Too many open files")
+
+    listener._accept()
+
+    mock_sleep.assert_called_with(0.1)
+    listener.selector.close()
+
+def test_reset(agent_channel):
+    client_channel = get_client(agent_channel, batch_size=10,
+            flush_interval=60)
+    client_channel.send(get_metrics("one"))
+
+    client_channel.reset()
+
+    assert len(client_channel.buffer) == 0
+    assert client_channel.sock is None
+    assert client_channel.flusher is None
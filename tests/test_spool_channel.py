@@ -0,0 +1,160 @@
+import kadabra
+import os
+import json
+import pytest
+
+logger = "testlogger"
+
+def get_unit(tmpdir, **kwargs):
+    args = {"receive_timeout": 0.01, "poll_interval": 0.01,
+            "checkpoint_interval": 0}
+    args.update(kwargs)
+    return kadabra.channels.SpoolChannel(str(tmpdir), logger, **args)
+
+def get_metrics(name="value"):
+    return kadabra.Metrics([kadabra.Dimension("name", name)], [], [])
+
+def close_reader(channel):
+    os.close(channel.read_lock_fd)
+
+def test_ctor(tmpdir):
+    path = tmpdir.join("spool")
+
+    channel = get_unit(path, segment_size=100)
+
+    assert os.path.isdir(str(path))
+    assert channel.path == str(path)
+    assert channel.logger.name == logger
+    assert channel.segment_size == 100
+
+def test_send_receive(tmpdir):
+    client_channel = get_unit(tmpdir)
+    agent_channel = get_unit(tmpdir)
+
+    client_channel.send(get_metrics("one"))
+    client_channel.send(get_metrics("two"))
+
+    first = agent_channel.receive()
+    second = agent_channel.receive()
+
+    assert first.dimensions[0].value == "one"
+    assert first.serialized_at is not None
+    assert second.dimensions[0].value == "two"
+    assert agent_channel.receive() is None
+    assert agent_channel.in_progress(10) == [first, second]
+
+def test_receive_batch(tmpdir):
+    channel = get_unit(tmpdir)
+    for i in range(3):
+        channel.send(get_metrics(str(i)))
+
+    batch = channel.receive_batch(2)
+
+    assert [m.dimensions[0].value for m in batch] == ["0", "1"]
+    assert [m.dimensions[0].value for m in channel.receive_batch(2)] == ["2"]
+    assert channel.receive_batch(2) == []
+
+def test_segment_rotation(tmpdir):
+    channel = get_unit(tmpdir, segment_size=1)
+
+    for i in range(3):
+        channel.send(get_metrics(str(i)))
+
+    assert channel._segments() == [0, 1, 2]
+    batch = channel.receive_batch(10)
+    assert [m.dimensions[0].value for m in batch] == ["0", "1", "2"]
+
+def test_complete_deletes_acknowledged_segments(tmpdir):
+    channel = get_unit(tmpdir, segment_size=1)
+    for i in range(3):
+        channel.send(get_metrics(str(i)))
+    batch = channel.receive_batch(10)
+
+    # Completing out of order doesn't move the watermark past the first.
+    channel.complete([batch[1]])
+    assert channel._segments() == [0, 1, 2]
+    assert channel.in_progress(10) == [batch[0], batch[2]]
+
+    channel.complete([batch[0]])
+    assert channel._segments() == [2]
+
+    state = json.load(open(str(tmpdir.join("state.json"))))
+    assert state == {"ack": [2, 0], "read": [2, channel.read_position[1]]}
+
+def test_restart_recovers_in_progress(tmpdir):
+    channel = get_unit(tmpdir)
+    for i in range(3):
+        channel.send(get_metrics(str(i)))
+    batch = channel.receive_batch(2)
+    channel.complete([batch[0]])
+    close_reader(channel)
+
+    restarted = get_unit(tmpdir)
+    in_progress = restarted.in_progress(10)
+    received = restarted.receive_batch(10)
+
+    assert [m.dimensions[0].value for m in in_progress] == ["1"]
+    assert [m.dimensions[0].value for m in received] == ["2"]
+
+def test_single_reader(tmpdir):
+    channel = get_unit(tmpdir)
+    channel.receive_batch(1)
+
+    with pytest.raises(Exception):
+        get_unit(tmpdir).receive_batch(1)
+
+def test_partial_record_not_read(tmpdir):
+    channel = get_unit(tmpdir)
+    channel.send(get_metrics())
+    with open(channel._segment_path(0), "ab") as f:
+        f.write(channel.HEADER.pack(100) + b"{")
+
+    assert len(channel.receive_batch(10)) == 1
+    assert channel.receive_batch(10) == []
+
+def test_unreadable_record_skipped(tmpdir):
+    channel = get_unit(tmpdir)
+    channel.send(get_metrics("0"))
+    with open(channel._segment_path(0), "ab") as f:
+        f.write(channel.HEADER.pack(3) + b"{x}")
+    channel.send(get_metrics("1"))
+
+    batch = channel.receive_batch(10)
+
+    assert [m.dimensions[0].value for m in batch] == ["0", "1"]
+    assert channel.stats() == {"unreadable": 1}
+    channel.complete(batch)
+    assert channel.in_progress(10) == []
+
+def test_cut_off_record_skipped(tmpdir):
+    channel = get_unit(tmpdir, segment_size=1)
+    channel.send(get_metrics("0"))
+    with open(channel._segment_path(0), "ab") as f:
+        f.write(channel.HEADER.pack(100) + b"{")
+    channel.send(get_metrics("1"))
+
+    batch = channel.receive_batch(10)
+
+    assert [m.dimensions[0].value for m in batch] == ["0", "1"]
+    assert channel.stats() == {"unreadable": 1}
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+def test_multiple_writer_processes(tmpdir):
+    writers = []
+    for w in range(3):
+        pid = os.fork()
+        if pid == 0:
+            writer = get_unit(tmpdir, segment_size=2000)
+            for i in range(50):
+                writer.send(get_metrics("%s-%s" % (w, i)))
+            os._exit(0)
+        writers.append(pid)
+    for pid in writers:
+        os.waitpid(pid, 0)
+
+    channel = get_unit(tmpdir)
+    values = [m.dimensions[0].value for m in channel.receive_batch(1000)]
+
+    assert len(values) == 150
+    assert len(set(values)) == 150
+    assert len(channel._segments()) > 1
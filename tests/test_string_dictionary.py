@@ -0,0 +1,92 @@
+import kadabra
+
+from mock import MagicMock, call
+
+key = "dictionary_key"
+max_size = 3
+
+def get_serialized():
+    return {
+        "dimensions": [{"name": "service", "value": "api"},
+                       {"name": "port", "value": 8080}],
+        "counters": [{"name": "requests", "metadata": {}, "value": 1.0}],
+        "timers": [{"name": "latency", "metadata": {}, "value": 5.0}],
+        "timestamp_format": "%Y",
+        "serialized_at": "2016"
+    }
+
+def get_unit(assigned_ids):
+    client = MagicMock()
+    pipeline = MagicMock()
+    pipeline.execute = MagicMock(return_value=assigned_ids)
+    client.pipeline = MagicMock(return_value=pipeline)
+    return kadabra.channels.StringDictionary(client, key, max_size)
+
+def test_ctor():
+    client = MagicMock()
+
+    dictionary = kadabra.channels.StringDictionary(client, key, max_size)
+
+    assert dictionary.client == client
+    assert dictionary.key == key
+    assert dictionary.ids_key == key + ":ids"
+    assert dictionary.max_size == max_size
+    assert dictionary.full == False
+
+def test_encode():
+    # IDs are assigned to the missing strings in sorted order.
+    dictionary = get_unit([0, 1, 2, 3, 4])
+
+    encoded = dictionary.encode(get_serialized())
+
+    assert encoded["dimensions"] == [{"name": 4, "value": 0},
+                                     {"name": 2, "value": [8080]}]
+    assert encoded["counters"][0]["name"] == 3
+    assert encoded["timers"][0]["name"] == 1
+    assert encoded["serialized_at"] == "2016"
+    assert dictionary.ids == {"api": 0, "latency": 1, "port": 2,
+            "requests": 3, "service": 4}
+    assert dictionary.full == False
+
+def test_encode_full():
+    dictionary = get_unit([0, 1, -1, -1])
+
+    encoded = dictionary.encode(get_serialized())
+
+    assert dictionary.full == True
+    assert encoded["dimensions"][0] == {"name": "service", "value": 0}
+    assert encoded["counters"][0]["name"] == "requests"
+    assert encoded["timers"][0]["name"] == 1
+
+    # Once full, no more round trips are made to assign IDs.
+    dictionary.client.pipeline.reset_mock()
+    dictionary.encode(get_serialized())
+    assert dictionary.client.pipeline.call_count == 0
+
+def test_encode_cached():
+    dictionary = get_unit([0, 1, 2, 3, 4])
+    dictionary.encode(get_serialized())
+    dictionary.client.pipeline.reset_mock()
+
+    dictionary.encode(get_serialized())
+
+    assert dictionary.client.pipeline.call_count == 0
+
+def test_decode():
+    dictionary = get_unit([])
+    dictionary.strings = {0: "api", 1: "latency", 2: "port"}
+    dictionary.client.hget = MagicMock(return_value=b"requests")
+
+    serialized = get_serialized()
+    encoded = {
+        "dimensions": [{"name": "service", "value": 0},
+                       {"name": 2, "value": [8080]}],
+        "counters": [{"name": 3, "metadata": {}, "value": 1.0}],
+        "timers": [{"name": 1, "metadata": {}, "value": 5.0}],
+        "timestamp_format": "%Y",
+        "serialized_at": "2016"
+    }
+
+    assert dictionary.decode(encoded) == serialized
+    dictionary.client.hget.assert_called_with(key + ":ids", 3)
+    assert dictionary.strings[3] == "requests"
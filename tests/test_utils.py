@@ -7,3 +7,38 @@ def test_get_datetime_from_timestamp_string():
     timestamp_format = "%Y-%m-%dT%H:%M:%SZ"
     assert kadabra.utils.get_datetime_from_timestamp_string(
             now.strftime(timestamp_format), timestamp_format) == now
+
+def test_token_bucket_take():
+    bucket = kadabra.utils.TokenBucket(10)
+
+    assert bucket.take(4) == 4
+    assert bucket.take(20) == 6
+    assert bucket.take(1) == 0
+
+def test_token_bucket_refill():
+    bucket = kadabra.utils.TokenBucket(10, capacity=5)
+    bucket.take(5)
+
+    bucket.updated = bucket.updated - 0.3
+
+    assert bucket.take(10) == 3
+
+def test_token_bucket_acquire_waits():
+    import time
+    bucket = kadabra.utils.TokenBucket(100, capacity=1)
+    bucket.acquire()
+
+    start = time.time()
+    bucket.acquire()
+
+    assert time.time() - start >= 0.005
+
+def test_get_age_seconds():
+    serialized_at = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+    metrics = kadabra.Metrics([], [], [],
+            serialized_at=serialized_at.strftime("%Y-%m-%dT%H:%M:%S.%fZ"))
+
+    assert 3599 < kadabra.utils.get_age_seconds(metrics) < 3601
+    assert kadabra.utils.get_age_seconds(kadabra.Metrics([], [], [])) is None
+    assert kadabra.utils.get_age_seconds(kadabra.Metrics([], [], [],
+        serialized_at="now")) is None